@@ -14,6 +14,7 @@ from plugins.SHARKtools_ctd_processing import gui
 from plugins.plugin_app import PluginApp
 
 from .events import subscribe
+from .jobs import JobExecutor
 
 ALL_PAGES = dict()
 ALL_PAGES['PageStart'] = gui.PageStart
@@ -70,6 +71,9 @@ class App(PluginApp):
 
         self.latest_loaded_sampling_type = ''
 
+        # Shared by all pages to run long actions outside the Tk main thread
+        self.job_executor = JobExecutor(self)
+
         self._set_frame()
 
         self.startup_pages()
@@ -91,6 +95,7 @@ class App(PluginApp):
                     frame.close()
                 except:
                     pass
+        self.job_executor.shutdown()
 
     def update_page(self):
         self.update_all()
@@ -0,0 +1,486 @@
+import concurrent.futures
+import contextlib
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import traceback
+from pathlib import Path
+
+import ctd_processing
+import file_explorer
+from file_explorer.file_handler.exceptions import RootDirectoryNotSetError
+from file_explorer.file_handler.seabird_ctd import get_seabird_file_handler
+
+from . import job_queue
+from . import jobs
+from .manifest import get_cast_id
+from .manifest import get_config_files as get_platform_config_files
+
+logger = logging.getLogger(__name__)
+
+STATUS_OK = 'ok'
+STATUS_MISMATCH = 'mismatch'
+STATUS_FILE_EXISTS = 'file_exists'
+STATUS_ERROR = 'error'
+STATUS_SKIPPED = 'skipped'
+
+# What to do when the raw files of a cast do not match (MismatchWarning). With MISMATCH_ASK the file gets
+# STATUS_MISMATCH and the caller decides (dialog in the GUI). MISMATCH_FIX and MISMATCH_IGNORE process the
+# file again in the worker with the corresponding option. MISMATCH_SKIP leaves the file as STATUS_MISMATCH.
+MISMATCH_ASK = 'ask'
+MISMATCH_FIX = 'fix'
+MISMATCH_IGNORE = 'ignore'
+MISMATCH_SKIP = 'skip'
+MISMATCH_POLICIES = [MISMATCH_ASK, MISMATCH_FIX, MISMATCH_IGNORE, MISMATCH_SKIP]
+MISMATCH_OPTIONS = {MISMATCH_FIX: dict(try_fixing_mismatch=True),
+                    MISMATCH_IGNORE: dict(ignore_mismatch=True)}
+
+# One file handler per worker process and root directory setup. Building a handler scans the roots
+_file_handlers = {}
+
+# Audit events that give the path of a file read by processing (psa files are read, edited and copied)
+FILE_ACCESS_EVENTS = ['open', 'shutil.copyfile']
+
+_used_files = threading.local()
+_audit_hook_added = False
+
+
+def get_default_nr_workers():
+    return max(1, (os.cpu_count() or 2) - 1)
+
+
+class ProcessingResult:
+
+    def __init__(self, path, status, processed_path=None, message='', mismatch_data=None, cnv_path=None,
+                 asvp_paths=None, config_files=None):
+        self.path = Path(path)
+        self.status = status
+        self.processed_path = processed_path
+        self.message = message
+        self.mismatch_data = mismatch_data
+        self.cnv_path = cnv_path
+        self.asvp_paths = asvp_paths or []
+        # The config files that processing depends on (see get_config_files), None if not known
+        self.config_files = config_files
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.path.name}, {self.status})'
+
+    @property
+    def ok(self):
+        return self.status == STATUS_OK
+
+
+class BatchReport:
+    """Collects the outcome of every file in a batch, so that problems can be handled after the batch
+    instead of stopping it. A file that is processed again replaces its earlier result."""
+
+    def __init__(self):
+        self.results = {}
+
+    def add(self, result):
+        self.results[result.path] = result
+
+    def get_results(self, *statuses):
+        return [result for path, result in sorted(self.results.items()) if result.status in statuses]
+
+    @property
+    def processed(self):
+        return self.get_results(STATUS_OK)
+
+    @property
+    def skipped(self):
+        return self.get_results(STATUS_SKIPPED)
+
+    @property
+    def problems(self):
+        return self.get_results(STATUS_MISMATCH, STATUS_FILE_EXISTS, STATUS_ERROR)
+
+    def get_counts(self):
+        counts = {}
+        for result in self.results.values():
+            counts[result.status] = counts.get(result.status, 0) + 1
+        return counts
+
+    def get_problem_lines(self):
+        lines = []
+        for result in self.problems:
+            message = (result.message or '').strip().split('\n')[-1]
+            lines.append(f'{result.path.name}: {result.status} {message}'.strip())
+        return lines
+
+    def get_text(self):
+        counts = ', '.join([f'{nr} {status}' for status, nr in sorted(self.get_counts().items())])
+        return '\n'.join([f'{len(self.results)} files: {counts}'] + self.get_problem_lines())
+
+    def as_dict(self):
+        return dict(counts=self.get_counts(),
+                    problems=[dict(path=str(result.path), status=result.status, message=result.message,
+                                   mismatch_data=result.mismatch_data) for result in self.problems])
+
+
+def create_file_handler(year, root_dirs):
+    """Returns a new file handler for the given year with the given root directories set.
+    root_dirs is a dict like {'local': ..., 'config': ...}"""
+    handler = get_seabird_file_handler(year=year)
+    for name, path in root_dirs.items():
+        if not path:
+            continue
+        try:
+            handler.set_root_dir(name, path)
+            if name in ['local', 'server']:
+                handler.create_dirs(name)
+            handler.store_files(name)
+        except RootDirectoryNotSetError:
+            pass
+    return handler
+
+
+def clear_file_handlers():
+    # Files might have been added since the handlers were created
+    _file_handlers.clear()
+
+
+def get_file_handler(year, root_dirs):
+    """Same as create_file_handler but reuses the handler within the process"""
+    key = (str(year), tuple(sorted((name, str(path)) for name, path in root_dirs.items() if path)))
+    if key not in _file_handlers:
+        _file_handlers[key] = create_file_handler(year, root_dirs)
+    return _file_handlers[key]
+
+
+def run_with_file_handler(func, year, root_dirs, /, *args, **kwargs):
+    """Returns func(*args, file_handler=<new file handler>, **kwargs). Used in the job executor so that
+    a job gets its own file handler (see create_file_handler), created in the job thread, instead of
+    sharing the file handler of a page that the Tk thread keeps using."""
+    return func(*args, file_handler=create_file_handler(year, root_dirs), **kwargs)
+
+
+def get_asvp_paths(directory, cast_id):
+    if not directory or not Path(directory).exists():
+        return []
+    return sorted([path for path in Path(directory).iterdir() if path.suffix.lower() == '.asvp'
+                   and cast_id in path.name.upper()])
+
+
+def install_file_access_hook():
+    """Installs the audit hook used by record_used_files. Only done in the worker processes that process
+    files (see get_process_pool), since an audit hook can not be removed and would run on every file access
+    in the GUI process for the rest of the session."""
+    global _audit_hook_added
+    if not _audit_hook_added:
+        sys.addaudithook(_audit_file_access)
+        _audit_hook_added = True
+
+
+def _audit_file_access(event, args):
+    paths = getattr(_used_files, 'paths', None)
+    if paths is None or event not in FILE_ACCESS_EVENTS or not args:
+        return
+    if isinstance(args[0], (str, os.PathLike)):
+        paths.add(os.fspath(args[0]))
+
+
+@contextlib.contextmanager
+def record_used_files():
+    """Yields a set that is filled with the paths of the files opened or copied in the current thread during
+    the block. The set stays empty in processes without the audit hook (see install_file_access_hook)."""
+    previous = getattr(_used_files, 'paths', None)
+    paths = set()
+    _used_files.paths = paths
+    try:
+        yield paths
+    finally:
+        _used_files.paths = previous
+        if previous is not None:
+            previous.update(paths)
+
+
+def get_config_files(paths, config_root_directory, platform=None):
+    """Returns the config files that processing depends on: the config files of the platform (see
+    manifest.get_config_files) and the files among paths (recorded with record_used_files) that are in the
+    config root directory. The platform files also cover files that processing reads without an audit
+    event (listed with os.scandir, read by a subprocess) and processing in the GUI process."""
+    if not config_root_directory:
+        return []
+    root = Path(config_root_directory).resolve()
+    config_files = {str(path.resolve()) for path in get_platform_config_files(config_root_directory, platform)}
+    for path in paths:
+        path = Path(path).resolve()
+        try:
+            path.relative_to(root)
+        except ValueError:
+            continue
+        if path.is_file():
+            config_files.add(str(path))
+    return sorted(config_files)
+
+
+def process_hex_file(path, year=None, root_dirs=None, mismatch_policy=MISMATCH_ASK, **kwargs):
+    """Processes one hex file. Runs in a worker process and never raises, the outcome is returned
+    as a ProcessingResult. A mismatch is handled according to mismatch_policy (see MISMATCH_POLICIES)."""
+    result = _process_hex_file(path, year=year, root_dirs=root_dirs, **kwargs)
+    options = MISMATCH_OPTIONS.get(mismatch_policy)
+    if result.status != STATUS_MISMATCH or not options or any([kwargs.get(key) for key in options]):
+        return result
+    logger.warning(f'Mismatch in {Path(path).name}, processing again with {options}')
+    retried = _process_hex_file(path, year=year, root_dirs=root_dirs, **{**kwargs, **options})
+    retried.mismatch_data = result.mismatch_data
+    if retried.ok:
+        retried.message = f'Mismatch handled ({mismatch_policy}): {result.mismatch_data}'
+    return retried
+
+
+def _process_hex_file(path, year=None, root_dirs=None, **kwargs):
+    root_dirs = root_dirs or {}
+    try:
+        handler = get_file_handler(year, root_dirs)
+        with record_used_files() as used_files:
+            pack = ctd_processing.process_sbe_file(path,
+                                                   target_root_directory=root_dirs.get('local'),
+                                                   config_root_directory=root_dirs.get('config'),
+                                                   file_handler=handler,
+                                                   **kwargs)
+        asvp_paths = []
+        if kwargs.get('create_asvp_file'):
+            asvp_paths = get_asvp_paths(kwargs.get('asvp_output_dir'), get_cast_id(path))
+        return ProcessingResult(path, STATUS_OK, processed_path=Path(pack['hex']), cnv_path=Path(pack['cnv']),
+                                asvp_paths=asvp_paths,
+                                config_files=get_config_files(used_files, root_dirs.get('config'),
+                                                              platform=kwargs.get('platform')) or None)
+    except FileExistsError as e:
+        return ProcessingResult(path, STATUS_FILE_EXISTS, message=str(e))
+    except file_explorer.seabird.MismatchWarning as e:
+        return ProcessingResult(path, STATUS_MISMATCH, message=str(e), mismatch_data=str(e.data))
+    except Exception:
+        return ProcessingResult(path, STATUS_ERROR, message=traceback.format_exc())
+
+
+def add_to_manifest(manifest, result, inputs=None, **processing_kwargs):
+    """Adds the outputs of a successfully processed file and the config files it was processed with to
+    the manifest. inputs (from before processing) are used if the config files used are not known."""
+    if result.config_files is not None or inputs is None:
+        inputs = manifest.get_processing_inputs(result.path, config_files=result.config_files,
+                                                **processing_kwargs)
+    cast_id = get_cast_id(result.path)
+    manifest.set_source(cast_id, result.path, result.processed_path)
+    manifest.set_output(cast_id, 'cnv', inputs, [result.cnv_path])
+    if result.asvp_paths:
+        manifest.set_output(cast_id, 'asvp', inputs, result.asvp_paths)
+
+
+class BatchProcessor:
+    """Sends hex files to a pool of worker processes. All files get the same processing arguments
+    (platform, surfacesoak, tau, overwrite, asvp options etc.). Arguments for single files can be
+    overridden in run(), for example to try fixing a mismatch.
+
+    If a manifest is given, files with unchanged input files and settings since they were last processed
+    are not processed again (status STATUS_SKIPPED).
+
+    If a job queue (job_queue.JobQueue) and batch id are given, each file is recorded as a 'process' job.
+    Files that fail with STATUS_ERROR are retried with backoff by run_all.
+
+    Mismatches are handled according to mismatch_policy. Problems never stop the batch, all results are
+    collected in report (BatchReport)."""
+
+    def __init__(self, year=None, root_dirs=None, nr_workers=None, manifest=None, job_queue=None, batch_id=None,
+                 mismatch_policy=MISMATCH_ASK, **processing_kwargs):
+        self.year = year
+        self.root_dirs = {key: str(value) for key, value in (root_dirs or {}).items() if value}
+        self.nr_workers = nr_workers or get_default_nr_workers()
+        self.manifest = manifest
+        self.job_queue = job_queue
+        self.batch_id = batch_id
+        self.mismatch_policy = mismatch_policy
+        self.report = BatchReport()
+        self.processing_kwargs = processing_kwargs
+        self._inputs = {}
+        self._job_start_times = {}
+
+    def _get_kwargs(self, path, options):
+        kwargs = dict(self.processing_kwargs)
+        kwargs.update(options.get(path, {}))
+        return kwargs
+
+    def run(self, paths, options=None):
+        """Generator that yields a ProcessingResult for each path as soon as it is finished.
+        options is an optional dict with path as key and extra processing arguments as value."""
+        options = options or {}
+        paths = list(paths)
+        if not paths:
+            return
+        clear_file_handlers()
+        self.start_jobs(paths)
+        paths_to_process = []
+        for path in paths:
+            if self.is_up_to_date(path, options):
+                result = ProcessingResult(path, STATUS_SKIPPED, message='Unchanged since last processing')
+                self.register(result)
+                yield result
+            else:
+                paths_to_process.append(path)
+        try:
+            for result in self._run(paths_to_process, options):
+                self.register(result)
+                yield result
+        finally:
+            if self.manifest:
+                self.manifest.save()
+
+    def _run(self, paths, options):
+        if not paths:
+            return
+        if self.nr_workers == 1 or len(paths) == 1:
+            for path in paths:
+                yield self.process(path, options)
+            return
+        nr_workers = min(self.nr_workers, len(paths))
+        logger.info(f'Processing {len(paths)} files using {nr_workers} processes')
+        executor = get_process_pool(nr_workers, record_file_access=True)
+        try:
+            futures = [self.submit(executor, path, options) for path in paths]
+            for future in concurrent.futures.as_completed(futures):
+                yield future.result()
+        finally:
+            # Not started files are dropped if the caller stops iterating (for example if the job is cancelled)
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _get_inputs(self, path, options):
+        key = Path(path)
+        if key not in self._inputs:
+            self._inputs[key] = self.manifest.get_processing_inputs(path, **self._get_kwargs(path, options))
+        return self._inputs[key]
+
+    def is_up_to_date(self, path, options=None):
+        if not self.manifest:
+            return False
+        options = options or {}
+        cast_id = get_cast_id(path)
+        inputs = self._get_inputs(path, options)
+        if not self.manifest.is_up_to_date(cast_id, 'cnv', inputs):
+            return False
+        if self._get_kwargs(path, options).get('create_asvp_file'):
+            return self.manifest.is_up_to_date(cast_id, 'asvp', inputs)
+        return True
+
+    def start_jobs(self, paths):
+        """Adds the files as running 'process' jobs in the job queue"""
+        if not self.job_queue:
+            return
+        self.job_queue.add_jobs(self.batch_id, 'process', [(get_cast_id(path), path) for path in paths])
+        self.job_queue.start(self.batch_id, 'process', [get_cast_id(path) for path in paths])
+        for path in paths:
+            self._job_start_times[Path(path)] = time.perf_counter()
+
+    def record(self, result):
+        """Records the result in the job queue"""
+        if not self.job_queue:
+            return
+        cast_id = get_cast_id(result.path)
+        t0 = self._job_start_times.pop(result.path, None)
+        seconds = time.perf_counter() - t0 if t0 else None
+        if result.status in [STATUS_OK, STATUS_SKIPPED]:
+            self.job_queue.finish(self.batch_id, 'process', cast_id, seconds=seconds, message=result.status)
+        else:
+            self.job_queue.fail(self.batch_id, 'process', cast_id, message=result.message or result.status,
+                                retry=result.status == STATUS_ERROR, seconds=seconds)
+
+    def register(self, result):
+        """Adds the result to the report, records it in the job queue and adds the outputs of a successfully
+        processed file to the manifest"""
+        self.report.add(result)
+        self.record(result)
+        inputs = self._inputs.pop(result.path, None)
+        if not self.manifest or not result.ok:
+            return
+        add_to_manifest(self.manifest, result, inputs=inputs, **self._get_kwargs(result.path, {}))
+
+    def submit(self, executor, path, options=None):
+        """Submits one file to the given executor. Returns the future"""
+        return executor.submit(process_hex_file, path, year=self.year, root_dirs=self.root_dirs,
+                               mismatch_policy=self.mismatch_policy, **self._get_kwargs(path, options or {}))
+
+    def process(self, path, options=None):
+        """Processes one file in the current process"""
+        return process_hex_file(path, year=self.year, root_dirs=self.root_dirs,
+                                mismatch_policy=self.mismatch_policy, **self._get_kwargs(path, options or {}))
+
+    def run_all(self, paths, options=None):
+        """Same as run but returns a list with all results. Reports progress if running as a job.
+        With a job queue, files that failed with an error are retried (see retry)."""
+        paths = [Path(path) for path in paths]
+        results = {}
+        jobs.report_progress(0, len(paths))
+        for result in self.run(paths, options=options):
+            results[result.path] = result
+            jobs.report_progress(len(results), len(paths), result.path.name)
+        for result in self.retry(paths, options=options):
+            results[result.path] = result
+        return list(results.values())
+
+    def retry(self, paths, options=None):
+        """Generator that processes the given files again as long as they have pending jobs in the job queue.
+        Waits for the backoff of each job before retrying."""
+        if not self.job_queue:
+            return
+        paths = {Path(path) for path in paths}
+        while True:
+            pending = [job for job in self.job_queue.get_jobs(self.batch_id, stage='process',
+                                                               states=[job_queue.PENDING])
+                       if Path(job['path']) in paths]
+            if not pending:
+                return
+            wait = min([job['next_attempt'] for job in pending]) - time.time()
+            if wait > 0:
+                jobs.report_progress(f'Retrying {len(pending)} files in {int(wait)} s')
+            while wait > 0:
+                jobs.raise_if_cancelled()
+                time.sleep(min(wait, 0.5))
+                wait -= 0.5
+            due = sorted([Path(job['path']) for job in pending if job['next_attempt'] <= time.time()])
+            if not due:
+                continue
+            logger.info(f'Retrying {len(due)} files')
+            yield from self.run(due, options=options)
+
+
+def get_process_pool(nr_workers, record_file_access=False):
+    """record_file_access=True installs the audit hook of record_used_files in the workers"""
+    # spawn (default on Windows) so that the workers never inherit the state of the Tk process
+    context = multiprocessing.get_context('spawn')
+    initializer = install_file_access_hook if record_file_access else None
+    return concurrent.futures.ProcessPoolExecutor(max_workers=nr_workers, mp_context=context, initializer=initializer)
+
+
+def split_in_chunks(items, nr_chunks):
+    items = list(items)
+    nr_chunks = max(1, min(nr_chunks, len(items)))
+    return [items[i::nr_chunks] for i in range(nr_chunks)]
+
+
+def run_in_processes(func, items, nr_workers=None, **kwargs):
+    """Generator that calls func(item, **kwargs) for every item using a pool of worker processes.
+    Yields (item, result, exception) in the order the items are finished."""
+    items = list(items)
+    nr_workers = min(nr_workers or get_default_nr_workers(), len(items))
+    if nr_workers <= 1:
+        for item in items:
+            try:
+                yield item, func(item, **kwargs), None
+            except Exception as e:
+                yield item, None, e
+        return
+    executor = get_process_pool(nr_workers)
+    try:
+        futures = {executor.submit(func, item, **kwargs): item for item in items}
+        for future in concurrent.futures.as_completed(futures):
+            exception = future.exception()
+            if exception:
+                yield futures[future], None, exception
+            else:
+                yield futures[future], future.result(), None
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
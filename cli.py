@@ -0,0 +1,169 @@
+"""
+Headless batch run of the processing chain. Example:
+
+    python -m plugins.SHARKtools_ctd_processing.cli <source_dir> --year 2023 --platform sbe09
+        --surfacesoak "Normal 8 m" --config-root <ctd_config> --local-root <local_root>
+
+Reprocess the casts that were processed with config files that have changed since:
+
+    python -m plugins.SHARKtools_ctd_processing.cli <source_dir> --rebuild-stale --config-root <ctd_config>
+        --local-root <local_root>
+
+Spread a campaign over several workstations that mount the same local root (see work_queue.py). Add the
+casts to the queue once and start workers on each machine:
+
+    python -m plugins.SHARKtools_ctd_processing.cli enqueue <source_dir> --year 2023 --platform sbe09
+        --surfacesoak "Normal 8 m" --config-root <ctd_config> --local-root <local_root> --campaign reprocess_2023
+    python -m plugins.SHARKtools_ctd_processing.cli worker --local-root <local_root> --campaign reprocess_2023
+    python -m plugins.SHARKtools_ctd_processing.cli status --local-root <local_root> --campaign reprocess_2023
+"""
+import argparse
+import json
+import logging
+import sys
+from pathlib import Path
+
+from . import batch
+from . import pipeline
+from . import server_copy
+from . import work_queue
+
+WORK_QUEUE_COMMANDS = ['enqueue', 'worker', 'status']
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Runs the CTD processing chain without GUI: '
+                                                 'process -> standard format -> automatic qc -> plots -> '
+                                                 'copy to server')
+    parser.add_argument('source_dir', help='Directory with raw files (hex, xmlcon, hdr...)')
+    parser.add_argument('--year')
+    parser.add_argument('--platform')
+    parser.add_argument('--surfacesoak')
+    parser.add_argument('--config-root', required=True, help='Root directory for ctd_config')
+    parser.add_argument('--local-root', required=True, help='Root directory for local data')
+    parser.add_argument('--server-root', help='Root directory for data on the server. Files are not copied '
+                                              'to the server if not given')
+    parser.add_argument('--hex', nargs='*', help='Hex files to process. Default is all files in source_dir '
+                                                 'that are neither found locally nor on the server')
+    parser.add_argument('--workers', type=int, default=batch.get_default_nr_workers(),
+                        help='Number of worker processes')
+    parser.add_argument('--copy-workers', type=int, default=server_copy.DEFAULT_NR_WORKERS,
+                        help='Number of threads used when copying to the server')
+    parser.add_argument('--no-plots', action='store_true', help='Do not create plots')
+    parser.add_argument('--mismatch-policy', choices=batch.MISMATCH_POLICIES, default=batch.MISMATCH_SKIP,
+                        help='What to do with casts where the raw files do not match: try to fix, ignore or '
+                             'skip (ask is the same as skip without GUI). Skipped casts are listed in the report')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Skip casts with unchanged raw files, config files and settings since the last run')
+    parser.add_argument('--rebuild-stale', action='store_true',
+                        help='Only reprocess the casts that depend on changed config files. Each cast is processed '
+                             'with the same settings as before, --year, --platform and --surfacesoak are not used')
+    parser.add_argument('--summary-file', help='Also write the summary (json) to this file')
+    parser.add_argument('--log-level', default='INFO')
+    return parser
+
+
+def get_work_queue_parser():
+    parser = argparse.ArgumentParser(description='Distributed processing through a work queue in the shared '
+                                                 'local root')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    enqueue = subparsers.add_parser('enqueue', help='Add casts to a campaign')
+    enqueue.add_argument('source_dir', help='Directory with raw files (hex, xmlcon, hdr...)')
+    enqueue.add_argument('--year', required=True)
+    enqueue.add_argument('--platform', required=True)
+    enqueue.add_argument('--surfacesoak', required=True)
+    enqueue.add_argument('--config-root', required=True, help='Root directory for ctd_config')
+    enqueue.add_argument('--hex', nargs='*', help='Hex files to add. Default is all hex files for the year '
+                                                  'in source_dir')
+    enqueue.add_argument('--no-plots', action='store_true', help='Do not create plots')
+    enqueue.add_argument('--mismatch-policy', choices=batch.MISMATCH_POLICIES, default=batch.MISMATCH_SKIP)
+
+    worker = subparsers.add_parser('worker', help='Process casts in a campaign')
+    worker.add_argument('--workers', type=int, default=1, help='Number of worker processes on this machine')
+    worker.add_argument('--wait', action='store_true', help='Keep waiting for new casts when the queue is empty')
+    worker.add_argument('--retry-failed', action='store_true', help='Process failed casts again')
+
+    subparsers.add_parser('status', help='Print the state of a campaign')
+
+    for subparser in subparsers.choices.values():
+        subparser.add_argument('--local-root', required=True, help='Root directory for local data (shared)')
+        subparser.add_argument('--campaign', default=work_queue.DEFAULT_CAMPAIGN)
+        subparser.add_argument('--log-level', default='INFO')
+    return parser
+
+
+def main_work_queue(argv):
+    args = get_work_queue_parser().parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    queue_directory = work_queue.get_queue_directory(args.local_root, args.campaign)
+    if args.command == 'enqueue':
+        hex_paths = args.hex
+        if hex_paths is None:
+            hex_paths = sorted([path for path in Path(args.source_dir).glob('*.hex')
+                                if pipeline.get_year_from_key(path.name) == str(args.year)])
+        work_queue.create_campaign(args.local_root, [Path(path).absolute() for path in hex_paths],
+                                   year=args.year,
+                                   config_root_directory=args.config_root,
+                                   campaign=args.campaign,
+                                   create_plots=not args.no_plots,
+                                   mismatch_policy=args.mismatch_policy,
+                                   platform=args.platform,
+                                   surfacesoak=args.surfacesoak)
+    elif args.command == 'worker':
+        if args.retry_failed:
+            work_queue.WorkQueue(queue_directory).reset_failed()
+        work_queue.run_workers(queue_directory, nr_workers=args.workers, wait=args.wait)
+    summary = work_queue.WorkQueue(queue_directory).get_summary()
+    print(json.dumps(summary, indent=4))
+    return 1 if summary['nr_failed'] else 0
+
+
+def print_summary(summary, stream=sys.stdout):
+    for name, item in summary['stages'].items():
+        print(f'{name:<16}{item["nr_items"]:>6} items {item["seconds"]:>10.2f} s', file=stream)
+    print(f'{"total":<16}{summary["nr_casts"]:>6} casts {summary["total_seconds"]:>10.2f} s', file=stream)
+    for item in summary['failed']:
+        print(f'FAILED in {item["stage"]}: {item["item"]}', file=stream)
+    print(json.dumps(summary), file=stream)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] in WORK_QUEUE_COMMANDS:
+        return main_work_queue(argv)
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    if args.rebuild_stale:
+        summary = pipeline.rebuild_stale(config_root_directory=args.config_root,
+                                         local_root_directory=args.local_root,
+                                         nr_workers=args.workers,
+                                         create_plots_option=not args.no_plots)
+    else:
+        for name in ['year', 'platform', 'surfacesoak']:
+            if not getattr(args, name):
+                parser.error(f'--{name} is required')
+        summary = pipeline.run(source_directory=args.source_dir,
+                               year=args.year,
+                               platform=args.platform,
+                               surfacesoak=args.surfacesoak,
+                               config_root_directory=args.config_root,
+                               local_root_directory=args.local_root,
+                               server_root_directory=args.server_root,
+                               hex_paths=args.hex,
+                               nr_workers=args.workers,
+                               create_plots_option=not args.no_plots,
+                               copy_workers=args.copy_workers,
+                               incremental=args.incremental,
+                               mismatch_policy=args.mismatch_policy)
+    print_summary(summary)
+    if args.summary_file:
+        with open(args.summary_file, 'w') as fid:
+            json.dump(summary, fid, indent=4)
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
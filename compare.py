@@ -0,0 +1,100 @@
+"""
+Bulk comparison of local files and files on the server. Both directories are listed once and all names
+are compared in one pass, instead of selecting every file in the file handler.
+"""
+import logging
+import os
+
+from .manifest import get_file_hash
+
+logger = logging.getLogger(__name__)
+
+# Modification times on network shares are not exact
+MTIME_TOLERANCE = 2
+
+
+class Comparison:
+
+    def __init__(self, missing=None, outdated=None, identical=None, only_on_server=None):
+        self.missing = set(missing or [])
+        self.outdated = set(outdated or [])
+        self.identical = set(identical or [])
+        self.only_on_server = set(only_on_server or [])
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(missing={len(self.missing)}, outdated={len(self.outdated)}, ' \
+               f'identical={len(self.identical)}, only_on_server={len(self.only_on_server)})'
+
+
+def get_file_stats(directory):
+    """Returns a dict with file name as key and (size, mtime) as value. The directory is listed once"""
+    stats = {}
+    try:
+        entries = list(os.scandir(directory))
+    except (FileNotFoundError, NotADirectoryError, TypeError):
+        return stats
+    for entry in entries:
+        if not entry.is_file():
+            continue
+        stat = entry.stat()
+        stats[entry.name] = (stat.st_size, stat.st_mtime)
+    return stats
+
+
+def get_file_stats_for_names(directory, names):
+    """Returns the same as get_file_stats but only for the given names. Used when only a few files have
+    changed and the directory does not need to be listed"""
+    stats = {}
+    if not directory:
+        return stats
+    for name in names:
+        try:
+            stat = os.stat(os.path.join(directory, name))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        stats[name] = (stat.st_size, stat.st_mtime)
+    return stats
+
+
+def compare_stats(local_stats, server_stats, names=None, local_directory=None, server_directory=None,
+                  checksum=False):
+    """Compares the local files with the files on the server. local_stats and server_stats are dicts
+    as returned by get_file_stats. Only names are compared if given.
+
+    missing: not on the server
+    outdated: on the server but with other size or older modification time (or other checksum)
+    identical: same size and not older on the server (or same checksum)
+
+    With checksum=True files with the same size are compared by checksum (requires the directories)."""
+    local_names = set(local_stats)
+    if names is not None:
+        local_names &= set(names)
+    server_names = set(server_stats)
+
+    missing = local_names - server_names
+    common = local_names & server_names
+    outdated = set()
+    identical = set()
+    for name in common:
+        local_size, local_mtime = local_stats[name]
+        server_size, server_mtime = server_stats[name]
+        if local_size != server_size:
+            outdated.add(name)
+        elif checksum:
+            if get_file_hash(os.path.join(local_directory, name)) == \
+                    get_file_hash(os.path.join(server_directory, name)):
+                identical.add(name)
+            else:
+                outdated.add(name)
+        elif local_mtime > server_mtime + MTIME_TOLERANCE:
+            outdated.add(name)
+        else:
+            identical.add(name)
+    return Comparison(missing=missing, outdated=outdated, identical=identical,
+                      only_on_server=server_names - set(local_stats))
+
+
+def compare_directories(local_directory, server_directory, names=None, checksum=False):
+    """Lists both directories once and compares them. See compare_stats"""
+    return compare_stats(get_file_stats(local_directory), get_file_stats(server_directory), names=names,
+                         local_directory=local_directory, server_directory=server_directory, checksum=checksum)
@@ -20,6 +20,7 @@ class EventTypes:
             'change_tau',
             'change_overwrite',
             'change_simple_old_key',
+            'change_simple_watch_source',
             'update_series_local_source',
             'change_local_data_path_raw',
             'change_year',
@@ -29,6 +30,7 @@ class EventTypes:
             'change_metadata_packs_target',
             'change_metadata_packs_sharkweb_path',
             'change_metadata_packs_lims_path',
+            'file_catalogue_delta',
         ]
 
         for item in self.event_types:
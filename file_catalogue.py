@@ -0,0 +1,342 @@
+"""
+Event driven catalogue of the files in the watched directories. Instead of listing the directories again
+after every action, changes are picked up by a watcher and delivered as deltas (added, removed and
+modified file names).
+
+On Linux inotify is used (through ctypes). Directories on network shares (cifs, nfs...) do not get
+inotify events for changes made by other computers, so these, and all directories on other platforms,
+are polled every poll_interval seconds.
+
+The watchers run in a background thread and put the deltas in a queue. get_deltas() is called from the
+Tk thread (see PageStart) where the deltas are posted on the event bus as 'file_catalogue_delta'.
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+import queue
+import select
+import struct
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 5
+
+NETWORK_FILE_SYSTEMS = ['cifs', 'smb', 'smbfs', 'smb2', 'smb3', 'nfs', 'nfs4', 'fuse.sshfs', 'afs', '9p']
+
+# From sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT_STRUCT = struct.Struct('iIII')
+
+
+class FileDelta:
+
+    def __init__(self, key, directory, added=None, removed=None, modified=None):
+        self.key = key
+        self.directory = directory
+        self.added = set(added or [])
+        self.removed = set(removed or [])
+        self.modified = set(modified or [])
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.key}, added={len(self.added)}, removed={len(self.removed)}, ' \
+               f'modified={len(self.modified)})'
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.modified)
+
+    def merge(self, other):
+        """Adds a later delta for the same directory"""
+        for name in other.added:
+            if name in self.removed:
+                self.removed.discard(name)
+                self.modified.add(name)
+            else:
+                self.added.add(name)
+        for name in other.removed:
+            self.modified.discard(name)
+            if name in self.added:
+                self.added.discard(name)
+            else:
+                self.removed.add(name)
+        self.modified.update(other.modified - self.added)
+
+
+def get_file_stats(directory):
+    stats = {}
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                try:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                stats[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        pass
+    return stats
+
+
+def get_file_system_type(path):
+    """Returns the file system type of the mount point of the path (Linux only)"""
+    path = os.path.realpath(path)
+    best = ('', '')
+    try:
+        with open('/proc/mounts') as fid:
+            for line in fid:
+                parts = line.split()
+                if len(parts) < 3:
+                    continue
+                mount_point = parts[1].replace('\\040', ' ')
+                if path == mount_point or path.startswith(mount_point.rstrip('/') + '/'):
+                    if len(mount_point) > len(best[0]):
+                        best = (mount_point, parts[2])
+    except OSError:
+        return ''
+    return best[1]
+
+
+def is_network_path(path):
+    return get_file_system_type(path) in NETWORK_FILE_SYSTEMS
+
+
+def get_libc():
+    """Returns libc if it supports inotify, else None"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class InotifyWatcher:
+
+    def __init__(self, libc, callback):
+        self._libc = libc
+        self._callback = callback
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._watches = {}
+
+    def add(self, directory):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {directory}')
+        self._watches[wd] = directory
+
+    def remove(self, directory):
+        for wd, watched in list(self._watches.items()):
+            if watched == directory:
+                self._libc.inotify_rm_watch(self._fd, wd)
+                self._watches.pop(wd, None)
+
+    def read(self, timeout):
+        """Waits at most timeout seconds for events and calls callback(directory, changes) where changes
+        is a list of (name, kind) with kind 'added', 'removed', 'modified' or 'rescan'"""
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        changes = {}
+        offset = 0
+        while offset + EVENT_STRUCT.size <= len(data):
+            wd, mask, cookie, length = EVENT_STRUCT.unpack_from(data, offset)
+            offset += EVENT_STRUCT.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                for directory in self._watches.values():
+                    changes.setdefault(directory, []).append(('', 'rescan'))
+                continue
+            directory = self._watches.get(wd)
+            if directory is None or mask & IN_ISDIR:
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                changes.setdefault(directory, []).append(('', 'rescan'))
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                changes.setdefault(directory, []).append((name, 'added'))
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                changes.setdefault(directory, []).append((name, 'removed'))
+            elif mask & IN_CLOSE_WRITE:
+                changes.setdefault(directory, []).append((name, 'modified'))
+        for directory, items in changes.items():
+            self._callback(directory, items)
+
+    def close(self):
+        os.close(self._fd)
+
+
+class FileCatalogue:
+
+    def __init__(self, poll_interval=POLL_INTERVAL, use_inotify=True):
+        self.poll_interval = poll_interval
+        self._directories = {}
+        self._names = {}
+        self._polled = {}
+        self._deltas = queue.Queue()
+        self._lock = threading.RLock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._inotify = None
+        libc = get_libc() if use_inotify else None
+        if libc:
+            try:
+                self._inotify = InotifyWatcher(libc, self._on_inotify_changes)
+            except OSError as e:
+                logger.warning(f'inotify not available, polling instead: {e}')
+
+    @property
+    def running(self):
+        return bool(self._thread and self._thread.is_alive())
+
+    def watch(self, key, directory):
+        """Starts watching the directory under the given key, for example ('local', 'cnv'). A key that
+        already watches another directory is moved to the new directory."""
+        directory = os.path.abspath(directory) if directory else None
+        with self._lock:
+            if self._directories.get(key) == directory:
+                return
+            self.unwatch(key)
+            if not directory or not os.path.isdir(directory):
+                return
+            self._directories[key] = directory
+            stats = get_file_stats(directory)
+            self._names[key] = set(stats)
+            if self._inotify and not is_network_path(directory):
+                try:
+                    self._inotify.add(directory)
+                    return
+                except OSError as e:
+                    logger.warning(f'Could not watch {directory} with inotify, polling instead: {e}')
+            self._polled[key] = stats
+
+    def unwatch(self, key):
+        with self._lock:
+            directory = self._directories.pop(key, None)
+            self._names.pop(key, None)
+            self._polled.pop(key, None)
+            if directory and self._inotify and directory not in self._directories.values():
+                self._inotify.remove(directory)
+
+    def get_names(self, key):
+        with self._lock:
+            return sorted(self._names.get(key, []))
+
+    def start(self):
+        if self.running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='file_catalogue')
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        self._thread = None
+
+    def close(self):
+        self.stop()
+        if self._inotify:
+            self._inotify.close()
+            self._inotify = None
+
+    def _run(self):
+        next_poll = 0
+        while not self._stop_event.is_set():
+            if self._inotify:
+                self._inotify.read(timeout=0.5)
+            else:
+                self._stop_event.wait(0.5)
+            next_poll -= 0.5
+            if next_poll <= 0:
+                self._poll()
+                next_poll = self.poll_interval
+
+    def _poll(self):
+        with self._lock:
+            polled = {key: (self._directories[key], stats) for key, stats in self._polled.items()}
+        for key, (directory, old_stats) in polled.items():
+            stats = get_file_stats(directory)
+            if stats == old_stats:
+                continue
+            delta = FileDelta(key, directory,
+                              added=set(stats) - set(old_stats),
+                              removed=set(old_stats) - set(stats),
+                              modified=[name for name in stats if name in old_stats and stats[name] != old_stats[name]])
+            with self._lock:
+                if key not in self._polled:
+                    continue
+                self._polled[key] = stats
+                self._names[key] = set(stats)
+            self._deltas.put(delta)
+
+    def _on_inotify_changes(self, directory, changes):
+        with self._lock:
+            keys = [key for key, watched in self._directories.items() if watched == directory]
+            for key in keys:
+                names = self._names[key]
+                delta = FileDelta(key, directory)
+                if any([kind == 'rescan' for name, kind in changes]):
+                    current = set(get_file_stats(directory))
+                    delta.added = current - names
+                    delta.removed = names - current
+                else:
+                    for name, kind in changes:
+                        if kind == 'added':
+                            delta.merge(FileDelta(key, directory, added=[name]))
+                        elif kind == 'removed':
+                            delta.merge(FileDelta(key, directory, removed=[name]))
+                        else:
+                            delta.merge(FileDelta(key, directory, modified=[name]))
+                    # A known name that is added again has been replaced (for example saved via a temporary
+                    # file and renamed)
+                    replaced = delta.added & names
+                    delta.added -= replaced
+                    delta.modified.update(replaced)
+                    delta.removed &= names | delta.added
+                names.update(delta.added)
+                names.difference_update(delta.removed)
+                if delta:
+                    self._deltas.put(delta)
+
+    def get_deltas(self):
+        """Returns the deltas since the last call, merged per key"""
+        deltas = {}
+        while True:
+            try:
+                delta = self._deltas.get_nowait()
+            except queue.Empty:
+                break
+            if delta.key in deltas:
+                deltas[delta.key].merge(delta)
+            else:
+                deltas[delta.key] = delta
+        return [delta for delta in deltas.values() if delta]
@@ -0,0 +1,107 @@
+"""
+Cache of the file listing on FTP. The listing is fetched in a background thread (through the session
+pool in ftp_pool.py) when it is older than ttl seconds, so the GUI does not freeze on a slow link.
+Files sent by the plugin are added to the cached listing without listing the server again.
+"""
+import logging
+import threading
+import time
+
+from . import ftp_pool
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 300
+
+
+class RemoteListing:
+
+    def __init__(self):
+        self.names = None
+        self.time = 0
+        self.version = 0
+        self.error = None
+        self.refreshing = False
+
+    @property
+    def age(self):
+        if not self.time:
+            return None
+        return time.time() - self.time
+
+
+class RemoteListingCache:
+
+    def __init__(self, ttl=DEFAULT_TTL, pool=None):
+        self.ttl = ttl
+        self._pool = pool or ftp_pool.get_pool()
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    def _get_listing(self, credentials):
+        key = ftp_pool.get_key(credentials)
+        with self._lock:
+            return self._listings.setdefault(key, RemoteListing())
+
+    def get(self, credentials, refresh=False):
+        """Returns the cached RemoteListing. A background refresh is started if the listing is older than
+        ttl or refresh=True. listing.names is None until the first listing is done."""
+        listing = self._get_listing(credentials)
+        expired = listing.age is None or listing.age > self.ttl
+        if (expired or refresh) and not listing.refreshing:
+            self._start_refresh(credentials, listing)
+        return listing
+
+    def peek(self, credentials):
+        """Returns the cached RemoteListing without starting a refresh"""
+        return self._get_listing(credentials)
+
+    def get_names(self, credentials):
+        return list(self.get(credentials).names or [])
+
+    def _start_refresh(self, credentials, listing):
+        listing.refreshing = True
+        credentials = dict(credentials)
+        threading.Thread(target=self._refresh, args=(credentials, listing), daemon=True,
+                         name='ftp_listing').start()
+
+    def _refresh(self, credentials, listing):
+        try:
+            names = self._pool.run(credentials, ftp_pool.list_files)
+            with self._lock:
+                listing.names = list(names)
+                listing.time = time.time()
+                listing.error = None
+                listing.version += 1
+        except Exception as e:
+            logger.warning(f'Could not list files on FTP: {e}')
+            with self._lock:
+                listing.error = e
+                listing.version += 1
+        finally:
+            listing.refreshing = False
+
+    def add_names(self, credentials, names):
+        """Adds names sent to the server to the cached listing (without listing the server)"""
+        listing = self._get_listing(credentials)
+        with self._lock:
+            if listing.names is None:
+                return
+            current = set(listing.names)
+            listing.names.extend([name for name in names if name not in current])
+            listing.version += 1
+
+    def invalidate(self, credentials=None):
+        with self._lock:
+            if credentials is None:
+                self._listings = {}
+            else:
+                self._listings.pop(ftp_pool.get_key(credentials), None)
+
+    def get_missing(self, credentials, local_names):
+        """Returns the local names that are not in the cached listing. None if there is no listing yet"""
+        listing = self._get_listing(credentials)
+        if listing.names is None:
+            return None
+        remote = set(listing.names)
+        return [name for name in local_names if name not in remote]
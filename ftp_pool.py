@@ -0,0 +1,153 @@
+"""
+Pool of FTP connections that are kept alive and shared between listing and sending. Connections are keyed on
+the credentials and the destination (test or not), so the handshake and login is only done once instead
+of every time the file list is updated.
+
+The pool holds logged in ftplib.FTP connections (see ftp_upload.connect), not ftp.Ftp objects from
+sharkpylib. ftp.Ftp keeps a list of files to send and a cached listing, state that must not be shared
+between uses. A connection is checked with NOOP before it is reused. A connection that fails is dropped
+and a new one is created on the next use. Connections not used for IDLE_TIMEOUT seconds are recreated
+since the server has probably closed them.
+"""
+import contextlib
+import ftplib
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+
+from . import ftp_upload
+
+logger = logging.getLogger(__name__)
+
+IDLE_TIMEOUT = 240
+
+CONNECTION_ERRORS = (OSError, EOFError) + ftplib.all_errors
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Returns the FtpSessionPool shared by the plugin"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = FtpSessionPool()
+        return _pool
+
+
+def get_key(credentials):
+    return json.dumps(credentials, sort_keys=True, default=str)
+
+
+def list_files(con):
+    """Returns the file names in the current directory of the connection"""
+    return [name for name in con.nlst() if name not in ['.', '..']]
+
+
+def send_files(con, paths, status_callback=None):
+    """Uploads the files in paths (a list) and removes each file from the list when it is sent, so that a
+    retry with the same list only sends the rest. status_callback((nr_done, nr_total, file_name)) is called
+    after each file."""
+    nr_total = len(paths)
+    while paths:
+        path = Path(paths[0])
+        ftp_upload.upload_file(con, path)
+        paths.pop(0)
+        if status_callback:
+            status_callback((nr_total - len(paths), nr_total, path.name))
+
+
+class FtpSession:
+
+    def __init__(self, credentials, connect_func=None):
+        self.key = get_key(credentials)
+        self.lock = threading.RLock()
+        self.last_used = time.time()
+        self.con = (connect_func or ftp_upload.connect)(credentials)
+
+    @property
+    def idle_seconds(self):
+        return time.time() - self.last_used
+
+    def is_alive(self):
+        try:
+            self.con.voidcmd('NOOP')
+            return True
+        except CONNECTION_ERRORS:
+            return False
+
+    def close(self):
+        try:
+            self.con.quit()
+        except CONNECTION_ERRORS:
+            self.con.close()
+
+
+class FtpSessionPool:
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT, connect_func=None):
+        self.idle_timeout = idle_timeout
+        self._connect = connect_func
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self.nr_connects = 0
+
+    def _get_session(self, credentials):
+        key = get_key(credentials)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session and session.idle_seconds > self.idle_timeout:
+                logger.debug('FTP session idle too long, reconnecting')
+                session.close()
+                session = None
+            if not session:
+                session = FtpSession(credentials, connect_func=self._connect)
+                self.nr_connects += 1
+                self._sessions[key] = session
+            return session
+
+    def drop(self, credentials):
+        """Closes and removes the session for the given credentials"""
+        with self._lock:
+            session = self._sessions.pop(get_key(credentials), None)
+        if session:
+            session.close()
+
+    @contextlib.contextmanager
+    def session(self, credentials):
+        """Yields the pooled ftplib.FTP connection for the credentials. Only one thread at the time uses a
+        connection. The session is dropped if a connection error occurs in the block."""
+        session = self._get_session(credentials)
+        with session.lock:
+            if not session.is_alive():
+                self.drop(credentials)
+                raise ftplib.error_temp('FTP connection closed by server')
+            try:
+                yield session.con
+            except CONNECTION_ERRORS:
+                self.drop(credentials)
+                raise
+            finally:
+                session.last_used = time.time()
+
+    def run(self, credentials, func, retries=1):
+        """Returns func(connection). If the connection has failed the session is recreated and func
+        is called again (at most retries times)."""
+        for attempt in range(retries + 1):
+            try:
+                with self.session(credentials) as con:
+                    return func(con)
+            except CONNECTION_ERRORS as e:
+                if attempt == retries:
+                    raise
+                logger.info(f'FTP connection failed ({e}), reconnecting')
+
+    def close(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions = {}
+        for session in sessions:
+            session.close()
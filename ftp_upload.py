@@ -0,0 +1,162 @@
+"""
+Upload of files to FTP over several parallel connections. On a link with high latency one connection
+makes poor use of the bandwidth, so the files are spread over nr_connections connections.
+
+The remote size is checked after each upload. A file that fails is retried on a new connection and the
+partially transferred file is resumed with REST.
+
+Uses ftplib directly since ftp.Ftp in sharkpylib does not support resume. The credentials are the same
+as for ftp.Ftp: host, user (or username) and password. Files are sent to the test directory if
+credentials['test'] is True.
+"""
+import ftplib
+import logging
+import queue
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_NR_CONNECTIONS = 4
+BLOCK_SIZE = 64 * 1024
+TIMEOUT = 60
+
+
+class UploadError(Exception):
+    pass
+
+
+class UploadResult:
+
+    def __init__(self):
+        self.sent = []
+        self.resumed = []
+        self.failed = []
+        self.nr_bytes = 0
+        self.seconds = 0
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(sent={len(self.sent)}, resumed={len(self.resumed)}, ' \
+               f'failed={len(self.failed)}, {self.seconds:.1f} s)'
+
+
+def connect(credentials, timeout=TIMEOUT):
+    """Returns a logged in ftplib.FTP in the destination directory"""
+    con = ftplib.FTP(timeout=timeout)
+    con.connect(credentials['host'], int(credentials.get('port', 21)))
+    con.login(credentials.get('user', credentials.get('username', '')),
+              credentials.get('password', credentials.get('passwd', '')))
+    if credentials.get('test', True):
+        con.cwd('test')
+    return con
+
+
+def get_remote_size(con, name):
+    """Returns the size of the remote file or None if it does not exist"""
+    con.voidcmd('TYPE I')
+    try:
+        return con.size(name)
+    except ftplib.error_perm:
+        return None
+
+
+def upload_file(con, path, resume=False, block_size=BLOCK_SIZE):
+    """Uploads path to the current directory of con. With resume=True (used when retrying) the upload
+    continues from the size of a smaller remote file. Returns (nr_bytes_sent, offset)."""
+    path = Path(path)
+    local_size = path.stat().st_size
+    offset = 0
+    if resume:
+        remote_size = get_remote_size(con, path.name)
+        if remote_size is not None and remote_size < local_size:
+            offset = remote_size
+    with open(path, 'rb') as fid:
+        fid.seek(offset)
+        con.storbinary(f'STOR {path.name}', fid, blocksize=block_size, rest=offset or None)
+    remote_size = get_remote_size(con, path.name)
+    if remote_size != local_size:
+        raise UploadError(f'Remote size {remote_size} differs from local size {local_size}: {path.name}')
+    return local_size - offset, offset
+
+
+class ParallelUploader:
+
+    def __init__(self, credentials, nr_connections=DEFAULT_NR_CONNECTIONS, retries=2, timeout=TIMEOUT,
+                 connect_func=None):
+        self.credentials = dict(credentials)
+        self.nr_connections = nr_connections
+        self.retries = retries
+        self.timeout = timeout
+        self._connect = connect_func or connect
+
+    def _worker(self, paths, messages):
+        con = None
+        try:
+            while True:
+                try:
+                    path, attempt = paths.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    if con is None:
+                        con = self._connect(self.credentials, timeout=self.timeout)
+                    nr_bytes, offset = upload_file(con, path, resume=attempt > 0)
+                    messages.put(('done', path, nr_bytes, offset))
+                except (UploadError, EOFError) + ftplib.all_errors as e:
+                    logger.warning(f'FTP upload of {path.name} failed (attempt {attempt + 1}): {e}')
+                    con = _close(con)
+                    if attempt < self.retries:
+                        paths.put((path, attempt + 1))
+                    else:
+                        messages.put(('failed', path, str(e), None))
+        finally:
+            _close(con)
+            messages.put(('exit', None, None, None))
+
+    def upload(self, paths, status_callback=None):
+        """Uploads the files. status_callback((nr_done, nr_total, file_name)) is called in the calling
+        thread after each file. Returns an UploadResult."""
+        paths = [Path(path) for path in paths]
+        result = UploadResult()
+        if not paths:
+            return result
+        t0 = time.perf_counter()
+        path_queue = queue.Queue()
+        for path in paths:
+            path_queue.put((path, 0))
+        messages = queue.Queue()
+        nr_threads = max(1, min(self.nr_connections, len(paths)))
+        for i in range(nr_threads):
+            threading.Thread(target=self._worker, args=(path_queue, messages), daemon=True,
+                             name=f'ftp_upload_{i}').start()
+        nr_running = nr_threads
+        nr_done = 0
+        while nr_running:
+            message, path, value, offset = messages.get()
+            if message == 'exit':
+                nr_running -= 1
+                continue
+            nr_done += 1
+            if message == 'failed':
+                result.failed.append((path, value))
+            else:
+                result.sent.append(path)
+                result.nr_bytes += value
+                if offset:
+                    result.resumed.append(path)
+            if status_callback:
+                status_callback((nr_done, len(paths), path.name))
+        result.seconds = time.perf_counter() - t0
+        logger.info(f'FTP upload: {result}')
+        return result
+
+
+def _close(con):
+    if con is None:
+        return None
+    try:
+        con.quit()
+    except (EOFError,) + ftplib.all_errors:
+        con.close()
+    return None
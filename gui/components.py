@@ -671,3 +671,48 @@ class SeriesSelection(tk.Frame):
         return self.selection_widget.get_selected()
 
 
+class JobStatus(tk.Frame):
+    """Shows the running background job and lets the user cancel queued and running jobs"""
+
+    def __init__(self,
+                 parent,
+                 executor,
+                 cancel_text='Cancel',
+                 queued_text='{} queued',
+                 **kwargs):
+
+        self.grid_frame = {'padx': 5,
+                           'pady': 5,
+                           'sticky': 'nsew'}
+        self.grid_frame.update(kwargs)
+
+        self._executor = executor
+        self._cancel_text = cancel_text
+        self._queued_text = queued_text
+
+        super().__init__(parent)
+        self.grid(**self.grid_frame)
+
+        self._create_frame()
+        self._executor.add_status_callback(self._on_status)
+
+    def _create_frame(self):
+        self._stringvar = tk.StringVar()
+        tk.Label(self, textvariable=self._stringvar).grid(column=0, row=0, padx=5, pady=5, sticky='w')
+        self.button = tk.Button(self, text=self._cancel_text, command=self._executor.cancel_all, state='disabled')
+        self.button.grid(column=1, row=0, padx=5, pady=5, sticky='e')
+        tkw.grid_configure(self, nr_columns=2)
+
+    def _on_status(self, executor):
+        job = executor.current_job
+        if not job and not executor.nr_queued:
+            self._stringvar.set('')
+            self.button.config(state='disabled')
+            return
+        parts = []
+        if job:
+            parts.append(f'{job.name} {job.status}'.strip())
+        if executor.nr_queued:
+            parts.append(self._queued_text.format(executor.nr_queued))
+        self._stringvar.set(', '.join(parts))
+        self.button.config(state='normal')
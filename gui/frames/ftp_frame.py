@@ -8,6 +8,10 @@ import sharkpylib.tklib.tkinter_widgets as tkw
 from sharkpylib import ftp
 
 from .. import components
+from ... import ftp_listing
+from ... import ftp_pool
+from ... import ftp_upload
+from ... import jobs
 from ...events import subscribe
 from ...events import post_event
 from ...saves import SaveComponents
@@ -27,18 +31,22 @@ LISTBOX_TITLES = dict(title_items=dict(text=_('Välj filer genom att dubbelklick
 
 class FtpFrame(tk.Frame):
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, job_executor=None, **kwargs):
         self._listbox_prop = {'width': 45, 'height': 6}
         self._listbox_prop.update(kwargs.get('listbox_prop', {}))
         super().__init__(*args, **kwargs)
 
+        self._job_executor = job_executor
+
         self._save_obj = SaveComponents(key='ftp')
 
         self._file_handler = None
+        self._ftp_listing = ftp_listing.RemoteListingCache()
 
         self._build()
         self._save_obj.add_components(
                                       self._ftp_credentials_path,
+                                      self._parallel_upload,
                                       )
 
         self._save_obj.load()
@@ -52,6 +60,7 @@ class FtpFrame(tk.Frame):
 
     def close(self):
         self._save_obj.save()
+        ftp_pool.get_pool().close()
 
     def _get_ftp_title(self):
         return _('Filer på FTP: {}').format(self._get_ftp_destination())
@@ -60,8 +69,9 @@ class FtpFrame(tk.Frame):
         cred = self.ftp_credentials
         if not cred:
             return ''
-        obj = get_ftp_object(cred)
-        return f'{cred.get("host", "")}/{obj.destination}'
+        # Same directory as in ftp_upload.connect. No need to connect to the server
+        destination = 'test' if cred.get('test', True) else ''
+        return f'{cred.get("host", "")}/{destination}'
 
     def _build(self):
         layout = dict(padx=5, pady=2, sticky='nw')
@@ -104,6 +114,10 @@ class FtpFrame(tk.Frame):
 
         self._also_send_cnv_files = tkw.CheckbuttonWidgetSingle(right_frame, name=_('Skicka även cnv-filer'), row=1, column=0, **layout)
 
+        self._parallel_upload = components.Checkbutton(right_frame, 'ftp_parallel_upload',
+                                                       title=_('Skicka parallellt (flera anslutningar)'),
+                                                       row=0, column=1, **layout)
+
         self._stringvar_title_ftp = tk.StringVar()
         tk.Label(right_frame, textvariable=self._stringvar_title_ftp).grid(row=2, column=0, **layout)
 
@@ -125,25 +139,74 @@ class FtpFrame(tk.Frame):
                                                     command=self._callback_pre_system)
         self._button_back_to_pre_system.grid(row=5, column=1, padx=5, pady=2, sticky='se')
 
+        frame_missing = tk.Frame(right_frame)
+        frame_missing.grid(row=5, column=0, **layout)
+        self._stringvar_missing_on_ftp = tk.StringVar()
+        tk.Label(frame_missing, textvariable=self._stringvar_missing_on_ftp).grid(row=0, column=0, **layout)
+        tk.Button(frame_missing, text=_('Välj filer som saknas på FTP'),
+                  command=self._select_missing_on_ftp).grid(row=0, column=1, **layout)
+
         tkw.grid_configure(right_frame, nr_rows=6, nr_columns=2)
 
     def _on_toggle_ftp_test(self):
         self._update_files_ftp()
         self._stringvar_title_ftp.set(self._get_ftp_title())
 
-    def _update_files_ftp(self, *args):
-        self._files_on_ftp.update_items()
+    def _update_files_ftp(self, *args, refresh=False):
+        """Shows the cached listing of the files on FTP. The listing is refreshed in the background if it
+        is too old, see ftp_listing.py"""
         cred = self.ftp_credentials
         if not cred:
+            self._files_on_ftp.update_items()
+            self._stringvar_missing_on_ftp.set('')
+            return
+        listing = self._ftp_listing.get(cred, refresh=refresh)
+        self._show_ftp_listing(listing)
+        if listing.refreshing:
+            self.after(500, self._poll_ftp_listing, cred)
+
+    def _poll_ftp_listing(self, cred):
+        if cred != self.ftp_credentials:
+            return
+        listing = self._ftp_listing.peek(cred)
+        self._show_ftp_listing(listing)
+        if listing.refreshing:
+            self.after(500, self._poll_ftp_listing, cred)
+
+    def _show_ftp_listing(self, listing):
+        if listing.names is None:
+            self._files_on_ftp.update_items()
+            if listing.refreshing:
+                self._stringvar_missing_on_ftp.set(_('Hämtar filer på FTP...'))
+            elif listing.error:
+                self._stringvar_missing_on_ftp.set(_('Kunde inte hämta filer på FTP'))
             return
-        obj = get_ftp_object(cred)
-        file_list = sorted(obj.server_files[:], key=lambda x: x.lower(), reverse=True)
+        file_list = sorted(listing.names, key=lambda x: x.lower(), reverse=True)
         file_list = [item for item in file_list if '.' in item] + [item for item in file_list if '.' not in item]
         self._files_on_ftp.update_items(file_list)
+        missing = self.get_missing_on_ftp()
+        if missing is None:
+            self._stringvar_missing_on_ftp.set('')
+        else:
+            self._stringvar_missing_on_ftp.set(_('{} filer saknas på FTP').format(len(missing)))
+
+    def get_missing_on_ftp(self):
+        """Returns the local standard format files that are not in the cached listing on FTP"""
+        cred = self.ftp_credentials
+        if not cred:
+            return None
+        return self._ftp_listing.get_missing(cred, self.get_all_items())
+
+    def _select_missing_on_ftp(self):
+        missing = self.get_missing_on_ftp()
+        if not missing:
+            return
+        self._files_local_ftp.move_items_to_selected(missing)
 
-    def update_frame(self):
+    def update_frame(self, snapshot=None):
+        """snapshot is an optional snapshot.FileSnapshot used to list the local directory"""
         self._local_data_path_ftp.set(path=self._file_handler.get_dir('local', 'data'))
-        self._update_items()
+        self._update_items(snapshot=snapshot)
         self._on_toggle_ftp_test()
 
     @property
@@ -171,25 +234,52 @@ class FtpFrame(tk.Frame):
 
         self._update_ftp_status(_('Börjar skicka filer...'))
 
-        try:
-            directory = self._local_data_path_ftp.get()
-            paths = [Path(directory, file) for file in files]
-            paths.extend(self._get_cnv_paths_matching_file_names(files))
-            obj = get_ftp_object(cred, status_callback=self._ftp_progress)
-            obj.add_files_to_send(*paths)
-            obj.send_files()
-            self._files_local_ftp.deselect_all()
+        directory = self._local_data_path_ftp.get()
+        paths = [Path(directory, file) for file in files]
+        paths.extend(self._get_cnv_paths_matching_file_names(files))
+        parallel = bool(self._parallel_upload.value)
+        if not self._job_executor:
+            try:
+                result = send_files(cred, paths, parallel=parallel, status_callback=self._ftp_progress)
+            except Exception as e:
+                self._on_send_error(e, traceback.format_exc())
+            else:
+                self._on_files_sent(cred, paths, result)
+            return
+        self._button_send_files_via_ftp.config(state='disabled')
+        self._job_executor.submit(send_files, cred, paths, parallel=parallel,
+                                  status_callback=lambda status: jobs.report_progress(*status),
+                                  name=_('Skickar filer via ftp'),
+                                  on_progress=lambda *status: self._ftp_progress(status),
+                                  on_result=lambda result: self._on_files_sent(cred, paths, result),
+                                  on_error=self._on_send_error,
+                                  on_finish=self._on_send_finished)
+
+    def _on_files_sent(self, cred, paths, result):
+        self._update_ftp_status('')
+        self._ftp_listing.add_names(cred, [path.name for path in result.sent])
+        if result.failed:
             self._update_files_ftp()
-            breakpoint()
-            messagebox.showinfo(_('Skicka till FTP'),
-                                _('{} filer har skickats till {}').format(len(paths),self._get_ftp_destination()))
-        except ftp.FtpConnectionError:
-            messagebox.showerror(_('Skicka filer till FTP'), _('Kunde inte skicka filer. Kunde inte koppla upp mot ftp. Internet kanske inte fungerar.'))
-        except:
             messagebox.showerror(_('Skicka filer till FTP'),
-                                 _('Något gick fel: {}').format(traceback.format_exc()))
-        finally:
-            self._update_ftp_status('')
+                                 _('Kunde inte skicka {} filer:\n{}').format(
+                                     len(result.failed),
+                                     '\n'.join([f'{path.name}: {e}' for path, e in result.failed])))
+            return
+        self._files_local_ftp.deselect_all()
+        self._update_files_ftp()
+        messagebox.showinfo(_('Skicka till FTP'),
+                            _('{} filer har skickats till {}').format(len(paths), self._get_ftp_destination()))
+
+    def _on_send_error(self, e, tb):
+        self._update_ftp_status('')
+        if isinstance(e, (ftp.FtpConnectionError,) + ftp_pool.CONNECTION_ERRORS):
+            messagebox.showerror(_('Skicka filer till FTP'), _('Kunde inte skicka filer. Kunde inte koppla upp mot ftp. Internet kanske inte fungerar.'))
+        else:
+            messagebox.showerror(_('Skicka filer till FTP'), _('Något gick fel: {}').format(tb))
+
+    def _on_send_finished(self):
+        self._update_ftp_status('')
+        self._button_send_files_via_ftp.config(state='normal')
 
     def _ftp_progress(self, status):
         t = status[0]
@@ -220,10 +310,14 @@ class FtpFrame(tk.Frame):
             matching_paths.append(path)
         return matching_paths
 
-    def _update_items(self):
+    def _update_items(self, snapshot=None):
         if not self._local_data_path_ftp.get():
             return
         directory = Path(self._local_data_path_ftp.get()).resolve()
+        if snapshot:
+            items = sorted(snapshot.list_directory(directory), reverse=True)
+            self._files_local_ftp.update_items(items)
+            return
         if not directory.exists():
             return
         items = sorted([path.name for path in directory.iterdir()], reverse=True)
@@ -243,7 +337,22 @@ class FtpFrame(tk.Frame):
         self._files_local_ftp.move_items_to_selected(items)
 
 
+def send_files(credentials, paths, parallel=False, status_callback=None):
+    """Sends the files to FTP and returns an ftp_upload.UploadResult. Called in the job executor thread by
+    FtpFrame, status_callback is then called in that thread as well."""
+    if parallel:
+        return ftp_upload.ParallelUploader(credentials).upload(paths, status_callback=status_callback)
+    result = ftp_upload.UploadResult()
+    remaining = list(paths)
+    ftp_pool.get_pool().run(credentials, lambda con: ftp_pool.send_files(con, remaining,
+                                                                         status_callback=status_callback))
+    result.sent = list(paths)
+    return result
+
+
 def get_ftp_object(credentials, **kwargs):
+    """Creates a new ftp.Ftp object. The frame itself uses pooled ftplib connections, see ftp_pool.py"""
+    credentials = dict(credentials)
     test = credentials.pop('test', True)
     obj = ftp.Ftp(**credentials, **kwargs)
     if test:
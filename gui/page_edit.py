@@ -15,7 +15,9 @@ from sharkpylib.tklib import tkinter_widgets as tkw
 
 from . import components
 from .. import events
+from .. import package_index
 from ..saves import SaveComponents
+from ..saves import get_saved_value
 from .locales import Translator
 
 _ = Translator('page_edit', 'en').lang.gettext
@@ -34,6 +36,9 @@ class PageEditRaw(tk.Frame):
         self._saves = SaveComponents('edit')
 
         self._all_packs = {}
+        # Where the package index is stored. Same as in the processing pages
+        self._local_root_directory = (get_saved_value('ctd_processing', 'local_data_path_root')
+                                      or get_saved_value('ctd_processing_simple', 'local_data_path_root'))
 
     @property
     def user(self):
@@ -60,6 +65,7 @@ class PageEditRaw(tk.Frame):
         events.subscribe('change_metadata_packs_target', self._on_change_target)
         events.subscribe('change_metadata_packs_sharkweb_path', self._on_change_sharkweb_path)
         events.subscribe('change_metadata_packs_lims_path', self._on_change_lims_path)
+        events.subscribe('change_local_data_path_root', self._on_change_local_root_directory)
 
     def close(self):
         self._saves.save()
@@ -140,9 +146,13 @@ class PageEditRaw(tk.Frame):
         tkw.grid_configure(frame, nr_rows=r+1, nr_columns=c+1)
 
     def _on_change_source(self, path):
-        self._all_packs = file_explorer.get_packages_in_directory(path)
+        self._all_packs = package_index.get_packs(path, as_list=False,
+                                                  local_root_directory=self._local_root_directory or None)
         self._packs_listbox.update_items(sorted(self._all_packs))
 
+    def _on_change_local_root_directory(self, path):
+        self._local_root_directory = str(path)
+
     def _on_change_target(self, path):
         pass
 
@@ -11,10 +11,10 @@ from tkinter import filedialog
 from tkinter import messagebox
 
 import ctd_processing
-import file_explorer
 from file_explorer.seabird.paths import SBEPaths
 from sharkpylib.tklib import tkinter_widgets as tkw
 
+from .. import package_index
 from ..saves import SaveComponents
 
 from .packs_info import PacksInfo
@@ -252,14 +252,15 @@ class PageInspect(tk.Frame):
         directory = self._stringvars_path.get('source_dir').get()
         if not directory:
             return
-        packs = file_explorer.get_packages_in_directory(directory, exclude_directory='temp', as_list=True)
+        packs = package_index.get_packs(directory, exclude_directory='temp',
+                                        local_root_directory=self._stringvars_path.get('local_dir').get() or None)
         self._info_frame_source.set_packs(packs)
 
     def _on_select_local_dir(self):
         directory = self._stringvars_path.get('local_dir').get()
         if not directory:
             return
-        packs = file_explorer.get_packages_in_directory(directory, exclude_directory='temp', as_list=True)
+        packs = package_index.get_packs(directory, exclude_directory='temp', local_root_directory=directory)
         self._info_frame_local.set_packs(packs)
 
     def close(self):
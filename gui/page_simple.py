@@ -1,30 +1,31 @@
 import logging
-import shutil
-import time
 import tkinter as tk
-import traceback
 from pathlib import Path
 from tkinter import messagebox
 import datetime
 
-import ctd_processing
 import file_explorer
 from file_explorer.file_handler.exceptions import RootDirectoryNotSetError
 from file_explorer.file_handler.seabird_ctd import get_seabird_file_handler
 from ctd_processing.processing.sbe_processing import SBEProcessing
 from ctd_processing.processing.sbe_processing_paths import SBEProcessingPaths
 from ctd_processing.visual_qc.vis_qc import VisQC
-from ctdpy.core import session as ctdpy_session
-from ctdpy.core.utils import get_reversed_dictionary
-from profileqc import qc
 # from profileqc.specific import get_specific_qc_settings
-from sharkpylib.plot import create_seabird_like_plots_for_package
 from sharkpylib.qc.qc_default import QCBlueprint
 from sharkpylib.tklib import tkinter_widgets as tkw
 
 from . import components
 from . import frames
+from .. import batch
+from .. import job_queue
+from .. import jobs
+from .. import manifest
+from .. import pipeline
+from .. import server_copy
+from .. import watch_folder
 from ..events import subscribe
+from ..pipeline import get_id_from_key
+from ..pipeline import get_year_from_key
 from ..saves import SaveComponents
 from ..utils import get_files_in_directory
 from ..utils import open_paths_in_default_program
@@ -33,6 +34,19 @@ from .locales import Translator
 _ = Translator('page_simple').lang.gettext
 logger = logging.getLogger(__name__)
 
+JOB_QUEUE_SOURCE = 'page_simple'
+
+# Stages of the batches in the job queue (standard_format and automatic_qc are recorded in watch mode). A batch
+# is resumed from the first stage with unfinished jobs
+RESUME_STAGES = ['process', 'standard_format', 'standard_format_and_automatic_qc', 'automatic_qc', 'plots_and_copy']
+# Resuming is deferred while the job executor is busy
+RESUME_RETRY_MS = 5000
+
+MISMATCH_POLICY_TITLES = {batch.MISMATCH_ASK: _('Fråga'),
+                          batch.MISMATCH_FIX: _('Försök lösa'),
+                          batch.MISMATCH_IGNORE: _('Ignorera'),
+                          batch.MISMATCH_SKIP: _('Hoppa över')}
+
 LISTBOX_TITLES = dict(title_items=dict(text=_('Välj filer genom att dubbelklicka'),
                                        fg='red',
                                        font='Helvetica 12 bold'),
@@ -55,6 +69,7 @@ class PageSimple(tk.Frame):
 
         self._unprocessed_packs = {}
         self._active_keys = []
+        self._active_ids = []
         # self._active_keys_mapping = {}
 
         self._button_bg_color = None
@@ -68,6 +83,17 @@ class PageSimple(tk.Frame):
         self._stringvar_nr_packs_missing_server = tk.StringVar()
         self._stringvar_nr_packs_missing_tot = tk.StringVar()
 
+        self._streaming_run = False
+
+        self._source_watcher = None
+        self._watch_after_id = None
+
+        # (job queue, batch id) of the latest processing, later stages are recorded in the same batch
+        self._job_queue_batch = (None, None)
+        self._resume_checked = False
+        # Ids of the unfinished batches found when the page was opened. Batches created later are not resumed
+        self._batch_ids_to_resume = None
+
         self._file_handlers = {}
         self._sbe_processing_paths = {}
         self._sbe_processing_objs = {}
@@ -92,6 +118,10 @@ class PageSimple(tk.Frame):
                                       self._year,
                                       # self._tau,
                                       self._platform,
+                                      self._nr_workers,
+                                      self._copy_workers,
+                                      self._streaming,
+                                      self._mismatch_policy,
         )
 
         self._save_obj.load(user=self.user.name)
@@ -103,6 +133,7 @@ class PageSimple(tk.Frame):
         subscribe('change_server_data_path_root', self._update_files)
         subscribe('change_simple_old_key', self._update_files)
         subscribe('select_platform', self._callback_select_platform)
+        subscribe('change_simple_watch_source', self._on_toggle_watch_source)
 
     def update_page(self):
         if not self.year:
@@ -111,9 +142,13 @@ class PageSimple(tk.Frame):
         self._update_lists()
         self._save_obj.load(component=self._surfacesoak, user=self.user.name)
         self._notebook.select_frame(_('Processering'))
+        if not self._resume_checked:
+            self._resume_checked = True
+            self._resume_unfinished_batches()
 
     def close(self):
-        self._close_manual_qc()
+        self._stop_watching_source()
+        self._close_manual_qc(background=False)
         self._ftp_frame.close()
         self._save_obj.save(user=self.user.name)
 
@@ -167,7 +202,7 @@ class PageSimple(tk.Frame):
         layout = dict(padx=20,
                       pady=20,
                       sticky='nsew')
-        self._ftp_frame = frames.FtpFrame(frame)
+        self._ftp_frame = frames.FtpFrame(frame, job_executor=self.job_executor)
         self._ftp_frame.grid(row=0, column=0, **layout)
 
         tkw.grid_configure(frame)
@@ -245,6 +280,34 @@ class PageSimple(tk.Frame):
         self._old_key.set(False)
         self._old_key.checkbutton.config(state='disabled')
 
+        r += 1
+        self._nr_workers = components.LabelEntry(frame, 'nr_workers', title=_('Antal processer'), width=3,
+                                                 data_type=int, row=r, column=0, **layout)
+        self._nr_workers.set(batch.get_default_nr_workers())
+
+        r += 1
+        self._copy_workers = components.LabelEntry(frame, 'simple_copy_workers',
+                                                   title=_('Antal samtidiga kopieringar'), width=3,
+                                                   data_type=int, row=r, column=0, **layout)
+        self._copy_workers.set(server_copy.DEFAULT_NR_WORKERS)
+
+        r += 1
+        self._mismatch_policy = components.LabelDropdownList(frame, 'simple_mismatch_policy',
+                                                             title=_('Vid mismatch'), width=12,
+                                                             row=r, column=0, **layout)
+        self._mismatch_policy.values = list(MISMATCH_POLICY_TITLES.values())
+        self._mismatch_policy.set(MISMATCH_POLICY_TITLES[batch.MISMATCH_ASK])
+
+        r += 1
+        self._streaming = components.Checkbutton(frame, 'simple_streaming',
+                                                 title=_('Granska varje station så snart den är klar'),
+                                                 row=r, column=0, **layout)
+
+        r += 1
+        self._watch_source = components.Checkbutton(frame, 'simple_watch_source',
+                                                    title=_('Bevaka källmappen och processera nya stationer'),
+                                                    row=r, column=0, **layout)
+
         tkw.grid_configure(frame, nr_rows=r+1, nr_columns=1)
 
     def _build_frame_files(self):
@@ -308,29 +371,40 @@ class PageSimple(tk.Frame):
         self._button_close_qc = tk.Button(frame, text=_('Stäng manuell granskning\nKopiera till server'), command=self._close_manual_qc, width=20)
         self._button_close_qc.grid(row=r, column=0, **layout)
 
-        tkw.grid_configure(frame, nr_rows=r + 1, nr_columns=1)
+        r += 1
+        self._job_status = components.JobStatus(frame, self.job_executor, cancel_text=_('Avbryt'),
+                                                queued_text=_('{} i kö'), row=r, column=0, **layout)
 
-    def _start_process(self):
-        all_keys = self._files_source.get_selected()
+        tkw.grid_configure(frame, nr_rows=r + 1, nr_columns=1)
 
+    def _check_processing_options(self):
+        """Shows a warning and returns False if something needed for the processing is missing"""
         if not self._config_path.get():
             messagebox.showwarning(_('Kör processering'), _('Ingen rotkatalog för ctd_config vald!'))
-            return
+            return False
 
         if not self._local_data_path_root.get():
             messagebox.showwarning(_('Kör processering'), _('Ingen rotkatalog för lokal data vald!'))
-            return
+            return False
 
         if not self._server_data_path_root.get():
             messagebox.showwarning(_('Kör processering'), _('Ingen rotkatalog för data på servern vald!'))
-            return
+            return False
 
         if not self._platform.value:
             messagebox.showwarning(_('Kör processering'), _('Ingen platform vald!'))
-            return
+            return False
 
         if not self._surfacesoak.value:
             messagebox.showwarning(_('Kör processering'), _('Ingen surfacesoak vald!'))
+            return False
+
+        return True
+
+    def _start_process(self):
+        all_keys = self._files_source.get_selected()
+
+        if not self._check_processing_options():
             return
 
         if not all_keys:
@@ -338,184 +412,376 @@ class PageSimple(tk.Frame):
             return
 
         self._button_run.configure(state='disable')
-
         self._process_files()
-        self._create_standard_format()
-        time.sleep(1)  # This is to assert registration of new files
-        self._update_ftp_frame()
-        self._preform_automatic_qc()
-        self._open_manual_qc()
+
+    @property
+    def job_executor(self):
+        return self.parent_app.job_executor
 
     def _process_files(self):
         self._active_ids = []
 
         active_patterns = self._files_source.get_selected()
         self._active_ids = [get_id_from_key(pattern) for pattern in active_patterns]
-        # all_files = []
-        # for serno in active_sernos:
-        #     all_files.extend(self._source_serno_to_file_paths[serno])
-        # packs = file_explorer.get_packages_from_file_list()
-        # self._active_ids = [get_id_from_key(pat) for pat in active_patterns]
-        # active_paths = [pack.path('hex') for _id, pack in self._id_to_source_pack.items() if _id in self._active_ids]
 
+        processor = self._get_processor(_('Processerar'))
+        self._job_queue_batch = (processor.job_queue, processor.batch_id)
+
+        paths = sorted([self._source_serno_to_hex_path[serno] for serno in self._active_ids])
+        options = {}
+        if paths and self._delete_old_asvp_files.get():
+            # Old asvp files are deleted when processing the last file so that the files in this batch are not
+            # removed by a parallel worker
+            options[paths[-1]] = dict(delete_old_asvp_files=True)
+            batches = [paths[:-1], paths[-1:]]
+        else:
+            batches = [paths]
+        self._streaming_run = self._streaming.get()
+        self._process_next_batch(processor, batches, options)
+
+    def _get_processor(self, name):
+        """Returns a BatchProcessor that records its jobs in a new batch (named name) in the job queue"""
         create_asvp_file = False
         asvp_output_dir = self._asvp_files_directory.get()
         if asvp_output_dir:
             create_asvp_file = True
 
-        for serno in self._active_ids:
-            path = self._source_serno_to_hex_path[serno]
-            ignore_mismatch = False
-            try_fixing_mismatch = False
-            continue_trying = True
-            while continue_trying:
-                try:
-                    logger.info(f'{self._local_data_path_root.value=}')
-                    pack = ctd_processing.process_sbe_file(path,
-                                                           target_root_directory=self._local_data_path_root.value,
-                                                           config_root_directory=self._config_path.value,
-                                                           file_handler=self.file_handler,
-                                                           platform=self._platform.value,
-                                                           surfacesoak=self._surfacesoak.value,
-                                                           # tau=self._tau.value,
-                                                           psa_paths=None,
-                                                           ignore_mismatch=ignore_mismatch,
-                                                           try_fixing_mismatch=try_fixing_mismatch,
-                                                           old_key=self._old_key.value,
-                                                           create_asvp_file=create_asvp_file,
-                                                           asvp_output_dir=asvp_output_dir,
-                                                           delete_old_asvp_files=self._delete_old_asvp_files.get()
-                                                           )
-                    continue_trying = False
-                except FileExistsError:
-                    messagebox.showerror('File exists',
-                                         _('Filen finns redan. Använd avancerad processering om du vill processera igen\n{}').format(path))
-                    return
-                except file_explorer.seabird.MismatchWarning as e:
-                    ans = messagebox.askyesnocancel(_('Mismatch mellan filer'),
-                                                    _("""{}\n\nVälj "Ja" för att försöka lösa problemet. \nVälj "Nej" för att lösa problemet i seabird programvara. \nVälj "Avbryt" för att avbryta.""").format(e.data))
-                    if ans is True:
-                        try_fixing_mismatch = True
-                    elif ans is False:
-                        ignore_mismatch = True
-                    else:
-                        return
-                except Exception as e:
-                    messagebox.showerror(_('Något gick fel'), traceback.format_exc())
-                    raise
-                finally:
-                    self._button_run.configure(state='normal')
-
-    def _create_standard_format(self):
+        logger.info(f'{self._local_data_path_root.value=}')
+        settings = dict(year=self.year,
+                        root_dirs=self._get_processing_root_dirs(),
+                        nr_workers=self._get_nr_workers(),
+                        platform=self._platform.value,
+                        surfacesoak=self._surfacesoak.value,
+                        # tau=self._tau.value,
+                        psa_paths=None,
+                        old_key=self._old_key.value,
+                        create_asvp_file=create_asvp_file,
+                        asvp_output_dir=asvp_output_dir,
+                        delete_old_asvp_files=False,
+                        mismatch_policy=self._get_mismatch_policy())
+        queue, batch_id = self._create_batch(name, settings=settings)
+        return batch.BatchProcessor(job_queue=queue, batch_id=batch_id, manifest=self._get_manifest(), **settings)
+
+    def _get_manifest(self):
+        """Returns the manifest where the dependencies of the casts are recorded (see manifest.py). Casts are
+        never skipped from this page."""
+        if not self._local_data_path_root.value:
+            return None
+        return manifest.Manifest(self._local_data_path_root.value, self._config_path.value, skip_unchanged=False)
+
+    def _get_mismatch_policy(self):
+        for policy, title in MISMATCH_POLICY_TITLES.items():
+            if self._mismatch_policy.get() == title:
+                return policy
+        return batch.MISMATCH_ASK
+
+    def _get_job_queue(self):
+        """Returns the job queue in the local root directory or None if no local root is set"""
+        if not self._local_data_path_root.value:
+            return None
         try:
-            # all_packs = file_explorer.get_packages_in_directory(self.file_handler.get_dir('local', 'cnv'),
-            #                                                     with_id_as_key=False, old_key=self._old_key.value)
-            # all_packs = {get_id_from_key(key): pack for key, pack in all_packs.items()}
-            # packs = []
-            # logger.info(f'{all_packs.keys()=}')
-
-            packs = self._get_active_cnv_packs()
-
-            # for _id in self._active_ids:
-            #     logger.info(f'{_id=}')
-            #     pack = all_packs.get(_id)
-            #     if not pack:
-            #         continue
-            #     packs.append(pack)
-            if not packs:
-                messagebox.showerror(_('Skapar standardformat'), _('Inga CNV filer valda för att skapa standardformat!'))
+            return job_queue.get_job_queue(self._local_data_path_root.value)
+        except Exception as e:
+            logger.warning(f'Could not open job queue: {e}')
+            return None
+
+    def _create_batch(self, name, settings=None):
+        queue = self._get_job_queue()
+        if not queue:
+            return None, None
+        return queue, queue.create_batch(name, source=JOB_QUEUE_SOURCE, settings=settings)
+
+    def _submit_stage(self, stage, func, *args, **kwargs):
+        """Submits func to the job executor and records the stage for the active casts in the batch of the
+        latest processing"""
+        queue, batch_id = self._job_queue_batch
+        self.job_executor.submit(job_queue.run_stage, queue, batch_id, stage, list(self._active_ids), func,
+                                 *args, **kwargs)
+
+    def _resume_unfinished_batches(self):
+        """Asks if processing that was stopped (application closed or crashed) should be resumed. A batch is
+        resumed from its first unfinished stage. Asking is deferred while other jobs are running."""
+        queue = self._get_job_queue()
+        if not queue:
+            return
+        unfinished_batches = queue.get_unfinished_batches(source=JOB_QUEUE_SOURCE)
+        if self._batch_ids_to_resume is None:
+            self._batch_ids_to_resume = set([batch_info['id'] for batch_info in unfinished_batches])
+        for batch_info in unfinished_batches:
+            if batch_info['id'] not in self._batch_ids_to_resume:
+                continue
+            if self.job_executor.busy:
+                self.after(RESUME_RETRY_MS, self._resume_unfinished_batches)
                 return
-            new_packs = ctd_processing.create_standard_format_for_packages(packs,
-                                                                           file_handler=self.file_handler,
-                                                                           # config_root_directory=self._config_path.value,
-                                                                           sharkweb_btl_row_file=None,
-                                                                           old_key=self._old_key.value)
-        except PermissionError as e:
-            messagebox.showerror(_('Skapa standardformat'),
-                                 _('Det verkar som att en file är öppen. Stäng den och försök igen: {}').format(e))
-        except Exception:
-            messagebox.showerror(_('Skapa standardformat'), _('Internt fel: \n{}').format(traceback.format_exc()))
-            raise
-
-    # def _get_active_nsf_packs(self):
-    #     packs = []
-    #     for serno in self._active_ids:
-    #         stem = self._source_serno_to_hex_path[serno].stem
-    #         self.file_handler.select_stem(stem)
-    #         pack = file_explorer.get_packages_from_file_list([p.path for p in self.file_handler.local_files.values()])
-    #         packs.append(pack)
-    #     return packs
+            self._batch_ids_to_resume.discard(batch_info['id'])
+            stage, unfinished = queue.get_first_unfinished_stage(batch_info['id'], RESUME_STAGES)
+            if stage == 'process':
+                items = sorted([Path(job['path']) for job in unfinished if Path(job['path']).exists()])
+            else:
+                items = [job['cast_id'] for job in unfinished]
+            if not items:
+                queue.cancel_batch(batch_info['id'])
+                continue
+            ans = messagebox.askyesno(_('Återuppta processering'),
+                                      _('Processeringen som startades {} avbröts innan den var klar. '
+                                        '{} stationer återstår.\n\nVill du fortsätta processeringen?').format(
+                                          batch_info['created'], len(items)))
+            if not ans:
+                queue.cancel_batch(batch_info['id'])
+                continue
+            self._resume_stage(queue, batch_info, stage, items)
+            # The next batch is asked for when this one is done
+            self.after(RESUME_RETRY_MS, self._resume_unfinished_batches)
+            return
 
-    def _get_active_cnv_packs(self):
-        all_packs = file_explorer.get_packages_in_directory(self.file_handler.get_dir('local', 'cnv'),
-                                                            with_id_as_key=False, old_key=self._old_key.value)
-        all_packs = {get_id_from_key(key): pack for key, pack in all_packs.items()}
-        return [pack for key, pack in all_packs.items() if key in self._active_ids]
+    def _resume_stage(self, queue, batch_info, stage, items):
+        self._job_queue_batch = (queue, batch_info['id'])
+        self._streaming_run = False
+        self._button_run.configure(state='disable')
+        if stage == 'process':
+            processor = batch.BatchProcessor(job_queue=queue, batch_id=batch_info['id'], manifest=self._get_manifest(),
+                                             **batch_info['settings'])
+            self._active_ids = [get_id_from_key(path.name) for path in items]
+            self._process_next_batch(processor, [items], {})
+        elif stage == 'plots_and_copy':
+            self._active_ids = list(items)
+            self._submit_plots_and_copy()
+        else:
+            self._active_ids = list(items)
+            self._after_processing()
+
+    def _on_toggle_watch_source(self, *args):
+        if not self._watch_source.get():
+            self._stop_watching_source()
+            return
+        if not self.year or not self._local_data_path_source.value or not self._check_processing_options():
+            self._watch_source.set(False)
+            return
+        self._source_watcher = watch_folder.SourceWatcher(self._local_data_path_source.value, year=self.year)
+        logger.info(f'Watching {self._local_data_path_source.value} for new casts')
+        self._poll_source_directory()
+
+    def _stop_watching_source(self):
+        self._source_watcher = None
+        if self._watch_after_id:
+            self.after_cancel(self._watch_after_id)
+            self._watch_after_id = None
+
+    def _poll_source_directory(self):
+        """Processes new casts in the source directory as soon as they are complete, see watch_folder.py"""
+        self._watch_after_id = None
+        if not self._source_watcher:
+            return
+        if not self.job_executor.busy:
+            hex_paths = self._source_watcher.poll()
+            if hex_paths:
+                logger.info(f'New casts in source directory: {[path.name for path in hex_paths]}')
+                processor = self._get_processor(_('Processerar nya stationer'))
+                self.job_executor.submit(batch.run_with_file_handler, watch_folder.process_casts, self.year,
+                                         self._get_file_handler_root_dirs(), processor, hex_paths,
+                                         old_key=self._old_key.value,
+                                         name=_('Processerar nya stationer'),
+                                         on_result=self._on_watched_casts_processed,
+                                         on_error=lambda e, tb: self._on_watched_casts_error(hex_paths, tb))
+        self._watch_after_id = self.after(watch_folder.POLL_INTERVAL * 1000, self._poll_source_directory)
+
+    def _on_watched_casts_error(self, hex_paths, tb):
+        logger.error(tb)
+        self._forget_watched_casts(hex_paths)
+
+    def _forget_watched_casts(self, hex_paths):
+        """Failed casts are processed again the next time the source directory is polled"""
+        if not self._source_watcher:
+            return
+        for path in hex_paths:
+            self._source_watcher.forget(path)
+
+    def _on_watched_casts_processed(self, result):
+        results, qc_files = result
+        for item in results:
+            if not item.ok:
+                logger.error(f'Watch mode: {item.path.name}: {item.status} {item.message}')
+        self._forget_watched_casts([item.path for item in results if item.status == batch.STATUS_ERROR])
+        new_ids = [get_id_from_key(item.path.name) for item in results if item.ok]
+        if not new_ids:
+            return
+        self._active_ids = self._active_ids + [_id for _id in new_ids if _id not in self._active_ids]
+        self.file_handler.store_files('local')
+        self._update_ftp_frame()
+        if not self.bokeh_server:
+            self._open_manual_qc()
+        else:
+            self._refresh_manual_qc()
+
+    def _process_next_batch(self, processor, batches, options):
+        batches = [paths for paths in batches if paths]
+        if not batches:
+            self._show_processing_report(processor)
+            self._after_processing()
+            return
+        if self._streaming_run:
+            self._stream_next_batch(processor, batches, options)
+            return
+        self.job_executor.submit(processor.run_all, batches[0], options=options,
+                                 name=_('Processerar'),
+                                 on_result=lambda results: self._on_processing_results(processor, results,
+                                                                                       batches[1:], options),
+                                 on_error=lambda e, tb: self._on_job_error(_('Något gick fel'), tb),
+                                 on_cancel=self._on_job_cancelled)
+
+    def _stream_next_batch(self, processor, batches, options):
+        self.job_executor.submit(stream_casts, processor, batches[0], old_key=self._old_key.value, options=options,
+                                 name=_('Processerar'),
+                                 on_progress=self._on_cast_ready,
+                                 on_result=lambda result: self._on_streamed_batch(processor, result,
+                                                                                  batches[1:], options),
+                                 on_error=lambda e, tb: self._on_job_error(_('Något gick fel'), tb),
+                                 on_cancel=self._on_streaming_finished)
+
+    def _on_cast_ready(self, nr_ready, nr_total, name=None):
+        """Manual qc is opened as soon as the first cast in a streaming run is ready"""
+        if not nr_ready:
+            return
+        self.file_handler.store_files('local')
+        if not self.bokeh_server:
+            self._update_ftp_frame()
+            self._open_manual_qc()
+        # Plots and copy to server are made when all casts are ready
+        self._button_close_qc.config(state='disabled')
+
+    def _on_streamed_batch(self, processor, result, batches, options):
+        results, casts = result
+        for cast in casts:
+            if cast.ok:
+                continue
+            logger.critical(cast.message)
+            messagebox.showerror(_('Något gick fel'), cast.message)
+        self._on_processing_results(processor, results, batches, options)
 
-    def _get_active_nsf_packs(self):
-        all_packs = file_explorer.get_packages_in_directory(self.file_handler.get_dir('local', 'data'),
-                                                            with_id_as_key=False, old_key=self._old_key.value)
-        all_packs = {get_id_from_key(key): pack for key, pack in all_packs.items()}
-        return [pack for key, pack in all_packs.items() if key in self._active_ids]
-
-    def _preform_automatic_qc(self):
-        packs = self._get_active_nsf_packs()
-        files = [pack['txt'] for pack in packs]
-        logger.info(f'{files=}')
-        if not files:
+    def _on_streaming_finished(self):
+        self.file_handler.store_files('local')
+        self._update_ftp_frame()
+        if not self.bokeh_server:
+            self._open_manual_qc()
+        else:
+            self._refresh_manual_qc()
+        self._button_close_qc.config(state='normal')
+
+    def _on_processing_results(self, processor, results, batches, options):
+        """Mismatches are only asked for here with the mismatch policy "ask". Other problems are collected in
+        the report of the processor and shown when all batches are finished."""
+        mismatches = []
+        if processor.mismatch_policy == batch.MISMATCH_ASK:
+            mismatches = [result for result in results if result.status == batch.STATUS_MISMATCH]
+        paths = []
+        for result in mismatches:
+            ans = messagebox.askyesnocancel(_('Mismatch mellan filer'),
+                                            _("""{}\n\nVälj "Ja" för att försöka lösa problemet. \nVälj "Nej" för att lösa problemet i seabird programvara. \nVälj "Avbryt" för att avbryta.""").format(result.mismatch_data))
+            if ans is None:
+                self._process_next_batch(processor, [], options)
+                return
+            options.setdefault(result.path, {})
+            if ans is True:
+                options[result.path]['try_fixing_mismatch'] = True
+            else:
+                options[result.path]['ignore_mismatch'] = True
+            paths.append(result.path)
+        self._process_next_batch(processor, [paths] + batches, options)
+
+    def _show_processing_report(self, processor):
+        report = processor.report
+        logger.info(f'Processing report: {report.get_text()}')
+        for result in report.get_results(batch.STATUS_ERROR):
+            logger.error(f'{result.path.name}: {result.message}')
+        if not report.problems:
+            return
+        msg = _('{} stationer processerade och {} hade problem:').format(len(report.processed),
+                                                                         len(report.problems))
+        msg = msg + '\n\n' + '\n'.join(report.get_problem_lines())
+        if report.get_results(batch.STATUS_FILE_EXISTS):
+            msg = msg + '\n\n' + _('Använd avancerad processering om du vill processera filer som redan finns.')
+        messagebox.showwarning(_('Kör processering'), msg)
+
+    def _after_processing(self):
+        """Creates standard format and runs automatic qc for the processed files"""
+        if self._streaming_run:
+            # Already done cast by cast
+            self._on_streaming_finished()
+            return
+        tkw.disable_buttons_in_class(self)
+        self._submit_stage('standard_format_and_automatic_qc',
+                           batch.run_with_file_handler,
+                           create_standard_format_and_run_automatic_qc,
+                           self.year,
+                           self._get_file_handler_root_dirs(),
+                           active_ids=list(self._active_ids),
+                           year=self.year,
+                           root_dirs=self._get_processing_root_dirs(),
+                           nr_workers=self._get_nr_workers(),
+                           old_key=self._old_key.value,
+                           manifest=self._get_manifest(),
+                           name=_('Skapar standardformat och granskar'),
+                           on_result=self._on_automatic_qc_done,
+                           on_error=self._on_after_processing_error,
+                           on_cancel=self._on_job_cancelled)
+
+    def _on_automatic_qc_done(self, result):
+        nr_cnv_packs, qc_files = result
+        if not nr_cnv_packs:
+            messagebox.showerror(_('Skapar standardformat'), _('Inga CNV filer valda för att skapa standardformat!'))
+        self._update_ftp_frame()
+        if not qc_files:
             messagebox.showwarning(_('Automatisk granskning'), _('Inga filer att granska!'))
+        self._open_manual_qc()
+
+    def _on_after_processing_error(self, exception, tb):
+        if isinstance(exception, PermissionError):
+            self._on_job_error(_('Skapa standardformat'),
+                               _('Det verkar som att en file är öppen. Stäng den och försök igen: {}').format(exception))
             return
+        self._on_job_error(_('Något gick fel'), tb)
 
-        tkw.disable_buttons_in_class(self)
-        try:
-            session = ctdpy_session.Session(filepaths=files,
-                                            reader='ctd_stdfmt')
-
-            datasets = session.read()
-
-            # qc_session = qc.SessionQC(None, advanced_settings_name='smhi_expedition')
-            qc_session = qc.SessionQC(None)
-
-            for dset_name, item in datasets[0].items():
-                parameter_mapping = get_reversed_dictionary(session.settings.pmap, item['data'].keys())
-                qc_session.update_data(item,
-                                       parameter_mapping=parameter_mapping,
-                                       dataset_name=dset_name)
-                # qc_session.update_routines()
-                qc_session.run()
-
-            qc_session.write_log(Path(self.file_handler.get_dir('local', 'temp'), 'automatic_qc_log.yaml'),
-                                 reset_log=True)
-
-            # datasets = session.read()
-            #
-            # for data_key, item in datasets[0].items():
-            #     parameter_mapping = get_reversed_dictionary(session.settings.pmap, item['data'].keys())
-            #     routine_settings = get_specific_qc_settings(
-            #         user='svea',
-            #         lat=item['data']['LATITUDE_DD'][0],
-            #         lon=item['data']['LONGITUDE_DD'][0],
-            #         month=item['data']['MONTH'][0])
-            #     qc_session = qc.SessionQC(data_item=item,
-            #                               parameter_mapping=parameter_mapping,
-            #                               routine_settings=routine_settings)
-            #     qc_session.run()
-
-            data_path = session.save_data(datasets,
-                                          writer='ctd_standard_template', return_data_path=True,
-                                          save_path=self.file_handler.get_dir('local', 'temp'),
-                                          )
-
-            # Den här metoden använder therading vilket innebär att vi måste vänta på att filerna skapats innan vi kan kopiera dem.
-            data_path = Path(data_path)
-            time.sleep(.5)
-            for source_path in Path(data_path).iterdir():
-                target_path = Path(self.file_handler.get_dir('local', 'data'), source_path.name)
-                shutil.copyfile(source_path, target_path)
-            return data_path
-        except Exception:
-            messagebox.showwarning(_('Automatisk granskning'), traceback.format_exc())
-            raise
+    def _on_job_error(self, title, msg):
+        messagebox.showerror(title, msg)
+        self._on_job_cancelled()
+
+    def _on_job_cancelled(self):
+        tkw.enable_buttons_in_class(self)
+        self._button_run.configure(state='normal')
+
+    def _get_nr_workers(self):
+        value = self._nr_workers.get()
+        if not value:
+            return None
+        return int(value)
+
+    def _get_copy_workers(self):
+        value = self._copy_workers.get()
+        if not value:
+            return None
+        return int(value)
+
+    def _get_file_handler_root_dirs(self):
+        """Root directories of file_handler. Jobs get their own file handler with these root directories
+        (see batch.run_with_file_handler)."""
+        return dict(source=self._local_data_path_source.value,
+                    config=self._config_path.value,
+                    local=self._local_data_path_root.value,
+                    server=self._server_data_path_root.value)
+
+    def _get_processing_root_dirs(self):
+        return dict(local=self._local_data_path_root.value,
+                    config=self._config_path.value)
+
+    def _get_active_cnv_packs(self):
+        return pipeline.get_packs_for_ids(self.file_handler.get_dir('local', 'cnv'), self._active_ids,
+                                          old_key=self._old_key.value,
+                                          local_root_directory=self._local_data_path_root.value)
+
+    def _get_active_nsf_packs(self):
+        return pipeline.get_packs_for_ids(self.file_handler.get_dir('local', 'data'), self._active_ids,
+                                          old_key=self._old_key.value,
+                                          local_root_directory=self._local_data_path_root.value)
 
     def _open_manual_qc(self):
         tkw.enable_buttons_in_class(self)
@@ -531,6 +797,15 @@ class PageSimple(tk.Frame):
         self.bokeh_server.start()
         # self._button_close_qc.config(state='normal')
 
+    def _refresh_manual_qc(self):
+        """Restarts manual qc if casts have been added since it was opened"""
+        file_names = self._get_file_names_for_selected_files_cruise()
+        if sorted(get_id_from_key(name) for name in file_names) == sorted(self._manual_qc_active_ids):
+            return
+        self.bokeh_server.stop()
+        self.bokeh_server = None
+        self._open_manual_qc()
+
     def _get_file_names_for_selected_files_cruise(self):
         active_packs = self._get_active_nsf_packs()
         # all_packs = file_explorer.get_packages_in_directory(self.file_handler.get_dir('local', 'data'), as_list=True)
@@ -544,56 +819,41 @@ class PageSimple(tk.Frame):
                 file_names.append(key[1])
         return file_names
 
-    def _close_manual_qc(self):
+    def _close_manual_qc(self, background=True):
         if not self.bokeh_server:
             return
         self.bokeh_server.stop()
         self.bokeh_server = None
-        image_paths = self._create_plots()
+        if not background:
+            args, kwargs = self._get_plots_and_copy_arguments()
+            create_plots_and_copy_to_server(*args, file_handler=self.file_handler, **kwargs)
+            return
+        self._submit_plots_and_copy()
+
+    def _get_plots_and_copy_arguments(self):
+        args = (self._get_active_nsf_packs(), self.file_handler.get_dir('local', 'plots'))
+        kwargs = dict(nr_workers=self._get_nr_workers(), manifest=self._get_manifest(),
+                      copy_workers=self._get_copy_workers())
+        return args, kwargs
+
+    def _submit_plots_and_copy(self):
+        args, kwargs = self._get_plots_and_copy_arguments()
+        self._button_close_qc.config(state='disabled')
+        self._submit_stage('plots_and_copy', batch.run_with_file_handler, create_plots_and_copy_to_server,
+                           self.year, self._get_file_handler_root_dirs(), *args, **kwargs,
+                           name=_('Skapar plottar och kopierar till servern'),
+                           on_result=self._on_manual_qc_closed,
+                           on_error=lambda e, tb: self._on_job_error(_('Något gick fel'), tb),
+                           on_finish=lambda: self._button_close_qc.config(state='normal'))
+
+    def _on_manual_qc_closed(self, image_paths):
         open_paths_in_default_program(image_paths)
         self._button_run.config(state='normal')
         self._button_open_qc.config(state='normal')
         self._button_close_qc.config(bg=self._button_bg_color)
-        self._copy_files_to_server()
         self._update_files()
         self._notebook.select_frame(_('Skicka via FTP'))
 
-    def _create_plots(self):
-        packs = self._get_active_nsf_packs()
-        image_paths = []
-        for pack in packs:
-            img_paths = create_seabird_like_plots_for_package(pack, self.file_handler.get_dir('local', 'plots'))
-            image_paths.extend(img_paths)
-        return image_paths
-
-    def _copy_files_to_server(self):
-
-        handler = self.file_handler
-        for pack in self._get_active_nsf_packs():
-            if 'test' in pack.pattern.lower():
-                logger.warning(f'TEST package not copied to server: {pack} ')
-                continue
-            handler.select_pack(pack)
-            handler.copy_files_to_server(update=True)
-
-        # local_packs = file_explorer.get_packages_in_directory(self.file_handler.get_dir('local', 'data'),
-        #                                                       with_id_as_key=False,
-        #                                                       old_key=self._old_key.value, exclude_directory='temp')
-        # local_packs = {get_id_from_key(key): pack for key, pack in local_packs.items()}
-        #
-        # logger.info(f'{self._active_ids=}')
-        # for _id in self._active_ids:
-        #     pack = local_packs.get(_id)
-        #     if not pack:
-        #         messagebox.showerror(_('Något gick fel'), _('Kunde inte kopiera till server. Hittar inga filer att kopiera...'))
-        #         return
-        #     if 'test' in pack.pattern.lower():
-        #         logger.warning(f'TEST package not copied to server: {pack} ')
-        #         continue
-        #     handler = file_handler.SBEFileHandler(self.sbe_paths)
-        #     handler.select_pack(pack)
-        #     handler.copy_files_to_server()
-
     def _get_pack_for_file_stem(self, stem):
         serno = self._source_stem_to_serno[stem]
         file_paths = self._source_serno_to_file_paths[serno]
@@ -801,13 +1061,52 @@ class PageSimple(tk.Frame):
             pass
 
 
-def get_id_from_key(key):
-    return key.split('.')[0].split('_', 6)[-1].upper()
-
-
-def get_year_from_key(key):
-    try:
-        return key.split('_')[2][:4]
-    except:
-        return "2023"
-
+def create_standard_format_and_run_automatic_qc(file_handler, active_ids, year=None, root_dirs=None, nr_workers=None,
+                                                old_key=False, manifest=None):
+    """Runs in the job executor after processing. Returns the number of cnv packages and the qc-checked files"""
+    local_root_directory = (root_dirs or {}).get('local')
+    cnv_packs = pipeline.get_packs_for_ids(file_handler.get_dir('local', 'cnv'), active_ids, old_key=old_key,
+                                           local_root_directory=local_root_directory)
+    if cnv_packs:
+        pipeline.create_standard_format(cnv_packs,
+                                        file_handler,
+                                        year=year,
+                                        root_dirs=root_dirs,
+                                        nr_workers=nr_workers,
+                                        old_key=old_key,
+                                        manifest=manifest)
+    jobs.raise_if_cancelled()
+    nsf_packs = pipeline.get_packs_for_ids(file_handler.get_dir('local', 'data'), active_ids, old_key=old_key,
+                                           local_root_directory=local_root_directory)
+    files = [pack['txt'] for pack in nsf_packs]
+    logger.info(f'{files=}')
+    if files:
+        pipeline.run_automatic_qc(files, file_handler, nr_workers=nr_workers, manifest=manifest,
+                                  local_root_directory=local_root_directory)
+    return len(cnv_packs), files
+
+
+def create_plots_and_copy_to_server(packs, plots_directory, file_handler=None, nr_workers=None, manifest=None,
+                                    copy_workers=None):
+    image_paths = pipeline.create_plots([pack['txt'] for pack in packs], plots_directory, nr_workers=nr_workers,
+                                        manifest=manifest)
+    pipeline.copy_packs_to_server(packs, file_handler, nr_workers=copy_workers)
+    return image_paths
+
+
+def stream_casts(processor, paths, old_key=False, options=None):
+    """Runs the streaming pipeline in the job executor. Reports progress every time a cast is ready
+    for manual qc. Returns the processing results and the cast results."""
+    results = []
+    casts = []
+    nr_ready = 0
+    jobs.report_progress(0, len(paths))
+    for stage, result in pipeline.stream(processor, paths, old_key=old_key, options=options):
+        if stage == 'process':
+            results.append(result)
+            continue
+        casts.append(result)
+        if result.ok:
+            nr_ready += 1
+            jobs.report_progress(nr_ready, len(paths), result.path.name)
+    return results, casts
@@ -3,33 +3,37 @@
 #
 # Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
 # License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+import contextlib
 import logging
-import shutil
-import time
 import tkinter as tk
-import traceback
 from pathlib import Path
 from tkinter import messagebox
 import datetime
 
 import ctd_processing
 import file_explorer
-from ctd_processing import exceptions
 from ctd_processing.processing.sbe_processing import SBEProcessing
 from ctd_processing.processing.sbe_processing_paths import SBEProcessingPaths
-from ctd_processing.standard_format import StandardFormatComments
 from ctd_processing.visual_qc.vis_qc import VisQC
-from ctdpy.core import session as ctdpy_session
-from ctdpy.core.utils import get_reversed_dictionary
 from file_explorer.file_handler.exceptions import RootDirectoryNotSetError
 from file_explorer.file_handler.seabird_ctd import get_seabird_file_handler
-from profileqc import qc
 from sharkpylib import plot
 from sharkpylib.tklib import tkinter_widgets as tkw
 
 from gui.utils import get_root_app
 from . import components
 from . import frames
+from .. import batch
+from .. import compare
+from .. import file_catalogue
+from .. import job_queue
+from .. import jobs
+from .. import manifest
+from .. import pipeline
+from .. import qc_index
+from .. import server_copy
+from .. import snapshot
+from ..events import post_event
 from ..events import subscribe
 from ..saves import SaveComponents
 
@@ -38,6 +42,17 @@ _ = Translator('page_start', 'en').lang.gettext
 
 logger = logging.getLogger(__name__)
 
+JOB_QUEUE_SOURCE = 'page_start'
+
+# Stages of the batches in the job queue. A batch is resumed from the first stage with unfinished jobs
+RESUME_STAGES = ['process', 'standard_format', 'automatic_qc', 'plots', 'copy']
+# Resuming is deferred while the job executor is busy
+RESUME_RETRY_MS = 5000
+
+MISMATCH_POLICY_TITLES = {batch.MISMATCH_ASK: _('Fråga'),
+                          batch.MISMATCH_FIX: _('Försök lösa'),
+                          batch.MISMATCH_IGNORE: _('Ignorera'),
+                          batch.MISMATCH_SKIP: _('Hoppa över')}
 
 LISTBOX_TITLES = dict(title_items=dict(text=_('Välj filer genom att dubbelklicka'),
                                        fg='red',
@@ -75,6 +90,17 @@ class PageStart(tk.Frame):
         self._processed_files = []
         self._converted_files = []
 
+        # Set during a refresh of the file lists, see _refresh
+        self._snapshot = None
+
+        # Unfinished batches in the job queue are offered to be resumed once, see _resume_unfinished_batches
+        self._resume_checked = False
+        # Ids of the unfinished batches found when the page was opened. Batches created later are not resumed
+        self._batch_ids_to_resume = None
+
+        # Changes in the watched directories are applied to the file lists, see _on_file_catalogue_delta
+        self._file_catalogue = file_catalogue.FileCatalogue()
+
         self._button_bg_color = None
 
     @property
@@ -168,6 +194,77 @@ class PageStart(tk.Frame):
         except RootDirectoryNotSetError:
             pass
 
+    @property
+    def job_executor(self):
+        return self.parent_app.job_executor
+
+    def _show_job_error(self, title, tb):
+        messagebox.showerror(title, tb)
+
+    def _get_processing_root_dirs(self):
+        return dict(local=self._local_data_path_root.value,
+                    config=self._config_path.value)
+
+    def _get_file_handler_root_dirs(self):
+        """Root directories of file_handler. Jobs get their own file handler with these root directories
+        (see batch.run_with_file_handler)."""
+        return dict(source=self._local_data_path_source.value,
+                    config=self._config_path.value,
+                    local=self._local_data_path_root.value,
+                    server=self._server_data_path_root.value)
+
+    def _get_manifest(self):
+        """Returns the manifest where the dependencies of the casts are recorded. Unchanged casts are only
+        skipped if "incremental" is selected."""
+        if not self._local_data_path_root.value:
+            return None
+        return manifest.Manifest(self._local_data_path_root.value, self._config_path.value,
+                                 skip_unchanged=bool(self._incremental.get()))
+
+    def _get_nr_workers(self):
+        value = self._nr_workers.get()
+        if not value:
+            return None
+        return int(value)
+
+    def _get_copy_workers(self):
+        value = self._copy_workers.get()
+        if not value:
+            return None
+        return int(value)
+
+    def _get_mismatch_policy(self):
+        for policy, title in MISMATCH_POLICY_TITLES.items():
+            if self._mismatch_policy.get() == title:
+                return policy
+        return batch.MISMATCH_ASK
+
+    def _get_job_queue(self):
+        """Returns the job queue in the local root directory or None if no local root is set"""
+        if not self._local_data_path_root.value:
+            return None
+        try:
+            return job_queue.get_job_queue(self._local_data_path_root.value)
+        except Exception as e:
+            logger.warning(f'Could not open job queue: {e}')
+            return None
+
+    def _create_batch(self, name, settings=None):
+        """Returns the job queue and the id of a new batch in it. (None, None) if there is no job queue"""
+        queue = self._get_job_queue()
+        if not queue:
+            return None, None
+        return queue, queue.create_batch(name, source=JOB_QUEUE_SOURCE, settings=settings)
+
+    def _submit_stage(self, stage, cast_ids, func, *args, resume_batch_id=None, **kwargs):
+        """Submits func to the job executor as a batch with one job per cast for the stage in the job queue.
+        The stage is recorded in the batch resume_batch_id if given."""
+        if resume_batch_id:
+            queue, batch_id = self._get_job_queue(), resume_batch_id
+        else:
+            queue, batch_id = self._create_batch(kwargs.get('name', stage))
+        self.job_executor.submit(job_queue.run_stage, queue, batch_id, stage, cast_ids, func, *args, **kwargs)
+
     @property
     def sbe_processing_paths(self):
         return self._sbe_processing_paths.setdefault(self.year, SBEProcessingPaths(self.file_handler))
@@ -198,7 +295,11 @@ class PageStart(tk.Frame):
                                       self._platform,
                                       self._overwrite,
                                       self._year,
-                                      self._create_plots_option
+                                      self._create_plots_option,
+                                      self._nr_workers,
+                                      self._copy_workers,
+                                      self._incremental,
+                                      self._mismatch_policy,
                                       )
 
         self._save_obj.load(user=self.user.name)
@@ -212,6 +313,10 @@ class PageStart(tk.Frame):
         subscribe('change_tau', self._callback_change_tau)
 
         subscribe('select_platform', self._callback_select_platform)
+        subscribe('file_catalogue_delta', self._on_file_catalogue_delta)
+
+        self._file_catalogue.start()
+        self._poll_file_catalogue()
 
     def update_page(self):
         logger.debug('start: update_page')
@@ -230,10 +335,14 @@ class PageStart(tk.Frame):
         # self._make_server_root_updates(message=False)
 
         self._update_files_all()
+        if not self._resume_checked:
+            self._resume_checked = True
+            self._resume_unfinished_batches()
         logger.debug('end: update_page')
 
     def close(self):
-        self._callback_stop_manual_qc()
+        self._file_catalogue.close()
+        self._callback_stop_manual_qc(background=False)
         self._ftp_frame.close()
         self._save_obj.save(user=self.user.name)
 
@@ -300,15 +409,24 @@ class PageStart(tk.Frame):
     def _goto_pre_system(self):
         self.parent_app.main_app.show_subframe('SHARKtools_pre_system_Svea', 'PageStart')
 
-    def _copy_to_server_and_update(self, files):
-        print(f'{files=}')
-        for file in files:
-            if 'test' in file:
-                continue
-            file_handler = self.file_handler
-            file_handler.select_file(file)
-            file_handler.copy_files_to_server(update=self._overwrite.value)
+    def _copy_to_server_and_update(self, files, msg, resume_batch_id=None):
+        cast_ids = [manifest.get_cast_id(file) for file in files if 'test' not in file]
+        self._submit_stage('copy', cast_ids, batch.run_with_file_handler, copy_files_to_server, self.year,
+                           self._get_file_handler_root_dirs(), files,
+                           update=self._overwrite.value,
+                           nr_workers=self._get_copy_workers(),
+                           resume_batch_id=resume_batch_id,
+                           name=_('Kopierar till servern'),
+                           on_result=lambda result: self._on_copied_to_server(msg, result),
+                           on_error=lambda e, tb: self._show_job_error(_('Kopiera till servern'), tb))
+
+    def _on_copied_to_server(self, msg, result):
         self._update_files_all_server()
+        msg = f'{msg}\n{result.get_summary()}'
+        if result.failed:
+            msg += '\n' + _('Kunde inte kopiera:') + '\n' + '\n'.join([str(path) for path, e in result.failed])
+        logger.info(msg)
+        messagebox.showinfo(_('Kopiera till servern'), msg)
 
     def _get_selected_local_cnv_stems(self):
         files = self._files_local_cnv.get_selected()
@@ -356,7 +474,7 @@ class PageStart(tk.Frame):
             return
         self._server_data_path_nsf.set(path=self.file_handler.get_dir('server', 'data') or '')
 
-    def _create_plots(self, with_config=False):
+    def _create_plots(self, with_config=False, on_created=None, background=True):
         directory = self.file_handler.get_dir('local', 'data')
         names = self._files_local_qc.get_selected()
         if not names:
@@ -366,12 +484,26 @@ class PageStart(tk.Frame):
             path = Path(directory, names[0])
             pack = file_explorer.get_package_for_file(path)
             self._show_config_plot_popup(pack)
-        else:
-            for name in names:
-                path = Path(directory, name)
-                pack = file_explorer.get_package_for_file(path)
-                plot.create_seabird_like_plots_for_package(pack, self.file_handler.get_dir('local', 'plots'))
+            return False
+        if not background:
+            pipeline.create_plots([Path(directory, name) for name in names], self.file_handler.get_dir('local', 'plots'),
+                                  nr_workers=self._get_nr_workers(), manifest=self._get_manifest())
             return True
+        self._submit_plots(names, on_created=on_created)
+        return True
+
+    def _submit_plots(self, names, on_created=None, resume_batch_id=None):
+        directory = self.file_handler.get_dir('local', 'data')
+        self._button_create_plots.config(state='disabled')
+        self._submit_stage('plots', [manifest.get_cast_id(name) for name in names], pipeline.create_plots,
+                           [Path(directory, name) for name in names], self.file_handler.get_dir('local', 'plots'),
+                           nr_workers=self._get_nr_workers(),
+                           manifest=self._get_manifest(),
+                           resume_batch_id=resume_batch_id,
+                           name=_('Skapar plottar'),
+                           on_result=lambda result: on_created and on_created(),
+                           on_error=lambda e, tb: self._show_job_error(_('Skapa plottar'), tb),
+                           on_finish=lambda: self._button_create_plots.config(state='normal'))
 
     def _show_config_plot_popup(self, pack):
         self._plot_config_popup = frames.PlotOptionsFrame(self, pack, callback=self._on_return_plot_config)
@@ -426,6 +558,9 @@ class PageStart(tk.Frame):
         self._overwrite = components.Checkbutton(frame, 'overwrite', title=_('Skriv över filer'), row=1, column=0,
                                                  **layout)
 
+        self._incremental = components.Checkbutton(frame, 'incremental', title=_('Hoppa över oförändrade stationer'),
+                                                   row=1, column=1, **layout)
+
         self._platform = components.LabelDropdownList(frame, 'platform', title=_('Platform'), row=2, column=0,
                                                       **layout)
 
@@ -441,11 +576,14 @@ class PageStart(tk.Frame):
                                                                     title=_('Spara asvp filer här:'),
                                                                     row=4, column=0, **layout)
 
+        self._job_status = components.JobStatus(frame, self.job_executor, cancel_text=_('Avbryt'),
+                                                queued_text=_('{} i kö'), row=5, column=0, columnspan=2, **layout)
+
         # self._button_update = tk.Button(frame, text='Uppdatera mappinnehåll mm.',
         #                                  command=self._update_all_local)
         # self._button_update.grid(row=2, column=1, padx=5, pady=2, sticky='ne')
 
-        tkw.grid_configure(frame, nr_rows=5, nr_columns=2)
+        tkw.grid_configure(frame, nr_rows=6, nr_columns=2)
 
     def _build_frame_local_data(self):
         frame = self._frame_local_data
@@ -505,12 +643,31 @@ class PageStart(tk.Frame):
         self._create_asvp_files = components.Checkbutton(option_frame, 'create_asvp_files',
                                                          title=_('Skapa asvp-filer'), row=0,
                                                          column=2, **layout)
-        tkw.grid_configure(option_frame, nr_rows=1, nr_columns=3)
+
+        self._nr_workers = components.LabelEntry(option_frame, 'nr_workers', title=_('Antal processer'), width=3,
+                                                 data_type=int, row=0, column=3, **layout)
+        self._nr_workers.set(batch.get_default_nr_workers())
+
+        self._mismatch_policy = components.LabelDropdownList(option_frame, 'mismatch_policy',
+                                                             title=_('Vid mismatch'), width=12,
+                                                             row=0, column=4, **layout)
+        self._mismatch_policy.values = list(MISMATCH_POLICY_TITLES.values())
+        self._mismatch_policy.set(MISMATCH_POLICY_TITLES[batch.MISMATCH_ASK])
+
+        self._copy_workers = components.LabelEntry(option_frame, 'copy_workers',
+                                                   title=_('Antal samtidiga kopieringar'), width=3,
+                                                   data_type=int, row=0, column=5, **layout)
+        self._copy_workers.set(server_copy.DEFAULT_NR_WORKERS)
+        tkw.grid_configure(option_frame, nr_rows=1, nr_columns=6)
 
         r += 1
         self._button_continue_source = tk.Button(frame, text=_('Kör processering'), command=self._callback_continue_source)
         self._button_continue_source.grid(row=r, column=0, padx=5, pady=2, sticky='se')
 
+        self._button_rebuild_stale = tk.Button(frame, text=_('Bygg om inaktuella stationer'),
+                                               command=self._callback_rebuild_stale)
+        self._button_rebuild_stale.grid(row=r, column=1, padx=5, pady=2, sticky='se')
+
         self._button_bg_color = self._button_continue_source.cget('bg')
 
         tkw.grid_configure(frame, nr_rows=4, nr_columns=2)
@@ -705,7 +862,7 @@ class PageStart(tk.Frame):
 
     def _build_frame_local_ftp(self):
         frame = self._notebook_local('FTP')
-        self._ftp_frame = frames.FtpFrame(frame)
+        self._ftp_frame = frames.FtpFrame(frame, job_executor=self.job_executor)
         self._ftp_frame.grid(row=0, column=0, sticky='nsew')
         tkw.grid_configure(frame)
 
@@ -814,70 +971,37 @@ class PageStart(tk.Frame):
             logger.warning(msg)
             messagebox.showwarning(_('Automatisk granskning'), msg)
             return
-        files = []
-        nr_files_qc = 0
-        for name in file_names:
-            self.file_handler.select_file(name)
-            local_file_path = self.file_handler.get_file_path('local', 'data', name)
-            if not self._intvar_allow_automatic_qc_same_day.get():
-                sf = StandardFormatComments(local_file_path)
-                if sf.has_automatic_qc_today():
-                    continue
-            files.append(str(local_file_path))
-            nr_files_qc += 1
+        self._run_automatic_qc(file_names)
+        logger.debug('end: _callback_continue_automatic_qc')
 
-        if not files:
+    def _run_automatic_qc(self, file_names, resume_batch_id=None):
+        self._button_automatic_qc.config(state='disabled')
+        self._submit_stage('automatic_qc',
+                           [manifest.get_cast_id(name) for name in file_names],
+                           batch.run_with_file_handler,
+                           run_automatic_qc_on_file_names,
+                           self.year,
+                           self._get_file_handler_root_dirs(),
+                           file_names,
+                           allow_same_day=bool(self._intvar_allow_automatic_qc_same_day.get()),
+                           manifest=self._get_manifest(),
+                           nr_workers=self._get_nr_workers() or batch.get_default_nr_workers(),
+                           local_root_directory=self._local_data_path_root.value,
+                           resume_batch_id=resume_batch_id,
+                           name=_('Automatisk granskning'),
+                           on_result=lambda nr_files_qc: self._on_automatic_qc_done(nr_files_qc, file_names),
+                           on_error=lambda e, tb: self._show_job_error(_('Automatisk granskning'), tb),
+                           on_finish=lambda: self._button_automatic_qc.config(state='normal'))
+
+    def _on_automatic_qc_done(self, nr_files_qc, file_names):
+        if not nr_files_qc:
             msg = _('Valda filer är redan granskade idag. \nIngen granskning gjord!')
             logger.warning(msg)
             messagebox.showwarning(_('Automatisk granskning'), msg)
             return
-        logger.info(f'{files=}')
-
-        tkw.disable_buttons_in_class(self)
-        self.root_app.open_progress_window()
-        try:
-            session = ctdpy_session.Session(filepaths=files,
-                                            reader='ctd_stdfmt')
-
-            datasets = session.read()
-            qc_session = qc.SessionQC(None)
-
-            for dset_name, item in datasets[0].items():
-                parameter_mapping = get_reversed_dictionary(session.settings.pmap, item['data'].keys())
-                qc_session.update_data(item,
-                                       parameter_mapping=parameter_mapping,
-                                       dataset_name=dset_name)
-                qc_session.run()
-
-            qc_session.write_log(Path(self.file_handler.get_dir('local', 'temp'), 'automatic_qc_log.yaml'),
-                                 reset_log=True)
-
-            data_path = session.save_data(datasets,
-                                          writer='ctd_standard_template', return_data_path=True,
-                                          save_path=self.file_handler.get_dir('local', 'temp'),
-                                          )
-
-            # Den här metoden använder therading vilket innebär att vi måste vänta på att filerna skapats innan vi kan kopiera dem.
-            data_path = Path(data_path)
-            time.sleep(.5)
-            for source_path in Path(data_path).iterdir():
-                target_path = Path(self.file_handler.get_dir('local', 'data'), source_path.name)
-                if target_path.exists() and not self._overwrite:
-                    continue
-                shutil.copyfile(str(source_path), str(target_path))
-            msg = _('{} av {} granskade!').format(nr_files_qc, len(file_names))
-            logger.info(msg)
-            messagebox.showinfo(_('Automatisk granskning'), msg)
-            return data_path
-        except Exception:
-            msg = traceback.format_exc()
-            logger.critical(msg)
-            messagebox.showwarning(_('Automatisk granskning'), msg)
-            raise
-        finally:
-            self.root_app.close_progress_window()
-            tkw.enable_buttons_in_class(self)
-            logger.debug('start: _callback_continue_automatic_qc')
+        msg = _('{} av {} granskade!').format(nr_files_qc, len(file_names))
+        logger.info(msg)
+        messagebox.showinfo(_('Automatisk granskning'), msg)
 
     def _callback_start_manual_qc(self):
         logger.debug('start: _callback_start_manual_qc')
@@ -891,7 +1015,7 @@ class PageStart(tk.Frame):
         self.bokeh_server.start()
         logger.debug('end: _callback_start_manual_qc')
 
-    def _callback_stop_manual_qc(self):
+    def _callback_stop_manual_qc(self, background=True):
         logger.debug('start: _callback_stop_manual_qc')
         if not self.bokeh_server:
             logger.info('No bokeh server started')
@@ -904,18 +1028,16 @@ class PageStart(tk.Frame):
         # self._update_files_local_nsf()
         # self._update_ftp_frame()
         if self._create_plots_option.get():
-            self._create_plots()
+            self._create_plots(background=background)
         self._notebook_local.select_frame(_('Standardformat'))
         logger.debug('end: _callback_stop_manual_qc')
 
     def _callback_create_plots(self):
         logger.debug('start: _callback_create_plots')
-        self.root_app.open_progress_window()
-        created = self._create_plots(with_config=True)
-        if created:
-            messagebox.showinfo(_('Skapa plottar'),
-                                _("Plottar har skapats här: {}").format(self.file_handler.get_dir('local', 'plots')))
-        self.root_app.close_progress_window()
+        plots_directory = self.file_handler.get_dir('local', 'plots')
+        self._create_plots(with_config=True,
+                           on_created=lambda: messagebox.showinfo(_('Skapa plottar'),
+                                                                  _("Plottar har skapats här: {}").format(plots_directory)))
         logger.debug('end: _callback_create_plots')
 
     def _callback_on_select_local_nsf(self):
@@ -932,72 +1054,123 @@ class PageStart(tk.Frame):
         # self._update_server_file_lists()
 
     def _callback_copy_all_to_server(self):
-        self.root_app.open_progress_window()
         files = self._files_local_nsf_all.get_items()
-        self._copy_to_server_and_update(files)
-        self.root_app.close_progress_window()
-        msg = _('ALLT filer har kopierats till servern')
-        logger.info(msg)
-        messagebox.showinfo(_('Kopiera till servern'), msg)
+        self._copy_to_server_and_update(files, _('ALLT filer har kopierats till servern'))
 
     def _callback_copy_missing_to_server(self):
         files = self._files_local_nsf_missing.get_items()
-        self._copy_to_server_and_update(files)
-        msg = _('Saknade filer har kopierats till servern')
-        logger.info(msg)
-        messagebox.showinfo(_('Kopiera till servern'), msg)
+        self._copy_to_server_and_update(files, _('Saknade filer har kopierats till servern'))
 
     def _callback_copy_not_updated_to_server(self):
         files = self._files_local_nsf_not_updated.get_items()
-        self._copy_to_server_and_update(files)
-        msg = _('Alla icke uppdaterade filer har kopierats till servern')
-        logger.info(msg)
-        messagebox.showinfo(_('Kopiera till servern'), msg)
+        self._copy_to_server_and_update(files, _('Alla icke uppdaterade filer har kopierats till servern'))
 
     def _callback_copy_selected_to_server(self):
         files = self._files_local_nsf_select.get_selected()
-        self._copy_to_server_and_update(files)
-        msg = _('Valda filer har kopierats till servern')
-        logger.info(msg)
-        messagebox.showinfo(_('Kopiera till servern'), msg)
+        self._copy_to_server_and_update(files, _('Valda filer har kopierats till servern'))
 
     def _callback_continue_cnv(self):
-        try:
-            self.root_app.open_progress_window()
-            self._converted_files = []
-            cnv_files = self._get_selected_local_cnv_file_paths()
-            if not cnv_files:
-                msg = _('Inga CNV filer valda för att skapa standardformat!')
-                logger.warning(msg)
-                messagebox.showwarning(_('Skapar standardformat'), msg)
-                return
-            packs = file_explorer.get_packages_from_file_list(cnv_files, instrument_type='sbe', as_list=True,
-                                                              old_key=self._old_key.value)
-            new_packs = ctd_processing.create_standard_format_for_packages(packs,
-                                                                           file_handler=self.file_handler,
-                                                                           # config_root_directory=self._config_path.value,
-                                                                           overwrite=self._overwrite.value,
-                                                                           sharkweb_btl_row_file=None,
-                                                                           old_key=self._old_key.value)
-
-            self._converted_files = [path.stem for path in cnv_files]
-            time.sleep(1)  # This is to assert registration of new files
+        self._converted_files = []
+        cnv_files = self._get_selected_local_cnv_file_paths()
+        if not cnv_files:
+            msg = _('Inga CNV filer valda för att skapa standardformat!')
+            logger.warning(msg)
+            messagebox.showwarning(_('Skapar standardformat'), msg)
+            return
+        self._create_standard_format(cnv_files)
+
+    def _create_standard_format(self, cnv_files, resume_batch_id=None):
+        self._button_continue_cnv.config(state='disabled')
+        self._submit_stage('standard_format',
+                           [manifest.get_cast_id(path.name) for path in cnv_files],
+                           batch.run_with_file_handler,
+                           pipeline.create_standard_format_for_cnv_files,
+                           self.year,
+                           self._get_file_handler_root_dirs(),
+                           cnv_files,
+                           year=self.year,
+                           root_dirs=self._get_processing_root_dirs(),
+                           nr_workers=self._get_nr_workers(),
+                           overwrite=self._overwrite.value,
+                           old_key=self._old_key.value,
+                           manifest=self._get_manifest(),
+                           resume_batch_id=resume_batch_id,
+                           name=_('Skapar standardformat'),
+                           on_result=lambda result: self._on_standard_format_created(cnv_files),
+                           on_error=self._on_standard_format_error,
+                           on_finish=lambda: self._button_continue_cnv.config(state='normal'))
+
+    def _on_standard_format_created(self, cnv_files):
+        self._converted_files = [path.stem for path in cnv_files]
+        with self._refresh():
             self._update_files_local_nsf()
             self._update_files_local_qc()
-            self._notebook_local.select_frame(_('Granskning'))
-        except PermissionError as e:
-            self.root_app.close_progress_window()
-            msg = _('Det verkar som att en fil är öppen. Stäng den och försök igen: {}').format(e)
+        self._notebook_local.select_frame(_('Granskning'))
+
+    def _on_standard_format_error(self, exception, tb):
+        if isinstance(exception, PermissionError):
+            msg = _('Det verkar som att en fil är öppen. Stäng den och försök igen: {}').format(exception)
             logger.error(msg)
             messagebox.showerror(_('Skapa standardformat'), msg)
-        except Exception:
-            self.root_app.close_progress_window()
-            msg = traceback.format_exc()
-            logger.critical(msg)
-            messagebox.showerror(_('Skapa standardformat'), _('Internt fel: \n{}').format(msg))
-            raise
-        finally:
-            self.root_app.close_progress_window()
+            return
+        messagebox.showerror(_('Skapa standardformat'), _('Internt fel: \n{}').format(tb))
+
+    def _callback_rebuild_stale(self):
+        """Finds the casts that were processed with config files that have changed since and asks if they
+        should be reprocessed"""
+        if not self._config_path.get():
+            messagebox.showwarning(_('Bygg om inaktuella stationer'), _('Ingen rotkatalog för ctd_config vald!'))
+            return
+        if not self._local_data_path_root.get():
+            messagebox.showwarning(_('Bygg om inaktuella stationer'), _('Ingen rotkatalog för lokal data vald!'))
+            return
+        self._button_rebuild_stale.config(state='disabled')
+        self.job_executor.submit(pipeline.get_stale_casts,
+                                 self._local_data_path_root.value,
+                                 self._config_path.value,
+                                 name=_('Letar efter inaktuella stationer'),
+                                 on_result=self._on_stale_casts,
+                                 on_error=lambda e, tb: self._on_rebuild_stale_finished(error=tb))
+
+    def _on_stale_casts(self, stale):
+        if not stale:
+            messagebox.showinfo(_('Bygg om inaktuella stationer'), _('Inga inaktuella stationer hittades'))
+            self._on_rebuild_stale_finished()
+            return
+        lines = [f'{cast_id}: {", ".join(changed[:3])}' for cast_id, changed in list(stale.items())[:20]]
+        if len(stale) > 20:
+            lines.append('...')
+        ans = messagebox.askyesno(_('Bygg om inaktuella stationer'),
+                                  _('{} stationer är processerade med configfiler som har ändrats:\n\n{}\n\n'
+                                    'Vill du processera om dem?').format(len(stale), '\n'.join(lines)))
+        if not ans:
+            self._on_rebuild_stale_finished()
+            return
+        self.job_executor.submit(pipeline.rebuild_stale,
+                                 self._config_path.value,
+                                 self._local_data_path_root.value,
+                                 cast_ids=list(stale),
+                                 nr_workers=self._get_nr_workers(),
+                                 name=_('Bygger om inaktuella stationer'),
+                                 on_result=lambda summary: self._on_rebuild_stale_finished(summary=summary),
+                                 on_error=lambda e, tb: self._on_rebuild_stale_finished(error=tb))
+
+    def _on_rebuild_stale_finished(self, summary=None, error=None):
+        self._button_rebuild_stale.config(state='normal')
+        if error:
+            messagebox.showerror(_('Bygg om inaktuella stationer'), error)
+        if not summary:
+            return
+        nr_processed = summary['stages'].get('process', {}).get('nr_items', 0)
+        msg = _('{} stationer har processerats om').format(nr_processed)
+        if summary['failed']:
+            msg = msg + '\n\n' + '\n'.join([f'{item["stage"]}: {item["item"]}' for item in summary['failed']])
+        logger.info(msg)
+        messagebox.showinfo(_('Bygg om inaktuella stationer'), msg)
+        with self._refresh():
+            self._update_files_local_cnv()
+            self._update_files_local_nsf()
+            self._update_files_local_qc()
 
     def _callback_continue_source(self):
         logger.debug('start: _callback_continue_source')
@@ -1022,67 +1195,154 @@ class PageStart(tk.Frame):
             messagebox.showwarning(_('Kör processering'), _('Ingen filer är valda för processering!'))
             return
 
-        self.root_app.open_progress_window()
         self.update_file_handler()
 
-        processed_files = []
-
         create_asvp_file = False
         asvp_output_dir = self._asvp_files_directory.get()
         if asvp_output_dir:
             create_asvp_file = self._create_asvp_files.get()
 
-        for file_name in selected:
-            path = Path(self._local_data_path_source.value, file_name)
-            ignore_mismatch = False
-            try_fixing_mismatch = False
-            continue_trying = True
-            while continue_trying:
-                try:
-                    pack = ctd_processing.process_sbe_file(path,
-                                                           target_root_directory=self._local_data_path_root.value,
-                                                           config_root_directory=self._config_path.value,
-                                                           file_handler=self.file_handler,
-                                                           platform=self._platform.value,
-                                                           surfacesoak=self._surfacesoak.value,
-                                                           tau=self._tau.value,
-                                                           overwrite=self._overwrite.value,
-                                                           psa_paths=None,
-                                                           ignore_mismatch=ignore_mismatch,
-                                                           try_fixing_mismatch=try_fixing_mismatch,
-                                                           old_key=self._old_key.value,
-                                                           create_asvp_file=create_asvp_file,
-                                                           asvp_output_dir=asvp_output_dir,
-                                                           )
-
-                    processed_files.append(pack['hex'])
-                    continue_trying = False
-                except FileExistsError:
-                    self.root_app.close_progress_window()
-                    messagebox.showerror('File exists',
-                                         f'Could not overwrite file. Select overwrite and try again.\n{path}')
-                    return
-                except file_explorer.seabird.MismatchWarning as e:
-                    self.root_app.close_progress_window()
-                    ans = messagebox.askyesnocancel(_('Mismatch mellan filer'),
-                                                    _("{}\n\nVälj \"Ja\" för att försöka lösa problemet. \nVälj \"Nej\" för att lösa problemet i seabird programvara. \nVälj \"Avbryt\" för att avbryta. ").format(e.data))
-                    if ans is True:
-                        try_fixing_mismatch = True
-                    elif ans is False:
-                        ignore_mismatch = True
-                    else:
-                        return
-                except Exception as e:
-                    self.root_app.close_progress_window()
-                    msg = traceback.format_exc()
-                    logger.critical(msg)
-                    messagebox.showerror(_('Något gick fel'), msg)
-                    raise
-
-        self._processed_files = [path.stem for path in processed_files]
+        settings = dict(year=self.year,
+                        root_dirs=self._get_processing_root_dirs(),
+                        nr_workers=self._get_nr_workers(),
+                        platform=self._platform.value,
+                        surfacesoak=self._surfacesoak.value,
+                        tau=self._tau.value,
+                        overwrite=self._overwrite.value,
+                        psa_paths=None,
+                        old_key=self._old_key.value,
+                        create_asvp_file=create_asvp_file,
+                        asvp_output_dir=asvp_output_dir,
+                        mismatch_policy=self._get_mismatch_policy())
+        queue, batch_id = self._create_batch(_('Processerar'), settings=settings)
+        processor = batch.BatchProcessor(manifest=self._get_manifest(), job_queue=queue, batch_id=batch_id,
+                                         **settings)
+
+        paths = [Path(self._local_data_path_source.value, file_name) for file_name in selected]
+        self._submit_processing(processor, paths, {})
+
+    def _resume_unfinished_batches(self):
+        """Asks if batches that were stopped (application closed or crashed) should be resumed. A batch is
+        resumed from its first unfinished stage. Asking is deferred while other jobs are running."""
+        queue = self._get_job_queue()
+        if not queue:
+            return
+        unfinished_batches = queue.get_unfinished_batches(source=JOB_QUEUE_SOURCE)
+        if self._batch_ids_to_resume is None:
+            self._batch_ids_to_resume = set([batch_info['id'] for batch_info in unfinished_batches])
+        for batch_info in unfinished_batches:
+            if batch_info['id'] not in self._batch_ids_to_resume:
+                continue
+            if self.job_executor.busy:
+                self.after(RESUME_RETRY_MS, self._resume_unfinished_batches)
+                return
+            stage, unfinished = queue.get_first_unfinished_stage(batch_info['id'], RESUME_STAGES)
+            if stage == 'process':
+                items = [Path(job['path']) for job in unfinished if Path(job['path']).exists()]
+            else:
+                items = self._get_local_files_for_resume(stage, [job['cast_id'] for job in unfinished])
+            self._batch_ids_to_resume.discard(batch_info['id'])
+            if not items:
+                queue.cancel_batch(batch_info['id'])
+                continue
+            if stage == 'process':
+                msg = _('Processeringen som startades {} avbröts innan den var klar. '
+                        '{} stationer återstår.\n\nVill du fortsätta processeringen?').format(batch_info['created'],
+                                                                                          len(items))
+            else:
+                msg = _('"{}" som startades {} avbröts innan det var klart. '
+                        '{} stationer återstår.\n\nVill du fortsätta?').format(batch_info['name'],
+                                                                            batch_info['created'], len(items))
+            if not messagebox.askyesno(_('Återuppta processering'), msg):
+                queue.cancel_batch(batch_info['id'])
+                continue
+            self._resume_stage(queue, batch_info, stage, items)
+            # The next batch is asked for when this one is done
+            self.after(RESUME_RETRY_MS, self._resume_unfinished_batches)
+            return
+
+    def _get_local_files_for_resume(self, stage, cast_ids):
+        """Returns the local files of the casts that are input to the stage (cnv paths or standard format
+        file names)"""
+        cast_ids = set(cast_ids)
+        if stage == 'standard_format':
+            directory = self.file_handler.get_dir('local', 'cnv')
+            return [Path(directory, name) for name in self._get_file_names('local', 'cnv', suffixes=['.cnv'])
+                    if manifest.get_cast_id(name) in cast_ids]
+        return [name for name in self._get_file_names('local', 'data', suffixes=['.txt'])
+                if manifest.get_cast_id(name) in cast_ids]
+
+    def _resume_stage(self, queue, batch_info, stage, items):
+        batch_id = batch_info['id']
+        if stage == 'process':
+            processor = batch.BatchProcessor(manifest=self._get_manifest(), job_queue=queue,
+                                             batch_id=batch_id, **batch_info['settings'])
+            self._submit_processing(processor, items, {})
+        elif stage == 'standard_format':
+            self._create_standard_format(items, resume_batch_id=batch_id)
+        elif stage == 'automatic_qc':
+            self._run_automatic_qc(items, resume_batch_id=batch_id)
+        elif stage == 'plots':
+            self._submit_plots(items, resume_batch_id=batch_id)
+        elif stage == 'copy':
+            self._copy_to_server_and_update(items, _('Filer har kopierats till servern'), resume_batch_id=batch_id)
+
+    def _submit_processing(self, processor, paths, options):
+        self._button_continue_source.config(state='disabled')
+        self.job_executor.submit(processor.run_all, paths, options=options,
+                                 name=_('Processerar'),
+                                 on_result=lambda results: self._on_processing_results(processor, results, options),
+                                 on_error=lambda e, tb: self._on_processing_error(processor, tb),
+                                 on_cancel=lambda: self._on_processing_finished(processor))
+
+    def _on_processing_results(self, processor, results, options):
+        """Mismatches are only asked for here with the mismatch policy "ask". Other problems are shown in
+        the report when the batch is finished."""
+        paths = []
+        mismatches = [result for result in results if result.status == batch.STATUS_MISMATCH]
+        if processor.mismatch_policy != batch.MISMATCH_ASK:
+            mismatches = []
+        for result in mismatches:
+            ans = messagebox.askyesnocancel(_('Mismatch mellan filer'),
+                                            _("{}\n\nVälj \"Ja\" för att försöka lösa problemet. \nVälj \"Nej\" för att lösa problemet i seabird programvara. \nVälj \"Avbryt\" för att avbryta. ").format(result.mismatch_data))
+            if ans is None:
+                break
+            options.setdefault(result.path, {})
+            if ans is True:
+                options[result.path]['try_fixing_mismatch'] = True
+            else:
+                options[result.path]['ignore_mismatch'] = True
+            paths.append(result.path)
+        if paths:
+            self._submit_processing(processor, paths, options)
+            return
+        self._on_processing_finished(processor)
+
+    def _on_processing_error(self, processor, tb):
+        messagebox.showerror(_('Något gick fel'), tb)
+        self._on_processing_finished(processor)
+
+    def _on_processing_finished(self, processor):
+        self._button_continue_source.config(state='normal')
+        report = processor.report
+        logger.info(f'Processing report: {report.get_text()}')
+        for result in report.get_results(batch.STATUS_ERROR):
+            logger.error(f'{result.path.name}: {result.message}')
+        if report.problems:
+            msg = _('{} stationer processerade, {} hoppades över och {} hade problem:').format(
+                len(report.processed), len(report.skipped), len(report.problems))
+            msg = msg + '\n\n' + '\n'.join(report.get_problem_lines())
+            if report.get_results(batch.STATUS_FILE_EXISTS):
+                msg = msg + '\n\n' + _('Välj "Skriv över filer" för att processera filer som redan finns.')
+            messagebox.showwarning(_('Kör processering'), msg)
+        elif report.skipped:
+            msg = _('{} oförändrade stationer hoppades över').format(len(report.skipped))
+            logger.info(msg)
+            messagebox.showinfo(_('Kör processering'), msg)
+
+        self._processed_files = [result.processed_path.stem for result in report.processed]
         self._update_files_local_cnv()
         self._notebook_local.select_frame('cnv')
-        self.root_app.close_progress_window()
         logger.debug('end: _callback_continue_source')
 
 ########################################################################################################################
@@ -1093,9 +1353,78 @@ class PageStart(tk.Frame):
 ########################################################################################################################
 ########################################################################################################################
 
+    @contextlib.contextmanager
+    def _refresh(self):
+        """All file lists updated within the block get their file names from the same snapshot of the
+        directories. The number of directory listings are logged when the refresh is done."""
+        if self._snapshot:
+            yield self._snapshot
+            return
+        self._snapshot = snapshot.FileSnapshot(self.file_handler)
+        try:
+            yield self._snapshot
+        finally:
+            logger.info(f'Refresh: {self._snapshot.get_summary()}')
+            self._snapshot = None
+
+    def _get_file_names(self, root, subdir, suffixes=None):
+        if self._snapshot:
+            return self._snapshot.get_file_names(root, subdir, suffixes=suffixes)
+        return self.file_handler.get_file_names(root, subdir, suffixes=suffixes)
+
     def _update_files_all(self):
-        self._update_files_all_local()
-        self._update_files_all_server()
+        with self._refresh():
+            self._update_files_all_local()
+            self._update_files_all_server()
+
+    def _get_file_catalogue_lists(self):
+        """Returns a dict with the watched (root, subdir) as key and a list of (widget, suffixes) as value"""
+        return {
+            ('source', 'root'): [(self._files_local_source, ['.hex'])],
+            ('local', 'raw'): [(self._files_local_raw, None)],
+            ('local', 'cnv'): [(self._files_local_cnv, ['.cnv'])],
+            ('local', 'data'): [(self._files_local_qc, None),
+                                (self._files_local_nsf_all, None),
+                                (self._files_local_nsf_select, None)],
+            ('server', 'data'): [(self._files_server, None)],
+        }
+
+    def _watch_directories(self):
+        if not self._year.get():
+            return
+        for root, subdir in self._get_file_catalogue_lists():
+            directory = None
+            if self.file_handler.root_dir_is_set(root):
+                try:
+                    directory = self.file_handler.get_dir(root, subdir)
+                except RootDirectoryNotSetError:
+                    pass
+            self._file_catalogue.watch((root, subdir), directory)
+
+    def _poll_file_catalogue(self):
+        for delta in self._file_catalogue.get_deltas():
+            post_event('file_catalogue_delta', delta)
+        self.after(500, self._poll_file_catalogue)
+
+    def _on_file_catalogue_delta(self, delta):
+        """Applies added and removed files to the lists instead of listing the directories again"""
+        for widget, suffixes in self._get_file_catalogue_lists().get(delta.key, []):
+            apply_file_delta(widget, delta, suffixes=suffixes)
+        if delta.key in [('local', 'data'), ('server', 'data')] and self._server_data_path_root.value:
+            self._update_server_comparison_for_names(delta.added | delta.removed | delta.modified)
+
+    def _update_server_comparison_for_names(self, names):
+        """Compares only the given local and server standard format files and updates them in the lists of
+        files missing and not updated on the server"""
+        handler = self.file_handler
+        if not handler:
+            return
+        local_directory = handler.get_dir('local', 'data')
+        server_directory = handler.get_dir('server', 'data')
+        comparison = compare.compare_stats(compare.get_file_stats_for_names(local_directory, names),
+                                           compare.get_file_stats_for_names(server_directory, names))
+        update_file_names(self._files_local_nsf_missing, names, comparison.missing)
+        update_file_names(self._files_local_nsf_not_updated, names, comparison.outdated)
 
     def _update_files_all_local(self):
         # self.sbe_file_handler.update_all_local_files()
@@ -1103,49 +1432,54 @@ class PageStart(tk.Frame):
             logger.warning('Local root directory is not set')
             return
 
-        self._update_files_local_source()
-        self._update_files_local_raw()
-        self._update_files_local_cnv()
-        self._update_files_local_nsf()
-        self._update_files_local_qc()
-        self._update_ftp_frame()
+        with self._refresh():
+            self._update_files_local_source()
+            self._update_files_local_raw()
+            self._update_files_local_cnv()
+            self._update_files_local_nsf()
+            self._update_files_local_qc()
+            self._update_ftp_frame()
+        self._watch_directories()
 
     def _update_files_all_server(self):
         if not self.file_handler.root_dir_is_set('server'):
             logger.warning('Server root directory is not set')
             return
-        self._update_files_server()
-        self._update_files_local_nsf_all()
-        self._update_files_local_nsf_not_on_server()
-        # self._update_files_local_nsf_not_updated_on_server()
+        with self._refresh():
+            self._update_files_server()
+            self._update_files_local_nsf_all()
+            self._update_files_local_nsf_not_on_server()
+            self._update_files_local_nsf_not_updated_on_server()
+        self._watch_directories()
 
     def _update_files_local_nsf(self):
-        self._update_files_local_nsf_all()
-        self._update_files_local_nsf_select()
-        if self._server_data_path_root.value:
-            self._update_files_local_nsf_not_on_server()
-            # self._update_files_local_nsf_not_updated_on_server()
-        else:
-            msg = _('Ingen rootkatlog för servern är satt. Kan inte uppdatera relaterade listor')
-            logger.info(msg)
-            messagebox.showinfo(_('Updaterar listor på standardformatet'), msg)
+        with self._refresh():
+            self._update_files_local_nsf_all()
+            self._update_files_local_nsf_select()
+            if self._server_data_path_root.value:
+                self._update_files_local_nsf_not_on_server()
+                self._update_files_local_nsf_not_updated_on_server()
+            else:
+                msg = _('Ingen rootkatlog för servern är satt. Kan inte uppdatera relaterade listor')
+                logger.info(msg)
+                messagebox.showinfo(_('Updaterar listor på standardformatet'), msg)
 
     def _update_files_local_source(self):
         """Updates local file list based on files found in path: self._local_data_path_source"""
         logger.debug('start: _update_files_local_source')
-        files = self.file_handler.get_file_names('source', 'root', suffixes=['.hex'])
+        files = self._get_file_names('source', 'root', suffixes=['.hex'])
         self._files_local_source.update_items(files)
         logger.debug('end: _update_files_local_source')
 
     def _update_files_local_raw(self):
         logger.debug('start: _update_files_local_raw')
-        files = self.file_handler.get_file_names('local', 'raw')
+        files = self._get_file_names('local', 'raw')
         self._files_local_raw.update_items(files)
         logger.debug('end: _update_files_local_raw')
 
     def _update_files_local_cnv(self):
         logger.debug('start: _update_files_local_cnv')
-        files = self.file_handler.get_file_names('local', 'cnv', suffixes=['.cnv'])
+        files = self._get_file_names('local', 'cnv', suffixes=['.cnv'])
         self._files_local_cnv.update_items(files)
         self._files_local_cnv.deselect_all()
         all_cnv_files = {}
@@ -1161,7 +1495,7 @@ class PageStart(tk.Frame):
 
     def _update_files_local_qc(self):
         logger.debug('start: _update_files_local_qc')
-        files = self.file_handler.get_file_names('local', 'data') or []
+        files = self._get_file_names('local', 'data') or []
         self._files_local_qc.update_items(files)
         self._files_local_qc.deselect_all()
         all_txt_files = {}
@@ -1176,7 +1510,7 @@ class PageStart(tk.Frame):
 
     def _update_ftp_frame(self):
         logger.debug('start: _update_ftp_frame')
-        self._ftp_frame.update_frame()
+        self._ftp_frame.update_frame(snapshot=self._snapshot)
         all_keys = self._ftp_frame.get_all_keys()
         selected_keys = [key for key in all_keys if key in self._converted_files]
         self._ftp_frame.move_keys_to_selected(selected_keys)
@@ -1184,52 +1518,95 @@ class PageStart(tk.Frame):
 
     def _update_files_local_nsf_all(self):
         logger.debug('start: _update_files_local_nsf_all')
-        files = self.file_handler.get_file_names('local', 'data')
+        files = self._get_file_names('local', 'data')
         self._files_local_nsf_all.update_items(files)
         logger.debug('end: _update_files_local_nsf_all')
 
     def _update_files_local_nsf_select(self):
         logger.debug('start: _update_files_local_nsf_select')
-        files = self.file_handler.get_file_names('local', 'data')
+        files = self._get_file_names('local', 'data')
         self._files_local_nsf_select.update_items(files)
         logger.debug('end: _update_files_local_nsf_select')
 
+    def _get_server_comparison(self):
+        """Local and server standard format files compared in one pass, see compare.py"""
+        with self._refresh() as snap:
+            return snap.get_comparison('data')
+
     def _update_files_local_nsf_not_on_server(self):
         logger.debug('start: _update_files_local_nsf_not_on_server')
-        files = self.file_handler.get_file_names('local', 'data')
-        not_on_server = []
-        for file in files:
-            try:
-                self.file_handler.select_file(file)
-                if self.file_handler.not_on_server():
-                    not_on_server.append(file)
-            except exceptions.InvalidFileNameFormat:
-                continue
-        self._files_local_nsf_missing.update_items(not_on_server)
+        comparison = self._get_server_comparison()
+        self._files_local_nsf_missing.update_items(sorted(comparison.missing))
         logger.debug('end: _update_files_local_nsf_not_on_server')
 
     def _update_files_local_nsf_not_updated_on_server(self):
         logger.debug('start: _update_files_local_nsf_not_updated_on_server')
-        files = self.file_handler.get_file_names('local', 'data')
-        not_updated_on_server = []
-        for file in files:
-            try:
-                self.file_handler.select_file(file)
-                if self.file_handler.not_updated_on_server():
-                    not_updated_on_server.append(file)
-            except exceptions.InvalidFileNameFormat:
-                continue
-        self._files_local_nsf_not_updated.update_items(not_updated_on_server)
+        comparison = self._get_server_comparison()
+        self._files_local_nsf_not_updated.update_items(sorted(comparison.outdated))
         logger.debug('end: _update_files_local_nsf_not_updated_on_server')
 
     def _update_files_server(self):
         """Updates server file list based on files found in path: self._server_data_path_nsf"""
         logger.debug('start: _update_files_server')
-        files = self.file_handler.get_file_names('server', 'data')
+        files = self._get_file_names('server', 'data')
         self._files_server.update_items(files)
         logger.debug('end: _update_files_server')
 
 
-
-
-
+def apply_file_delta(widget, delta, suffixes=None):
+    """Adds and removes the files in the file_catalogue.FileDelta in a ListboxWidget or
+    ListboxSelectionWidget. Selected files are kept selected."""
+    added = [name for name in delta.added if not suffixes or Path(name).suffix in suffixes]
+    removed = set(delta.removed)
+    if not added and not removed:
+        return
+    update_file_names(widget, removed | set(added), added)
+
+
+def update_file_names(widget, names, present):
+    """Updates the given names in a ListboxWidget or ListboxSelectionWidget. Names in present are
+    listed, the other names are removed. Selected files are kept selected."""
+    names = set(names)
+    if hasattr(widget, 'get_all_items'):
+        items = widget.get_all_items()
+        selected = widget.get_selected()
+    else:
+        items = widget.get_items()
+        selected = []
+    new_items = [item for item in items if item not in names]
+    new_items.extend([name for name in present if name not in new_items])
+    if sorted(new_items) == sorted(items):
+        return
+    items = sorted(new_items)
+    widget.update_items(items)
+    selected = [item for item in selected if item in items]
+    if selected:
+        widget.move_items_to_selected(selected)
+
+
+def copy_files_to_server(files, file_handler, update=False, nr_workers=None):
+    """Copies all local files of the casts of the given files to the server, see server_copy.py.
+    Returns a CopyResult."""
+    cast_ids = [manifest.get_cast_id(file) for file in files if 'test' not in file]
+    return server_copy.copy_casts_to_server(file_handler, cast_ids, update=update, nr_workers=nr_workers)
+
+
+def run_automatic_qc_on_file_names(file_names, file_handler, allow_same_day=False, manifest=None, nr_workers=1,
+                                   local_root_directory=None):
+    """Runs automatic qc on the given files in local data. Files that already have automatic qc
+    today are skipped if allow_same_day is False. The files are split between nr_workers processes.
+    Returns the number of files that were qc-checked."""
+    files = []
+    for name in file_names:
+        file_handler.select_file(name)
+        files.append(str(file_handler.get_file_path('local', 'data', name)))
+    if not allow_same_day:
+        # Only the headers are read, see qc_index.py
+        qc_today = set(qc_index.get_qc_index(local_root_directory).get_files_with_automatic_qc_today(files))
+        files = [path for path in files if path not in qc_today]
+    if not files:
+        return 0
+    logger.info(f'{files=}')
+    pipeline.run_automatic_qc(files, file_handler, manifest=manifest, nr_workers=nr_workers,
+                              local_root_directory=local_root_directory)
+    return len(files)
@@ -0,0 +1,274 @@
+"""
+Durable queue (SQLite) with one job per cast and stage. Every batch action in PageStart and PageSimple
+creates a batch and records its jobs with state and timings, so it is known which casts were finished
+if the application is closed or crashes during a long run.
+
+Jobs that were running when the application stopped are set back to pending when the queue is opened.
+Unfinished batches can be resumed from their first unfinished stage (processing batches store the
+processing settings for this). Failed jobs are retried with exponential backoff
+(BACKOFF_SECONDS * 2 ** (attempt - 1), at most MAX_BACKOFF_SECONDS) until max_attempts is reached. This
+is done per cast for the process stage (see batch.BatchProcessor) and for the whole stage for the other
+stages (see run_stage). Errors that will not go away by retrying (mismatch, file exists) are not retried.
+
+The database is stored in the local root directory.
+"""
+import contextlib
+import datetime
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from . import jobs
+
+logger = logging.getLogger(__name__)
+
+QUEUE_FILE_NAME = 'processing_queue.sqlite'
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+UNFINISHED_STATES = [PENDING, RUNNING]
+
+MAX_ATTEMPTS = 3
+BACKOFF_SECONDS = 5
+MAX_BACKOFF_SECONDS = 300
+# Exceptions in a stage that are not retried
+NOT_RETRIED_EXCEPTIONS = (FileExistsError,)
+
+_queues = {}
+_lock = threading.Lock()
+
+
+def get_job_queue(local_root_directory):
+    """Returns a shared JobQueue for the given local root directory"""
+    key = str(Path(local_root_directory).resolve())
+    with _lock:
+        if key not in _queues:
+            _queues[key] = JobQueue(local_root_directory)
+        return _queues[key]
+
+
+def get_backoff(attempt):
+    return min(BACKOFF_SECONDS * 2 ** (attempt - 1), MAX_BACKOFF_SECONDS)
+
+
+def _now_string():
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+class JobQueue:
+
+    def __init__(self, local_root_directory, file_path=None):
+        self.file_path = Path(file_path or Path(local_root_directory, QUEUE_FILE_NAME))
+        self._lock = threading.RLock()
+        self._create_tables()
+        self.reset_running()
+
+    def _connect(self):
+        con = sqlite3.connect(str(self.file_path), timeout=30)
+        con.row_factory = sqlite3.Row
+        return con
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            con = self._connect()
+            try:
+                with con:
+                    yield con
+            finally:
+                con.close()
+
+    def _create_tables(self):
+        with self._transaction() as con:
+            con.execute('CREATE TABLE IF NOT EXISTS batches ('
+                        'id TEXT PRIMARY KEY, name TEXT, source TEXT, settings TEXT, created TEXT)')
+            con.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                        'id INTEGER PRIMARY KEY AUTOINCREMENT, batch_id TEXT, cast_id TEXT, stage TEXT, path TEXT, '
+                        'state TEXT, attempts INTEGER DEFAULT 0, max_attempts INTEGER, next_attempt REAL DEFAULT 0, '
+                        'created TEXT, started TEXT, finished TEXT, seconds REAL, message TEXT, '
+                        'UNIQUE (batch_id, cast_id, stage))')
+            con.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (batch_id, state)')
+
+    def reset_running(self):
+        """Jobs left running by a stopped application are pending again"""
+        with self._transaction() as con:
+            nr = con.execute('UPDATE jobs SET state=?, started=NULL WHERE state=?', (PENDING, RUNNING)).rowcount
+        if nr:
+            logger.info(f'{nr} interrupted jobs are pending again')
+
+    def create_batch(self, name, source='', settings=None):
+        """Creates a batch and returns its id. settings (json) is used when resuming the batch"""
+        batch_id = f'{datetime.datetime.now().strftime("%Y%m%d%H%M%S")}_{uuid.uuid4().hex[:8]}'
+        with self._transaction() as con:
+            con.execute('INSERT INTO batches VALUES (?, ?, ?, ?, ?)',
+                        (batch_id, name, source, json.dumps(settings or {}, default=str), _now_string()))
+        return batch_id
+
+    def add_jobs(self, batch_id, stage, items, max_attempts=MAX_ATTEMPTS):
+        """items is a list of (cast_id, path). Jobs that already exist for the cast and stage are kept as they
+        are (with their number of attempts)"""
+        with self._transaction() as con:
+            con.executemany('INSERT OR IGNORE INTO jobs (batch_id, cast_id, stage, path, state, max_attempts, created) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            [(batch_id, cast_id, stage, str(path or ''), PENDING, max_attempts, _now_string())
+                             for cast_id, path in items])
+
+    def start(self, batch_id, stage, cast_ids):
+        with self._transaction() as con:
+            con.executemany('UPDATE jobs SET state=?, started=? WHERE batch_id=? AND stage=? AND cast_id=?',
+                            [(RUNNING, _now_string(), batch_id, stage, cast_id) for cast_id in cast_ids])
+
+    def finish(self, batch_id, stage, cast_id, seconds=None, message=''):
+        with self._transaction() as con:
+            con.execute('UPDATE jobs SET state=?, finished=?, seconds=?, message=? '
+                        'WHERE batch_id=? AND stage=? AND cast_id=?',
+                        (DONE, _now_string(), seconds, message, batch_id, stage, cast_id))
+
+    def fail(self, batch_id, stage, cast_id, message='', retry=True, seconds=None):
+        """Sets the job to pending with a backoff if it should be retried, else to failed. Returns True if
+        the job will be retried."""
+        with self._transaction() as con:
+            row = con.execute('SELECT attempts, max_attempts FROM jobs WHERE batch_id=? AND stage=? AND cast_id=?',
+                              (batch_id, stage, cast_id)).fetchone()
+            if not row:
+                return False
+            attempts = row['attempts'] + 1
+            retry = retry and attempts < row['max_attempts']
+            con.execute('UPDATE jobs SET state=?, attempts=?, next_attempt=?, finished=?, seconds=?, message=? '
+                        'WHERE batch_id=? AND stage=? AND cast_id=?',
+                        (PENDING if retry else FAILED, attempts, time.time() + get_backoff(attempts) if retry else 0,
+                         _now_string(), seconds, message, batch_id, stage, cast_id))
+        return retry
+
+    def cancel_batch(self, batch_id):
+        with self._transaction() as con:
+            con.execute('UPDATE jobs SET state=? WHERE batch_id=? AND state IN (?, ?)',
+                        (CANCELLED, batch_id, *UNFINISHED_STATES))
+
+    def get_jobs(self, batch_id, stage=None, states=None):
+        sql = 'SELECT * FROM jobs WHERE batch_id=?'
+        args = [batch_id]
+        if stage:
+            sql += ' AND stage=?'
+            args.append(stage)
+        if states:
+            sql += f' AND state IN ({", ".join("?" * len(states))})'
+            args.extend(states)
+        with self._transaction() as con:
+            return [dict(row) for row in con.execute(sql + ' ORDER BY id', args)]
+
+    def get_first_unfinished_stage(self, batch_id, stages):
+        """Returns (stage, jobs) for the first of the given stages (in order) that has pending or running
+        jobs in the batch. (None, []) if all stages are finished"""
+        for stage in stages:
+            unfinished = self.get_jobs(batch_id, stage=stage, states=UNFINISHED_STATES)
+            if unfinished:
+                return stage, unfinished
+        return None, []
+
+    def get_due_jobs(self, batch_id, stage):
+        """Returns the pending jobs that may be started now"""
+        return [job for job in self.get_jobs(batch_id, stage=stage, states=[PENDING])
+                if job['next_attempt'] <= time.time()]
+
+    def get_next_attempt(self, batch_id, stage):
+        """Returns the time of the next retry or None if no jobs are pending"""
+        jobs_pending = self.get_jobs(batch_id, stage=stage, states=[PENDING])
+        if not jobs_pending:
+            return None
+        return min([job['next_attempt'] for job in jobs_pending])
+
+    def get_batch(self, batch_id):
+        with self._transaction() as con:
+            row = con.execute('SELECT * FROM batches WHERE id=?', (batch_id,)).fetchone()
+        if not row:
+            return None
+        batch = dict(row)
+        batch['settings'] = json.loads(batch['settings'] or '{}')
+        return batch
+
+    def get_unfinished_batches(self, source=None):
+        """Returns the batches with pending or running jobs, oldest first"""
+        sql = ('SELECT DISTINCT batches.id FROM batches JOIN jobs ON jobs.batch_id = batches.id '
+               f'WHERE jobs.state IN ({", ".join("?" * len(UNFINISHED_STATES))})')
+        args = list(UNFINISHED_STATES)
+        if source:
+            sql += ' AND batches.source=?'
+            args.append(source)
+        with self._transaction() as con:
+            ids = [row['id'] for row in con.execute(sql + ' ORDER BY batches.created', args)]
+        return [self.get_batch(batch_id) for batch_id in ids]
+
+    def get_summary(self, batch_id):
+        """Returns a dict with stage as key and a dict with the number of jobs in each state as value"""
+        summary = {}
+        with self._transaction() as con:
+            for row in con.execute('SELECT stage, state, COUNT(*) AS nr FROM jobs WHERE batch_id=? '
+                                   'GROUP BY stage, state', (batch_id,)):
+                summary.setdefault(row['stage'], {})[row['state']] = row['nr']
+        return summary
+
+    @contextlib.contextmanager
+    def record_stage(self, batch_id, stage, cast_ids, max_attempts=MAX_ATTEMPTS):
+        """All casts get one job for the stage. The jobs are done if the block finishes, else failed (pending
+        with a backoff if the stage will be retried, see fail). A cancelled block leaves the jobs pending."""
+        cast_ids = list(cast_ids)
+        self.add_jobs(batch_id, stage, [(cast_id, '') for cast_id in cast_ids], max_attempts=max_attempts)
+        self.start(batch_id, stage, cast_ids)
+        t0 = time.perf_counter()
+        try:
+            yield
+        except jobs.JobCancelled:
+            with self._transaction() as con:
+                con.executemany('UPDATE jobs SET state=? WHERE batch_id=? AND stage=? AND cast_id=?',
+                                [(PENDING, batch_id, stage, cast_id) for cast_id in cast_ids])
+            raise
+        except Exception as e:
+            for cast_id in cast_ids:
+                self.fail(batch_id, stage, cast_id, message=str(e), seconds=time.perf_counter() - t0,
+                          retry=not isinstance(e, NOT_RETRIED_EXCEPTIONS))
+            raise
+        seconds = time.perf_counter() - t0
+        for cast_id in cast_ids:
+            self.finish(batch_id, stage, cast_id, seconds=seconds)
+
+
+def _wait_until(next_attempt, message=''):
+    """Sleeps until next_attempt (time.time()). Raises JobCancelled if the job is cancelled meanwhile."""
+    wait = next_attempt - time.time()
+    if wait > 0 and message:
+        jobs.report_progress(f'{message} in {int(wait)} s')
+    while wait > 0:
+        jobs.raise_if_cancelled()
+        time.sleep(min(wait, 0.5))
+        wait -= 0.5
+
+
+def run_stage(job_queue, batch_id, stage, cast_ids, func, *args, **kwargs):
+    """Returns func(*args, **kwargs) and records the stage for the casts in the queue. Used in the job
+    executor. If func fails the stage is run again after the backoff until the jobs have reached
+    MAX_ATTEMPTS. Nothing is recorded (and nothing retried) if job_queue is None."""
+    if job_queue is None:
+        return func(*args, **kwargs)
+    cast_ids = list(cast_ids)
+    while True:
+        try:
+            with job_queue.record_stage(batch_id, stage, cast_ids):
+                return func(*args, **kwargs)
+        except jobs.JobCancelled:
+            raise
+        except Exception as e:
+            pending = [job for job in job_queue.get_jobs(batch_id, stage=stage, states=[PENDING])
+                       if job['cast_id'] in cast_ids]
+            if not pending:
+                raise
+            next_attempt = min([job['next_attempt'] for job in pending])
+            logger.warning(f'Stage {stage} failed ({e}), retrying')
+            _wait_until(next_attempt, message=f'Retrying {stage}')
@@ -0,0 +1,224 @@
+import logging
+import queue
+import threading
+import traceback
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def get_current_job():
+    """Returns the job running in the current thread or None"""
+    return getattr(_local, 'job', None)
+
+
+def report_progress(*args):
+    """Reports progress for the job running in the current thread. Raises JobCancelled if the job is
+    cancelled. Does nothing when not called from a job (for example when running headless)."""
+    job = get_current_job()
+    if not job:
+        return
+    job.progress(*args)
+
+
+def raise_if_cancelled():
+    job = get_current_job()
+    if not job:
+        return
+    job.raise_if_cancelled()
+
+
+def get_progress_text(*args):
+    """(3, 10, 'file.hex') -> '3/10 file.hex'"""
+    args = list(args)
+    parts = []
+    if len(args) >= 2 and all([isinstance(item, int) for item in args[:2]]):
+        parts.append(f'{args.pop(0)}/{args.pop(0)}')
+    parts.extend([str(item) for item in args])
+    return ' '.join(parts)
+
+
+class Job:
+
+    def __init__(self, executor, func, args, kwargs, name='', on_result=None, on_error=None, on_progress=None,
+                 on_cancel=None, on_finish=None):
+        self._executor = executor
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.name = name or getattr(func, '__name__', '')
+        self.on_result = on_result
+        self.on_error = on_error
+        self.on_progress = on_progress
+        self.on_cancel = on_cancel
+        self.on_finish = on_finish
+        self.status = ''
+        self._cancel_event = threading.Event()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.name})'
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled(self.name)
+
+    def progress(self, *args):
+        self.raise_if_cancelled()
+        self._executor._put_message(self, 'progress', args)
+
+
+class JobExecutor:
+    """Runs jobs one at a time in a background thread. Callbacks (on_result, on_error, on_progress, on_cancel
+    and on_finish) are always called in the Tk main thread by polling a queue with widget.after()."""
+
+    def __init__(self, widget, poll_interval=100):
+        self._widget = widget
+        self._poll_interval = poll_interval
+        self._jobs = queue.Queue()
+        self._messages = queue.Queue()
+        self._pending = []
+        self._current_job = None
+        self._polling = False
+        self._status_callbacks = []
+        self._stopped = False
+        self._thread = threading.Thread(target=self._work, name='JobExecutor', daemon=True)
+        self._thread.start()
+
+    @property
+    def busy(self):
+        return bool(self._current_job or self._pending)
+
+    @property
+    def current_job(self):
+        return self._current_job
+
+    @property
+    def nr_queued(self):
+        return len(self._pending)
+
+    def add_status_callback(self, func):
+        """func is called with the executor as argument every time a job starts, ends or reports progress"""
+        self._status_callbacks.append(func)
+
+    def submit(self, func, *args, name='', on_result=None, on_error=None, on_progress=None, on_cancel=None,
+               on_finish=None, **kwargs):
+        """Queues func(*args, **kwargs) to run in the background thread. Returns the Job"""
+        job = Job(self, func, args, kwargs, name=name, on_result=on_result, on_error=on_error,
+                  on_progress=on_progress, on_cancel=on_cancel, on_finish=on_finish)
+        self._pending.append(job)
+        self._jobs.put(job)
+        self._start_polling()
+        self._notify_status()
+        return job
+
+    def cancel_all(self):
+        for job in self._pending:
+            job.cancel()
+        if self._current_job:
+            self._current_job.cancel()
+
+    def shutdown(self):
+        self._stopped = True
+        self.cancel_all()
+        self._jobs.put(None)
+
+    def _put_message(self, job, kind, data=None):
+        self._messages.put((job, kind, data))
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            if job.cancelled:
+                self._put_message(job, 'cancelled')
+                continue
+            self._put_message(job, 'started')
+            _local.job = job
+            try:
+                result = job.func(*job.args, **job.kwargs)
+                if job.cancelled:
+                    self._put_message(job, 'cancelled')
+                else:
+                    self._put_message(job, 'result', result)
+            except JobCancelled:
+                self._put_message(job, 'cancelled')
+            except Exception as e:
+                self._put_message(job, 'error', (e, traceback.format_exc()))
+            finally:
+                _local.job = None
+
+    def _start_polling(self):
+        if self._polling or self._stopped:
+            return
+        self._polling = True
+        self._widget.after(self._poll_interval, self._poll)
+
+    def _poll(self):
+        while True:
+            try:
+                job, kind, data = self._messages.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                self._handle_message(job, kind, data)
+            except Exception:
+                logger.critical(traceback.format_exc())
+        if self.busy and not self._stopped:
+            self._widget.after(self._poll_interval, self._poll)
+        else:
+            self._polling = False
+
+    def _handle_message(self, job, kind, data):
+        if kind == 'started':
+            self._current_job = job
+            if job in self._pending:
+                self._pending.remove(job)
+            self._notify_status()
+            return
+        if kind == 'progress':
+            job.status = get_progress_text(*data)
+            self._notify_status()
+            if job.on_progress:
+                job.on_progress(*data)
+            return
+
+        if job in self._pending:
+            self._pending.remove(job)
+        if job is self._current_job:
+            self._current_job = None
+        self._notify_status()
+
+        if kind == 'result':
+            if job.on_result:
+                job.on_result(data)
+        elif kind == 'cancelled':
+            logger.info(f'Job cancelled: {job}')
+            if job.on_cancel:
+                job.on_cancel()
+        elif kind == 'error':
+            exception, tb = data
+            logger.critical(tb)
+            if job.on_error:
+                job.on_error(exception, tb)
+        if job.on_finish:
+            job.on_finish()
+
+    def _notify_status(self):
+        for func in self._status_callbacks:
+            try:
+                func(self)
+            except Exception:
+                logger.critical(traceback.format_exc())
@@ -0,0 +1,157 @@
+"""
+Directory listing service. Listings are made with os.scandir and cached until the modification time of
+the directory changes (files added, removed or renamed).
+
+Call counts and call sites are only recorded when profiling is switched on (enable_profiling() or the
+environment variable SHARKTOOLS_PROFILE_LISTING=1). The metrics are bounded: at most max_stacks
+different directories and call sites are stored, the rest are counted as OTHER_STACK.
+"""
+import collections
+import logging
+import os
+import threading
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+PROFILE_ENVIRONMENT_VARIABLE = 'SHARKTOOLS_PROFILE_LISTING'
+MAX_STACKS = 50
+STACK_DEPTH = 4
+OTHER_STACK = '<other>'
+
+
+class ListingMetrics:
+
+    def __init__(self, max_stacks=MAX_STACKS):
+        self.max_stacks = max_stacks
+        self.reset()
+
+    def reset(self):
+        self.calls = collections.Counter()
+        self.stacks = collections.Counter()
+        self.nr_scans = 0
+        self.nr_cache_hits = 0
+        self.scan_seconds = 0
+
+    def add_call(self, directory, stack):
+        for counter, key in [(self.calls, directory), (self.stacks, stack)]:
+            if key not in counter and len(counter) >= self.max_stacks:
+                key = OTHER_STACK
+            counter[key] += 1
+
+    def as_dict(self):
+        return dict(nr_calls=sum(self.calls.values()),
+                    nr_scans=self.nr_scans,
+                    nr_cache_hits=self.nr_cache_hits,
+                    scan_seconds=self.scan_seconds,
+                    calls=dict(self.calls.most_common()),
+                    stacks=dict(self.stacks.most_common()))
+
+
+def _get_call_site():
+    """Returns the last STACK_DEPTH frames outside this module"""
+    stack = [frame for frame in traceback.extract_stack(limit=STACK_DEPTH + 8) if frame.filename != __file__]
+    return ' -> '.join([f'{os.path.basename(frame.filename)}:{frame.name}' for frame in stack[-STACK_DEPTH:]])
+
+
+class DirectoryListing:
+
+    def __init__(self, profiling=None, max_stacks=MAX_STACKS):
+        if profiling is None:
+            profiling = os.environ.get(PROFILE_ENVIRONMENT_VARIABLE) == '1'
+        self.profiling = profiling
+        self.metrics = ListingMetrics(max_stacks=max_stacks)
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _scan(self, directory):
+        t0 = time.perf_counter()
+        entries = {}
+        with os.scandir(directory) as it:
+            for entry in it:
+                try:
+                    entries[entry.name] = entry.is_file()
+                except OSError:
+                    continue
+        if self.profiling:
+            self.metrics.nr_scans += 1
+            self.metrics.scan_seconds += time.perf_counter() - t0
+        return entries
+
+    def _get_entries(self, directory):
+        directory = os.path.abspath(directory)
+        if self.profiling:
+            self.metrics.add_call(directory, _get_call_site())
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError):
+            with self._lock:
+                self._cache.pop(directory, None)
+            return {}
+        with self._lock:
+            cached = self._cache.get(directory)
+        if cached and cached[0] == mtime:
+            if self.profiling:
+                self.metrics.nr_cache_hits += 1
+            return cached[1]
+        entries = self._scan(directory)
+        with self._lock:
+            self._cache[directory] = (mtime, entries)
+        return entries
+
+    def list_directory(self, directory, files_only=False, suffix=None):
+        """Returns the sorted names in the directory. suffix can be a string or a list of suffixes"""
+        if isinstance(suffix, str):
+            suffix = [suffix]
+        names = []
+        for name, is_file in self._get_entries(directory).items():
+            if files_only and not is_file:
+                continue
+            if suffix and os.path.splitext(name)[1] not in suffix:
+                continue
+            names.append(name)
+        return sorted(names)
+
+    def list_files(self, directory, suffix=None):
+        return self.list_directory(directory, files_only=True, suffix=suffix)
+
+    def invalidate(self, directory=None):
+        with self._lock:
+            if directory is None:
+                self._cache = {}
+            else:
+                self._cache.pop(os.path.abspath(directory), None)
+
+    def get_metrics(self):
+        return self.metrics.as_dict()
+
+
+_listing = DirectoryListing()
+
+
+def get_listing():
+    """Returns the DirectoryListing shared by the plugin"""
+    return _listing
+
+
+def list_files(directory, suffix=None):
+    return _listing.list_files(directory, suffix=suffix)
+
+
+def list_directory(directory, files_only=False, suffix=None):
+    return _listing.list_directory(directory, files_only=files_only, suffix=suffix)
+
+
+def enable_profiling(reset=True):
+    if reset:
+        _listing.metrics.reset()
+    _listing.profiling = True
+
+
+def disable_profiling():
+    _listing.profiling = False
+
+
+def get_metrics():
+    return _listing.get_metrics()
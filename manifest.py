@@ -0,0 +1,379 @@
+"""
+Content-hash manifest used to skip casts that are unchanged since they were last processed.
+
+For each cast (id) and output (cnv, txt, asvp, plots) the manifest stores the hashes of the input files,
+the settings used and the hashes of the created files. An output is up to date if the inputs and settings
+are the same and the created files are unchanged.
+
+The config files are also used as a dependency graph: config file -> cnv/asvp -> txt -> plots.
+The config files recorded for a cast are the config files of its platform (see get_config_files) and the
+other files in the config root that processing read in a worker process (see batch.get_config_files).
+get_stale_casts() returns the casts that were processed with config files that have changed or been
+removed since, or for which a new config file has been added to the platform files after processing.
+
+The dependencies are always recorded. skip_unchanged=False (used when "incremental" is off) only turns off
+the skipping, is_up_to_date is then always False.
+
+Several processes (GUI, work queue workers on other machines) can share the manifest. save() takes a lock
+file and only writes the casts changed by this instance on top of the manifest on disk.
+"""
+import contextlib
+import datetime
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE_NAME = 'processing_manifest.json'
+
+OUTPUTS = ['cnv', 'txt', 'asvp', 'plots']
+
+# Raw files that are used together with the hex file
+RAW_SUFFIXES = ['.hex', '.xmlcon', '.hdr', '.bl']
+
+# Processing arguments that change the result
+PROCESSING_SETTINGS = ['platform', 'surfacesoak', 'tau', 'old_key']
+
+LOCK_TIMEOUT = 60
+# A lock file older than this is left by a process that died
+STALE_LOCK_SECONDS = 300
+
+
+def get_file_hash(path, chunk_size=1024 * 1024):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fid:
+        for chunk in iter(lambda: fid.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_cast_id(path):
+    """Same as pipeline.get_id_from_key but for a path"""
+    return Path(path).name.split('.')[0].split('_', 6)[-1].upper()
+
+
+def get_raw_files(hex_path):
+    """Returns the raw files (hex, xmlcon, hdr...) belonging to the given hex file"""
+    hex_path = Path(hex_path)
+    paths = []
+    for path in hex_path.parent.iterdir():
+        if path.stem != hex_path.stem:
+            continue
+        if path.suffix.lower() not in RAW_SUFFIXES:
+            continue
+        paths.append(path)
+    return sorted(paths)
+
+
+def get_config_files(config_root_directory, platform=None):
+    """Returns the config files used when processing for the given platform. These are the files in
+    directories named as the platform. If no such directory exists all psa files are returned."""
+    if not config_root_directory:
+        return []
+    root = Path(config_root_directory)
+    if not root.exists():
+        return []
+    paths = []
+    if platform:
+        for path in root.rglob('*'):
+            if not path.is_file():
+                continue
+            if platform.lower() in [part.lower() for part in path.relative_to(root).parts[:-1]]:
+                paths.append(path)
+    if not paths:
+        paths = list(root.rglob('*.psa'))
+    return sorted(paths)
+
+
+@contextlib.contextmanager
+def file_lock(path, timeout=LOCK_TIMEOUT):
+    """Holds <path>.lock (created with O_EXCL, works on network file systems) during the block"""
+    lock_path = Path(f'{path}.lock')
+    t0 = time.time()
+    while True:
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            pass
+        try:
+            if time.time() - lock_path.stat().st_mtime > STALE_LOCK_SECONDS:
+                logger.warning(f'Removing stale lock {lock_path}')
+                lock_path.unlink()
+                continue
+        except FileNotFoundError:
+            continue
+        if time.time() - t0 > timeout:
+            raise TimeoutError(f'Could not lock {path}')
+        time.sleep(0.1)
+    try:
+        yield
+    finally:
+        try:
+            lock_path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class Manifest:
+
+    def __init__(self, local_root_directory, config_root_directory=None, skip_unchanged=True):
+        self.local_root_directory = Path(local_root_directory)
+        self.config_root_directory = Path(config_root_directory) if config_root_directory else None
+        self.skip_unchanged = skip_unchanged
+        self.file_path = Path(self.local_root_directory, MANIFEST_FILE_NAME)
+        self._changed = set()
+        self._config_hashes = {}
+        self._file_hashes = {}
+        self.data = self._read()
+
+    def __contains__(self, cast_id):
+        return cast_id in self.data
+
+    def _read(self):
+        if not self.file_path.exists():
+            return {}
+        try:
+            with open(self.file_path) as fid:
+                return json.load(fid)
+        except json.JSONDecodeError:
+            logger.warning(f'Could not read manifest {self.file_path}. Starting with an empty manifest')
+            return {}
+
+    def save(self):
+        """Writes the casts changed by this instance into the manifest on disk (other processes might have
+        saved since it was read). The file is written to a temporary file that then replaces the old one."""
+        with file_lock(self.file_path):
+            data = self._read()
+            for cast_id in self._changed:
+                if cast_id in self.data:
+                    data[cast_id] = self.data[cast_id]
+                else:
+                    data.pop(cast_id, None)
+            tmp_path = self.file_path.with_suffix('.tmp')
+            with open(tmp_path, 'w') as fid:
+                json.dump(data, fid, indent=4, sort_keys=True)
+            os.replace(tmp_path, self.file_path)
+            self.data = data
+            self._changed = set()
+
+    def _get_path_key(self, path):
+        path = Path(path)
+        try:
+            return str(path.relative_to(self.local_root_directory))
+        except ValueError:
+            return str(path)
+
+    def _get_path(self, key):
+        path = Path(key)
+        if path.is_absolute():
+            return path
+        return Path(self.local_root_directory, path)
+
+    def _get_config_key(self, path):
+        path = Path(path)
+        if self.config_root_directory:
+            try:
+                return str(path.resolve().relative_to(self.config_root_directory.resolve()))
+            except ValueError:
+                pass
+        return str(path)
+
+    def _get_config_path(self, key):
+        path = Path(key)
+        if path.is_absolute() or not self.config_root_directory:
+            return path
+        return Path(self.config_root_directory, path)
+
+    def get_config_hashes(self, platform=None):
+        """Returns the hashes of the config files guessed from the platform (see get_config_files). Only used
+        for casts where the config files used are not known."""
+        if platform not in self._config_hashes:
+            self._config_hashes[platform] = self.get_config_file_hashes(
+                get_config_files(self.config_root_directory, platform))
+        return self._config_hashes[platform]
+
+    def get_config_file_hashes(self, paths):
+        """Returns a dict with the config key (path relative to the config root) as key and the hash as value.
+        Missing files are left out."""
+        hashes = {}
+        for path in paths:
+            path = Path(path)
+            if path not in self._file_hashes:
+                self._file_hashes[path] = get_file_hash(path) if path.is_file() else None
+            if self._file_hashes[path] is not None:
+                hashes[self._get_config_key(path)] = self._file_hashes[path]
+        return hashes
+
+    def get_used_config_files(self, cast_id):
+        """Returns the paths to the config files the cnv of the cast was built from"""
+        item = self.get_output(cast_id, 'cnv')
+        if not item:
+            return []
+        return [self._get_config_path(key) for key in sorted(item['inputs'].get('config', {}))]
+
+    def get_processing_inputs(self, hex_path, config_files=None, **processing_kwargs):
+        """Returns the inputs for the cnv (and asvp) output of the given hex file. config_files are the config
+        files used when processing. If not given, the files recorded the last time the cast was processed
+        are used, for a new cast the files are guessed from the platform."""
+        settings = {key: processing_kwargs.get(key) for key in PROCESSING_SETTINGS}
+        if config_files is None:
+            config_files = self.get_used_config_files(get_cast_id(hex_path))
+        if config_files:
+            config = self.get_config_file_hashes(config_files)
+        else:
+            config = self.get_config_hashes(settings.get('platform'))
+        return dict(files={path.name: get_file_hash(path) for path in get_raw_files(hex_path)},
+                    config=config,
+                    settings={key: str(value) for key, value in settings.items()})
+
+    @staticmethod
+    def get_file_inputs(path, **settings):
+        """Returns the inputs for an output made from one file (txt from cnv, plots from txt)"""
+        path = Path(path)
+        return dict(files={path.name: get_file_hash(path)},
+                    settings={key: str(value) for key, value in settings.items()})
+
+    def get_output(self, cast_id, output):
+        return self.data.get(cast_id, {}).get(output)
+
+    def get_output_paths(self, cast_id, output):
+        item = self.get_output(cast_id, output)
+        if not item:
+            return []
+        return [self._get_path(key) for key in item['paths']]
+
+    def is_up_to_date(self, cast_id, output, inputs):
+        """Returns True if the output of the cast was made from the same inputs and the created files
+        are unchanged. Always False if skip_unchanged is False."""
+        if not self.skip_unchanged:
+            return False
+        item = self.get_output(cast_id, output)
+        if not item:
+            return False
+        if item['inputs'] != inputs:
+            return False
+        for key, file_hash in item['paths'].items():
+            path = self._get_path(key)
+            if not path.exists():
+                return False
+            if get_file_hash(path) != file_hash:
+                return False
+        return True
+
+    def set_output(self, cast_id, output, inputs, paths):
+        if output not in OUTPUTS:
+            raise ValueError(f'Invalid output: {output}')
+        paths = [Path(path) for path in paths if path and Path(path).exists()]
+        self._changed.add(cast_id)
+        self.data.setdefault(cast_id, {})[output] = dict(
+            inputs=inputs,
+            paths={self._get_path_key(path): get_file_hash(path) for path in paths},
+            time=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        )
+
+    def update_output_paths(self, cast_id, output, paths):
+        """Updates the hashes of the created files without changing the inputs. Used when a file is
+        changed by a later step, for example automatic qc of the standard format file."""
+        item = self.get_output(cast_id, output)
+        if not item:
+            return
+        self.set_output(cast_id, output, item['inputs'], paths)
+
+    def set_source(self, cast_id, hex_path, raw_path=None):
+        """Stores where the hex file of the cast can be found, used when rebuilding stale casts"""
+        self._changed.add(cast_id)
+        item = self.data.setdefault(cast_id, {})
+        item['source'] = str(hex_path)
+        if raw_path:
+            item['raw'] = self._get_path_key(raw_path)
+
+    def get_hex_path(self, cast_id):
+        """Returns the path to the hex file of the cast. The local copy is used if the source file
+        is not found."""
+        item = self.data.get(cast_id, {})
+        for key in ['source', 'raw']:
+            if not item.get(key):
+                continue
+            path = self._get_path(item[key])
+            if path.exists():
+                return path
+        return None
+
+    def get_settings(self, cast_id):
+        item = self.get_output(cast_id, 'cnv')
+        if not item:
+            return {}
+        return item['inputs'].get('settings', {})
+
+    def get_dependencies(self, cast_id):
+        """Returns the config files (relative to the config root) that the outputs of the cast
+        were built from"""
+        item = self.get_output(cast_id, 'cnv')
+        if not item:
+            return []
+        return sorted(item['inputs'].get('config', {}))
+
+    def get_dependents(self, config_file):
+        """Returns a dict with the outputs (cnv, asvp, txt, plots) that depend on the given config file
+        (relative to the config root) for each cast id"""
+        config_file = str(Path(config_file))
+        dependents = {}
+        for cast_id, item in self.data.items():
+            if config_file not in self.get_dependencies(cast_id):
+                continue
+            dependents[cast_id] = [output for output in OUTPUTS if output in item]
+        return dependents
+
+    def get_added_config_files(self, cast_id):
+        """Returns the config files of the platform of the cast (see get_config_files) that are not recorded
+        for the cast and were modified after it was processed. A file copied with its old mtime is not
+        found."""
+        item = self.get_output(cast_id, 'cnv')
+        if not item or not item.get('time'):
+            return []
+        platform = item['inputs'].get('settings', {}).get('platform')
+        if platform in [None, '', 'None']:
+            platform = None
+        processed = datetime.datetime.strptime(item['time'], '%Y-%m-%d %H:%M:%S').timestamp()
+        recorded = item['inputs'].get('config', {})
+        added = []
+        for key in self.get_config_hashes(platform):
+            if key in recorded:
+                continue
+            path = self._get_config_path(key)
+            if path.exists() and path.stat().st_mtime > processed:
+                added.append(key)
+        return sorted(added)
+
+    def get_changed_config_files(self, cast_id):
+        """Returns the config files used for the cast that are changed or removed since it was processed,
+        and the config files added for its platform since (see get_added_config_files)"""
+        item = self.get_output(cast_id, 'cnv')
+        if not item:
+            return []
+        recorded = item['inputs'].get('config', {})
+        current = self.get_config_file_hashes(self.get_used_config_files(cast_id))
+        changed = [name for name in set(recorded) | set(current) if recorded.get(name) != current.get(name)]
+        return sorted(set(changed) | set(self.get_added_config_files(cast_id)))
+
+    def get_stale_casts(self):
+        """Returns a dict with cast id as key and the changed config files as value for all casts that
+        depends on changed config files"""
+        stale = {}
+        for cast_id in sorted(self.data):
+            changed = self.get_changed_config_files(cast_id)
+            if changed:
+                stale[cast_id] = changed
+        return stale
+
+    def remove(self, cast_id, output=None):
+        self._changed.add(cast_id)
+        if output:
+            self.data.get(cast_id, {}).pop(output, None)
+        else:
+            self.data.pop(cast_id, None)
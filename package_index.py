@@ -0,0 +1,299 @@
+"""
+Persistent index (SQLite) of the packages in a directory tree. Replaces repeated calls to
+file_explorer.get_packages_in_directory.
+
+Every file is stored with its mtime (ns) and size, every directory with its mtime. When a tree is indexed
+again only the directories with a changed mtime (files added, removed or renamed) are listed. The files
+of the other directories are taken from the index and checked with stat, since a file rewritten in place
+(for example a standard format file saved by VisQC) does not change the mtime of its directory. Only the
+packages with new, changed or removed files are parsed. Files are grouped on the id used in the rest of
+the plugin (see pipeline.get_id_from_key). For each package the key, id, serno, cruise, year, platform and the file
+paths for each suffix are stored, together with the pickled package.
+
+The index is stored in the local root directory (or in the user cache directory for trees outside it).
+"""
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import file_explorer
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE_NAME = 'package_index.sqlite'
+# Changed when the tables change, an index with another version is created again
+INDEX_VERSION = 2
+# Directories changed more recently than this are listed again next time. The mtime resolution of some
+# file systems (FAT, SMB) is too coarse to notice a change made in the same second as the scan.
+MTIME_MARGIN_SECONDS = 2
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def get_id_from_name(name):
+    """Same as pipeline.get_id_from_key"""
+    return name.split('.')[0].split('_', 6)[-1].upper()
+
+
+def get_index_file_path(local_root_directory=None):
+    if local_root_directory:
+        return Path(local_root_directory, INDEX_FILE_NAME)
+    return Path(utils.get_cache_directory(), INDEX_FILE_NAME)
+
+
+def get_package_index(local_root_directory=None):
+    """Returns a shared PackageIndex stored in the given local root directory (user cache directory if
+    not given)"""
+    file_path = str(get_index_file_path(local_root_directory))
+    with _lock:
+        if file_path not in _indexes:
+            _indexes[file_path] = PackageIndex(file_path)
+        return _indexes[file_path]
+
+
+def get_packs(directory, local_root_directory=None, **kwargs):
+    """Shortcut to get_package_index(local_root_directory).get_packs()"""
+    return get_package_index(local_root_directory).get_packs(directory, **kwargs)
+
+
+def _get_pack_attribute(pack, name):
+    try:
+        value = pack(name)
+    except Exception:
+        value = None
+    if value is None and name == 'year':
+        value = getattr(getattr(pack, 'datetime', None), 'year', None)
+    if value is None:
+        return ''
+    return str(value)
+
+
+def _get_scope(directory, exclude_directory=None):
+    return f'{os.path.abspath(directory)}::{exclude_directory or ""}'
+
+
+def scan_directory(directory, exclude_directory=None, known_dirs=None, known_files=None):
+    """Returns a dict with path as key and (mtime_ns, size) as value for all files in the tree and a dict
+    with the mtime (ns) of each directory. known_dirs (directory: mtime) and known_files (as returned) are
+    from an earlier scan. Directories with unchanged mtime are not listed, their subdirectories are taken
+    from known_dirs and their files from known_files (with a new stat of each file)."""
+    known_dirs = known_dirs or {}
+    known_files = known_files or {}
+    known_children = {}
+    for path in known_dirs:
+        known_children.setdefault(os.path.dirname(path), []).append(path)
+    known_dir_files = {}
+    for path, stat in known_files.items():
+        known_dir_files.setdefault(os.path.dirname(path), {})[path] = stat
+    files = {}
+    dirs = {}
+    now_ns = time.time_ns()
+    stack = [os.path.abspath(directory)]
+    while stack:
+        current = stack.pop()
+        try:
+            mtime_ns = os.stat(current).st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+        if now_ns - mtime_ns < MTIME_MARGIN_SECONDS * 1e9:
+            # Not trusted, see MTIME_MARGIN_SECONDS
+            dirs[current] = None
+        else:
+            dirs[current] = mtime_ns
+            if known_dirs.get(current) == mtime_ns:
+                for path in known_dir_files.get(current, {}):
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    files[path] = (stat.st_mtime_ns, stat.st_size)
+                stack.extend(known_children.get(current, []))
+                continue
+        try:
+            entries = list(os.scandir(current))
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+        for entry in entries:
+            if entry.is_dir():
+                if exclude_directory and entry.name == exclude_directory:
+                    continue
+                stack.append(entry.path)
+            elif entry.is_file() and not entry.name.startswith(INDEX_FILE_NAME):
+                stat = entry.stat()
+                files[entry.path] = (stat.st_mtime_ns, stat.st_size)
+    return files, dirs
+
+
+class PackageIndex:
+
+    def __init__(self, file_path=None):
+        self.file_path = Path(file_path or get_index_file_path())
+        self.file_path.parent.mkdir(parents=True, exist_ok=True)
+        self._create_tables()
+
+    def _connect(self):
+        return sqlite3.connect(str(self.file_path), timeout=30)
+
+    def _create_tables(self):
+        with self._connect() as con:
+            if con.execute('PRAGMA user_version').fetchone()[0] != INDEX_VERSION:
+                for table in ['files', 'packs', 'dirs']:
+                    con.execute(f'DROP TABLE IF EXISTS {table}')
+                con.execute(f'PRAGMA user_version = {INDEX_VERSION}')
+            con.execute('CREATE TABLE IF NOT EXISTS files ('
+                        'scope TEXT, old_key INTEGER, path TEXT, mtime_ns INTEGER, size INTEGER, '
+                        'PRIMARY KEY (scope, old_key, path))')
+            con.execute('CREATE TABLE IF NOT EXISTS packs ('
+                        'scope TEXT, old_key INTEGER, pack_key TEXT, id TEXT, serno TEXT, cruise TEXT, '
+                        'year TEXT, platform TEXT, paths TEXT, data BLOB, '
+                        'PRIMARY KEY (scope, old_key, pack_key))')
+            con.execute('CREATE INDEX IF NOT EXISTS packs_id ON packs (scope, old_key, id)')
+            con.execute('CREATE TABLE IF NOT EXISTS dirs ('
+                        'scope TEXT, old_key INTEGER, path TEXT, mtime_ns INTEGER, '
+                        'PRIMARY KEY (scope, old_key, path))')
+        con.close()
+
+    def update(self, directory, exclude_directory=None, old_key=False):
+        """Updates the index for the given tree. Returns the number of parsed packages."""
+        scope = _get_scope(directory, exclude_directory)
+        old_key = int(bool(old_key))
+        con = self._connect()
+        try:
+            stored = {path: (mtime_ns, size) for path, mtime_ns, size in con.execute(
+                'SELECT path, mtime_ns, size FROM files WHERE scope=? AND old_key=?', (scope, old_key))}
+            stored_dirs = {path: mtime_ns for path, mtime_ns in con.execute(
+                'SELECT path, mtime_ns FROM dirs WHERE scope=? AND old_key=?', (scope, old_key))}
+            current, current_dirs = scan_directory(directory, exclude_directory=exclude_directory,
+                                                   known_dirs=stored_dirs, known_files=stored)
+            if current_dirs != stored_dirs:
+                with con:
+                    con.execute('DELETE FROM dirs WHERE scope=? AND old_key=?', (scope, old_key))
+                    con.executemany('INSERT INTO dirs VALUES (?, ?, ?, ?)',
+                                    [(scope, old_key, path, mtime_ns) for path, mtime_ns in current_dirs.items()])
+            changed = [path for path, stat in current.items() if stored.get(path) != stat]
+            removed = [path for path in stored if path not in current]
+            if not changed and not removed:
+                return 0
+
+            affected_ids = {get_id_from_name(Path(path).name) for path in changed + removed}
+            changed_paths = set(changed + removed)
+            affected_keys = []
+            for pack_key, _id, paths in con.execute('SELECT pack_key, id, paths FROM packs WHERE scope=? AND old_key=?',
+                                                    (scope, old_key)):
+                pack_paths = {path for paths in json.loads(paths).values() for path in paths}
+                if _id in affected_ids or pack_paths & changed_paths:
+                    affected_keys.append(pack_key)
+                    affected_ids.add(_id)
+            paths_to_parse = [path for path in current if get_id_from_name(Path(path).name) in affected_ids]
+            packs = []
+            if paths_to_parse:
+                packs = file_explorer.get_packages_from_file_list([Path(path) for path in paths_to_parse],
+                                                                  instrument_type='sbe', as_list=True,
+                                                                  old_key=bool(old_key))
+            with con:
+                con.executemany('DELETE FROM packs WHERE scope=? AND old_key=? AND pack_key=?',
+                                [(scope, old_key, key) for key in affected_keys])
+                con.executemany('INSERT OR REPLACE INTO packs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                [self._get_pack_row(scope, old_key, pack) for pack in packs])
+                con.executemany('DELETE FROM files WHERE scope=? AND old_key=? AND path=?',
+                                [(scope, old_key, path) for path in removed])
+                con.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                                [(scope, old_key, path, *current[path]) for path in changed])
+            logger.debug(f'Package index {directory}: {len(changed)} changed and {len(removed)} removed files, '
+                         f'{len(packs)} packages parsed')
+            return len(packs)
+        finally:
+            con.close()
+
+    @staticmethod
+    def _get_pack_row(scope, old_key, pack):
+        paths = {}
+        for file in pack.files:
+            paths.setdefault(file.suffix, []).append(str(getattr(file, 'path', file)))
+        try:
+            data = pickle.dumps(pack)
+        except Exception:
+            data = None
+        return (scope, old_key, pack.key, get_id_from_name(pack.key),
+                _get_pack_attribute(pack, 'serno'), _get_pack_attribute(pack, 'cruise'),
+                _get_pack_attribute(pack, 'year'), _get_pack_attribute(pack, 'platform'),
+                json.dumps(paths), data)
+
+    def query(self, directory, exclude_directory=None, old_key=False, ids=None, cruise=None, year=None, serno=None,
+              update=True):
+        """Returns the rows (dicts) of the matching packages. The index is updated first if update=True"""
+        if update:
+            self.update(directory, exclude_directory=exclude_directory, old_key=old_key)
+        sql = ('SELECT pack_key, id, serno, cruise, year, platform, paths, data FROM packs '
+               'WHERE scope=? AND old_key=?')
+        args = [_get_scope(directory, exclude_directory), int(bool(old_key))]
+        for column, values in dict(id=ids, cruise=cruise, year=year, serno=serno).items():
+            if values is None:
+                continue
+            if isinstance(values, str):
+                values = [values]
+            values = [str(value).upper() if column == 'id' else str(value) for value in values]
+            if not values:
+                return []
+            sql += f' AND {column} IN ({", ".join("?" * len(values))})'
+            args.extend(values)
+        sql += ' ORDER BY pack_key'
+        con = self._connect()
+        try:
+            rows = []
+            for pack_key, _id, serno, cruise, year, platform, paths, data in con.execute(sql, args):
+                rows.append(dict(key=pack_key, id=_id, serno=serno, cruise=cruise, year=year, platform=platform,
+                                 paths=json.loads(paths), data=data))
+            return rows
+        finally:
+            con.close()
+
+    def get_packs(self, directory, exclude_directory=None, old_key=False, as_list=True, **filters):
+        """Same result as file_explorer.get_packages_in_directory but from the index. Can be filtered on
+        ids, cruise, year and serno."""
+        rows = self.query(directory, exclude_directory=exclude_directory, old_key=old_key, **filters)
+        packs = []
+        paths_to_parse = []
+        for row in rows:
+            pack = None
+            if row['data']:
+                try:
+                    pack = pickle.loads(row['data'])
+                except Exception:
+                    pack = None
+            if pack is None:
+                paths_to_parse.extend([Path(path) for paths in row['paths'].values() for path in paths])
+                continue
+            packs.append(pack)
+        if paths_to_parse:
+            packs.extend(file_explorer.get_packages_from_file_list(paths_to_parse, instrument_type='sbe',
+                                                                   as_list=True, old_key=old_key))
+        packs = sorted(packs, key=lambda pack: pack.key)
+        if as_list:
+            return packs
+        return {pack.key: pack for pack in packs}
+
+    def clear(self, directory=None, exclude_directory=None):
+        """Removes the given tree (or everything) from the index"""
+        con = self._connect()
+        try:
+            with con:
+                if directory is None:
+                    con.execute('DELETE FROM files')
+                    con.execute('DELETE FROM packs')
+                    con.execute('DELETE FROM dirs')
+                    return
+                scope = _get_scope(directory, exclude_directory)
+                con.execute('DELETE FROM files WHERE scope=?', (scope,))
+                con.execute('DELETE FROM packs WHERE scope=?', (scope,))
+                con.execute('DELETE FROM dirs WHERE scope=?', (scope,))
+        finally:
+            con.close()
@@ -0,0 +1,866 @@
+"""
+The processing chain used by PageSimple, without any dependency to tkinter:
+process -> standard format -> automatic qc -> plots -> copy to server.
+"""
+import concurrent.futures
+import copy
+import errno
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+import traceback
+from pathlib import Path
+
+import ctd_processing
+import file_explorer
+import yaml
+from ctdpy.core import session as ctdpy_session
+from ctdpy.core.utils import get_reversed_dictionary
+from profileqc import qc
+from sharkpylib.plot import create_seabird_like_plots_for_package
+
+from . import batch
+from . import jobs
+from . import manifest
+from . import package_index
+from . import qc_cache
+from . import qc_index
+from . import server_copy
+
+logger = logging.getLogger(__name__)
+
+# Upper limit when waiting for files written in threads by ctdpy
+WRITER_TIMEOUT = 120
+# Interval when waiting for output files (see wait_for_output_files)
+WRITER_POLL_SECONDS = 0.5
+
+QC_LOG_FILE_NAME = 'automatic_qc_log.yaml'
+# Number of standard format files read into memory at a time in automatic qc
+QC_CHUNK_SIZE = 5
+
+STAGES = ['process', 'standard_format', 'automatic_qc', 'plots', 'copy_to_server']
+
+
+def get_id_from_key(key):
+    return key.split('.')[0].split('_', 6)[-1].upper()
+
+
+def get_year_from_key(key):
+    """Returns the year (str) in the date part of the key or None if the key can not be parsed"""
+    try:
+        year = key.split('_')[2][:4]
+        int(year)
+    except (IndexError, ValueError):
+        return None
+    if len(year) != 4:
+        return None
+    return year
+
+
+class StageTimer:
+    """Keeps track of time and outcome for each stage in a run"""
+
+    def __init__(self):
+        self.stages = {}
+        self.failed = []
+
+    def __call__(self, stage):
+        return _Stage(self, stage)
+
+    def add_failed(self, stage, item, message):
+        self.failed.append(dict(stage=stage, item=str(item), message=message))
+
+    def get_summary(self, **kwargs):
+        summary = dict(kwargs)
+        summary['stages'] = self.stages
+        summary['total_seconds'] = round(sum([item['seconds'] for item in self.stages.values()]), 3)
+        summary['failed'] = self.failed
+        return summary
+
+
+class _Stage:
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.nr_items = 0
+        self._t0 = None
+
+    def __enter__(self):
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        seconds = time.perf_counter() - self._t0
+        # A stage can be run several times, for example once per year
+        item = self.timer.stages.setdefault(self.name, dict(seconds=0, nr_items=0))
+        item['seconds'] = round(item['seconds'] + seconds, 3)
+        item['nr_items'] += self.nr_items
+        logger.info(f'Stage {self.name}: {self.nr_items} items in {seconds:.2f} s')
+
+
+_writer_threads = threading.local()
+
+
+def _start_writer_thread(call_function, *args, **kwargs):
+    """Replaces ctdpy.core.utils.thread_process. Same behaviour, but the thread is recorded for the
+    call_with_writer_future running in the calling thread."""
+    thread = threading.Thread(target=call_function, args=args, kwargs=kwargs)
+    thread.start()
+    threads = getattr(_writer_threads, 'threads', None)
+    if threads is not None:
+        threads.append(thread)
+
+
+def _track_writer_threads():
+    """ctdpy writes files with utils.thread_process that does not return the thread. The function is
+    replaced in ctdpy.core.utils and in the ctdpy modules that have imported it by name. This depends on
+    the name in ctdpy, see the fallback in call_with_writer_future."""
+    for name, module in list(sys.modules.items()):
+        if not name.startswith('ctdpy') or module is None:
+            continue
+        func = getattr(module, 'thread_process', None)
+        if func is not None and func is not _start_writer_thread:
+            module.thread_process = _start_writer_thread
+
+
+def wait_for_output_files(directory, ids, suffix='.txt', timeout=WRITER_TIMEOUT):
+    """Waits until directory has a file with the given suffix for each of the cast ids and the sizes of the
+    files are unchanged since the last check. Returns False if this is not the case within timeout
+    seconds."""
+    ids = {str(_id).upper() for _id in ids}
+    stop = time.time() + timeout
+    previous = None
+    while time.time() < stop:
+        sizes = {}
+        if Path(directory).exists():
+            for path in Path(directory).iterdir():
+                if path.suffix == suffix and get_id_from_key(path.name) in ids:
+                    sizes[path.name] = path.stat().st_size
+        if {get_id_from_key(name) for name in sizes} >= ids and sizes == previous:
+            return True
+        previous = sizes
+        time.sleep(WRITER_POLL_SECONDS)
+    return False
+
+
+def call_with_writer_future(func, *args, wait_for_output=None, **kwargs):
+    """Calls func(*args, **kwargs) and returns a Future that is done when func has returned and all
+    threads that ctdpy started from this thread during the call (ctdpy writes files in threads) have
+    finished. The result of the future is the return value of func.
+    ctdpy does not return the writer threads, they are captured by replacing thread_process in ctdpy (see
+    _track_writer_threads). If no thread is captured (ctdpy wrote the files in the calling thread or the
+    function has been renamed) wait_for_output(result) is called, if given, to wait for the expected output
+    files (see wait_for_output_files)."""
+    future = concurrent.futures.Future()
+    _track_writer_threads()
+    previous = getattr(_writer_threads, 'threads', None)
+    _writer_threads.threads = []
+    try:
+        result = func(*args, **kwargs)
+        threads = _writer_threads.threads
+    finally:
+        _writer_threads.threads = previous
+    if previous is not None:
+        previous.extend(threads)
+    if not threads and not wait_for_output:
+        future.set_result(result)
+        return future
+
+    def wait():
+        if not threads and not wait_for_output(result):
+            logger.warning(f'Output files of {getattr(func, "__name__", func)} not found after {WRITER_TIMEOUT} s')
+        for thread in threads:
+            thread.join(WRITER_TIMEOUT)
+            if thread.is_alive():
+                logger.warning(f'Thread {thread.name} still running after {WRITER_TIMEOUT} seconds')
+        future.set_result(result)
+
+    threading.Thread(target=wait, name='WriterFuture', daemon=True).start()
+    return future
+
+
+def get_unprocessed_hex_paths(file_handler, year):
+    """Returns the hex files in the source directory (for the given year) that are neither found
+    locally nor on the server. This is the default selection in PageSimple."""
+    local_files = file_handler.get_file_names('local', 'raw', suffixes=['.hex'])
+    try:
+        server_files = file_handler.get_file_names('server', 'raw', suffixes=['.hex'])
+    except Exception:
+        server_files = []
+    local_serno = {get_id_from_key(item): True for item in local_files}
+    server_serno = {get_id_from_key(item): True for item in server_files}
+    paths = []
+    for path in file_handler.get_files('source', 'root').values():
+        if path.suffix != '.hex':
+            continue
+        if get_year_from_key(path.name) != str(year):
+            continue
+        serno = get_id_from_key(path.name)
+        if local_serno.get(serno) or server_serno.get(serno):
+            continue
+        paths.append(path)
+    return sorted(paths)
+
+
+def get_packs_for_ids(directory, ids, old_key=False, local_root_directory=None):
+    """local_root_directory is where the package index is stored, see package_index.py"""
+    return package_index.get_packs(directory, ids=ids, old_key=old_key, local_root_directory=local_root_directory)
+
+
+def _create_standard_format_for_packs(packs, file_handler, old_key=False, **kwargs):
+    """Creates standard format for the packages with ctd_processing and returns when all files are written
+    to the local data directory of file_handler"""
+    data_directory = file_handler.get_dir('local', 'data')
+    ids = [_get_cnv_id(pack) for pack in packs]
+    call_with_writer_future(ctd_processing.create_standard_format_for_packages,
+                            packs,
+                            file_handler=file_handler,
+                            sharkweb_btl_row_file=None,
+                            old_key=old_key,
+                            wait_for_output=lambda result: wait_for_output_files(data_directory, ids),
+                            **kwargs).result()
+
+
+def _create_standard_format_for_files(cnv_paths, year=None, root_dirs=None, old_key=False, **kwargs):
+    handler = batch.create_file_handler(year, root_dirs or {})
+    packs = file_explorer.get_packages_from_file_list([Path(path) for path in cnv_paths], instrument_type='sbe',
+                                                      as_list=True, old_key=old_key)
+    _create_standard_format_for_packs(packs, handler, old_key=old_key, **kwargs)
+    return cnv_paths
+
+
+def _get_cnv_id(pack):
+    return get_id_from_key(Path(pack['cnv']).name)
+
+
+def create_standard_format(packs, file_handler, year=None, root_dirs=None, nr_workers=1, old_key=False,
+                           timer=None, manifest=None, **kwargs):
+    """Creates standard format files for the given cnv packages. With more than one worker the packages
+    are split between worker processes, each with its own file handler (requires year and root_dirs).
+    If a manifest is given, packages with unchanged cnv files since the last run are skipped.
+    Returns when all files are written and the local files of file_handler are updated.
+    Returns the packages that standard format was created for."""
+    inputs = {}
+    if manifest:
+        inputs = {_get_cnv_id(pack): manifest.get_file_inputs(pack['cnv'], old_key=old_key) for pack in packs}
+        packs = [pack for pack in packs if not manifest.is_up_to_date(_get_cnv_id(pack), 'txt',
+                                                                      inputs[_get_cnv_id(pack)])]
+    if not packs:
+        return packs
+    failed = []
+    if nr_workers == 1 or len(packs) <= 1:
+        _create_standard_format_for_packs(packs, file_handler, old_key=old_key, **kwargs)
+    else:
+        cnv_chunks = batch.split_in_chunks([str(pack['cnv']) for pack in packs], nr_workers)
+        for chunk, result, exception in batch.run_in_processes(_create_standard_format_for_files, cnv_chunks,
+                                                               nr_workers=nr_workers, year=year,
+                                                               root_dirs=root_dirs, old_key=old_key, **kwargs):
+            if not exception:
+                continue
+            if timer is None:
+                raise exception
+            for path in chunk:
+                timer.add_failed('standard_format', path, str(exception))
+                failed.append(get_id_from_key(Path(path).name))
+    file_handler.store_files('local')
+    if manifest:
+        ids = [_get_cnv_id(pack) for pack in packs if _get_cnv_id(pack) not in failed]
+        for pack in get_packs_for_ids(file_handler.get_dir('local', 'data'), ids, old_key=old_key,
+                                      local_root_directory=manifest.local_root_directory):
+            _id = get_id_from_key(Path(pack['txt']).name)
+            manifest.set_output(_id, 'txt', inputs[_id], [pack['txt']])
+        manifest.save()
+    return packs
+
+
+def create_standard_format_for_cnv_files(cnv_paths, file_handler, old_key=False, **kwargs):
+    """Same as create_standard_format but takes paths to cnv files"""
+    packs = file_explorer.get_packages_from_file_list(cnv_paths, instrument_type='sbe', as_list=True,
+                                                      old_key=old_key)
+    return create_standard_format(packs, file_handler, old_key=old_key, **kwargs)
+
+
+def save_data(session, datasets, save_path):
+    """Saves the datasets in standard format using the ctdpy session. Returns a Future with the
+    data path as result. The Future is done when all files are written."""
+    ids = [get_id_from_key(name) for name in datasets[0]]
+    future = call_with_writer_future(session.save_data,
+                                     datasets,
+                                     writer='ctd_standard_template', return_data_path=True,
+                                     save_path=save_path,
+                                     wait_for_output=lambda data_path: wait_for_output_files(data_path, ids))
+    path_future = concurrent.futures.Future()
+    future.add_done_callback(lambda f: path_future.set_result(Path(f.result())))
+    return path_future
+
+
+def _run_automatic_qc_on_files(file_paths, temp_directory, use_cache=True, local_root_directory=None):
+    """Runs automatic qc on the given standard format files with one SessionQC. Datasets with data and qc
+    configuration found in the qc cache (see qc_cache.py) get the cached flags instead. The log of each
+    dataset is written separately (so that it can be cached) and merged into one qc log. The qc log and
+    the qc-files are written to temp_directory. The qc cache is stored in local_root_directory.
+    Returns the directory with the qc-files."""
+    session = ctdpy_session.Session(filepaths=[str(path) for path in file_paths],
+                                    reader='ctd_stdfmt')
+
+    datasets = session.read()
+    qc_session = qc.SessionQC(None)
+    cache = qc_cache.get_qc_cache(local_root_directory) if use_cache else None
+
+    logs = []
+    for nr, (dset_name, item) in enumerate(datasets[0].items()):
+        data_hash = None
+        cached = None
+        if cache:
+            data_hash = qc_cache.get_data_hash(item['data'], name=dset_name)
+            cached = cache.get(data_hash)
+        nr_metadata = len(item['metadata'])
+        parameter_mapping = get_reversed_dictionary(session.settings.pmap, item['data'].keys())
+        qc_session.update_data(item,
+                               parameter_mapping=parameter_mapping,
+                               dataset_name=dset_name)
+        if cached:
+            cached.apply(item, qc_session)
+            logs.append(cached.log)
+            continue
+        qc_session.run()
+        log_path = Path(temp_directory, f'qc_log_{nr}.yaml')
+        qc_session.write_log(log_path, reset_log=True)
+        log = _read_qc_log(log_path)
+        log_path.unlink()
+        logs.append(log)
+        if cache:
+            cache.put(data_hash, qc_cache.QcResult.from_item(item, nr_metadata, log))
+    if cache:
+        logger.info(f'QC cache: {cache.get_summary()}')
+
+    _write_qc_log(merge_qc_log_data(logs), Path(temp_directory, QC_LOG_FILE_NAME))
+
+    return save_data(session, datasets, temp_directory).result()
+
+
+def replace_file(source_path, target_path):
+    """Moves source_path to target_path (overwriting it) with an atomic rename, so that readers of
+    target_path (VisQC, copy to server...) see either the old or the new file and never a partly written
+    one. If the paths are on different file systems the file is first copied to a temporary name next to
+    target_path."""
+    try:
+        os.replace(source_path, target_path)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    temp_path = server_copy.get_temp_path(target_path)
+    try:
+        shutil.copyfile(source_path, temp_path)
+        os.replace(temp_path, target_path)
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+    os.remove(source_path)
+
+
+def _replace_files(data_path, data_directory, overwrite=True):
+    """Moves the files in data_path into data_directory with replace_file. Returns the new paths."""
+    target_paths = []
+    for source_path in Path(data_path).iterdir():
+        target_path = Path(data_directory, source_path.name)
+        if target_path.exists() and not overwrite:
+            continue
+        replace_file(source_path, target_path)
+        target_paths.append(target_path)
+    return target_paths
+
+
+def _run_automatic_qc_shard(shard, temp_directory=None, data_directory=None, overwrite=True,
+                            chunk_size=QC_CHUNK_SIZE, use_cache=True, local_root_directory=None):
+    """Runs automatic qc on the files of the shard, chunk_size files at a time. shard is (shard number,
+    file paths). Each chunk is read, checked and moved into data_directory before the next chunk is read,
+    so memory use depends on chunk_size and not on the number of files. Each shard gets its own temp
+    directory so that shards in parallel processes are kept apart. The temp directory should be on the
+    same file system as data_directory (local/temp and local/data are) so that the files are moved with a
+    rename and not copied.
+    Returns the paths to the qc-files in data_directory and the paths to the logs of the chunks."""
+    nr, file_paths = shard
+    if not file_paths:
+        return [], []
+    shard_directory = Path(temp_directory, f'qc_shard_{nr}')
+    if shard_directory.exists():
+        shutil.rmtree(shard_directory)
+    chunk_size = max(1, chunk_size or len(file_paths))
+    target_paths = []
+    log_paths = []
+    for i in range(0, len(file_paths), chunk_size):
+        chunk_directory = Path(shard_directory, f'chunk_{i // chunk_size}')
+        chunk_directory.mkdir(parents=True)
+        data_path = _run_automatic_qc_on_files(file_paths[i:i + chunk_size], chunk_directory, use_cache=use_cache,
+                                               local_root_directory=local_root_directory)
+        target_paths.extend(_replace_files(data_path, data_directory, overwrite=overwrite))
+        shutil.rmtree(data_path)
+        log_paths.append(Path(chunk_directory, QC_LOG_FILE_NAME))
+        jobs.report_progress(min(i + chunk_size, len(file_paths)), len(file_paths))
+    return target_paths, log_paths
+
+
+def _merge_qc_log_items(target, source):
+    for key, value in source.items():
+        if isinstance(target.get(key), dict) and isinstance(value, dict):
+            _merge_qc_log_items(target[key], value)
+        elif isinstance(target.get(key), list) and isinstance(value, list):
+            target[key].extend(value)
+        else:
+            target[key] = value
+
+
+def _read_qc_log(path):
+    if not Path(path).exists():
+        return None
+    with open(path, encoding='utf-8') as fid:
+        return yaml.safe_load(fid)
+
+
+def _write_qc_log(log, path):
+    with open(path, 'w', encoding='utf-8') as fid:
+        yaml.safe_dump(log or {}, fid, allow_unicode=True, sort_keys=False)
+
+
+def merge_qc_log_data(logs):
+    """Merges qc logs (loaded yaml). Dicts are merged per key and lists are concatenated."""
+    merged = None
+    for log in logs:
+        if not log:
+            continue
+        if merged is None:
+            merged = copy.deepcopy(log)
+        elif isinstance(merged, dict):
+            _merge_qc_log_items(merged, log)
+        else:
+            merged.extend(log)
+    return merged
+
+
+def merge_qc_logs(log_paths, target_path):
+    """Merges the qc logs written by the shards into one log file"""
+    _write_qc_log(merge_qc_log_data([_read_qc_log(path) for path in log_paths]), target_path)
+
+
+def run_automatic_qc(file_paths, file_handler, overwrite=True, temp_directory=None, manifest=None, nr_workers=1,
+                     chunk_size=QC_CHUNK_SIZE, use_cache=True, local_root_directory=None):
+    """Runs automatic qc on the given standard format files. The files are read, checked and written
+    chunk_size files at a time (all at once if chunk_size is None) to the local temp directory (or
+    temp_directory) and then renamed into the local data directory, replacing the old files atomically.
+    Returns the paths to the qc-files in local data.
+    If a manifest is given the hashes of the standard format files are updated.
+    With more than one worker the files are split between worker processes, each with its own SessionQC.
+    The logs of all chunks are merged into automatic_qc_log.yaml in the temp directory.
+    Results are taken from the qc cache (qc_cache.py) in local_root_directory (the user cache directory if
+    not given) for unchanged data unless use_cache is False."""
+    temp_directory = temp_directory or file_handler.get_dir('local', 'temp')
+    data_directory = file_handler.get_dir('local', 'data')
+    file_paths = list(file_paths)
+    nr_workers = nr_workers or 1
+    kwargs = dict(temp_directory=str(temp_directory), data_directory=str(data_directory), overwrite=overwrite,
+                  chunk_size=chunk_size, use_cache=use_cache, local_root_directory=local_root_directory)
+    shards = list(enumerate(batch.split_in_chunks(file_paths, nr_workers)))
+    results = {}
+    if len(shards) == 1:
+        results[0] = _run_automatic_qc_shard(shards[0], **kwargs)
+    else:
+        logger.info(f'Running automatic qc on {len(file_paths)} files in {len(shards)} processes')
+        for shard, result, exception in batch.run_in_processes(_run_automatic_qc_shard, shards,
+                                                               nr_workers=nr_workers, **kwargs):
+            if exception:
+                raise exception
+            results[shard[0]] = result
+    target_paths = []
+    log_paths = []
+    for nr in sorted(results):
+        target_paths.extend(results[nr][0])
+        log_paths.extend(results[nr][1])
+    merge_qc_logs(log_paths, Path(temp_directory, QC_LOG_FILE_NAME))
+    for nr, paths in shards:
+        shutil.rmtree(Path(temp_directory, f'qc_shard_{nr}'), ignore_errors=True)
+    qc_index.get_qc_index(local_root_directory).update(target_paths)
+    if manifest:
+        for path in target_paths:
+            manifest.update_output_paths(get_id_from_key(path.name), 'txt', [path])
+        manifest.save()
+    return target_paths
+
+
+class CastResult:
+    """Outcome of standard format and automatic qc for one processed cast"""
+
+    def __init__(self, path, status, qc_path=None, message=''):
+        self.path = Path(path)
+        self.status = status
+        self.qc_path = qc_path
+        self.message = message
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.path.name}, {self.status})'
+
+    @property
+    def id(self):
+        return get_id_from_key(self.path.name)
+
+    @property
+    def ok(self):
+        return self.status == batch.STATUS_OK
+
+
+def _create_standard_format_in_staging_directory(cnv_packs, handler, staging_directory, year=None, root_dirs=None,
+                                                 old_key=False):
+    """Creates standard format for the packages with staging_directory as local root and renames the files
+    into the local data directory of handler (see replace_file). A worker that stops while ctdpy writes
+    never leaves a partly written file in local data. Returns the paths in local data."""
+    staging_handler = batch.create_file_handler(year, {**(root_dirs or {}), 'local': str(staging_directory)})
+    _create_standard_format_for_packs(cnv_packs, staging_handler, old_key=old_key)
+    return _replace_files(staging_handler.get_dir('local', 'data'), handler.get_dir('local', 'data'))
+
+
+def prepare_cast_for_manual_qc(hex_path, year=None, root_dirs=None, old_key=False):
+    """Creates standard format and runs automatic qc for one processed cast. Both stages write to the
+    local temp directory and rename the finished files into local data. Runs in a worker process and
+    never raises."""
+    _id = get_id_from_key(Path(hex_path).name)
+    try:
+        handler = batch.get_file_handler(year, root_dirs or {})
+        handler.store_files('local')
+        cnv_packs = get_packs_for_ids(handler.get_dir('local', 'cnv'), [_id], old_key=old_key,
+                                      local_root_directory=(root_dirs or {}).get('local'))
+        if not cnv_packs:
+            return CastResult(hex_path, batch.STATUS_ERROR, message=f'No cnv file found for {_id}')
+        # One temp directory per cast so that casts running in parallel do not pick up each others files
+        temp_directory = Path(handler.get_dir('local', 'temp'), _id)
+        staging_directory = Path(temp_directory, 'standard_format')
+        if staging_directory.exists():
+            shutil.rmtree(staging_directory)
+        staging_directory.mkdir(parents=True)
+        try:
+            _create_standard_format_in_staging_directory(cnv_packs, handler, staging_directory, year=year,
+                                                         root_dirs=root_dirs, old_key=old_key)
+        finally:
+            shutil.rmtree(staging_directory, ignore_errors=True)
+        nsf_packs = get_packs_for_ids(handler.get_dir('local', 'data'), [_id], old_key=old_key,
+                                      local_root_directory=(root_dirs or {}).get('local'))
+        if not nsf_packs:
+            return CastResult(hex_path, batch.STATUS_ERROR, message=f'No standard format file found for {_id}')
+        qc_paths = run_automatic_qc([nsf_packs[0]['txt']], handler, temp_directory=temp_directory,
+                                    local_root_directory=(root_dirs or {}).get('local'))
+        return CastResult(hex_path, batch.STATUS_OK, qc_path=qc_paths[0] if qc_paths else None)
+    except Exception:
+        return CastResult(hex_path, batch.STATUS_ERROR, message=traceback.format_exc())
+
+
+def add_cast_to_manifest(processing_manifest, cast, cnv_path, old_key=False):
+    """Adds the standard format file of a cast made by prepare_cast_for_manual_qc to the manifest, with the
+    same inputs as in create_standard_format"""
+    if not cast.ok or not cast.qc_path or not cnv_path:
+        return
+    inputs = processing_manifest.get_file_inputs(cnv_path, old_key=old_key)
+    processing_manifest.set_output(cast.id, 'txt', inputs, [cast.qc_path])
+
+
+def stream(processor, paths, old_key=False, options=None):
+    """Streaming version of process -> standard format -> automatic qc. Each cast is sent to standard
+    format and automatic qc as soon as it is processed, so the stages overlap between casts.
+    Generator that yields ('process', ProcessingResult) and ('cast', CastResult) in the order they
+    are finished. The standard format files are added to the manifest of the processor (if any)."""
+    options = options or {}
+    paths = list(paths)
+    if not paths:
+        return
+    cnv_paths = {}
+
+    def add_to_manifest(cast):
+        if processor.manifest:
+            add_cast_to_manifest(processor.manifest, cast, cnv_paths.get(cast.path), old_key=old_key)
+
+    batch.clear_file_handlers()
+    kwargs = dict(year=processor.year, root_dirs=processor.root_dirs, old_key=old_key)
+    processor.start_jobs(paths)
+    for path in paths[:]:
+        if processor.is_up_to_date(path, options):
+            paths.remove(path)
+            result = batch.ProcessingResult(path, batch.STATUS_SKIPPED, message='Unchanged since last processing')
+            processor.register(result)
+            yield 'process', result
+    if processor.nr_workers == 1:
+        for path in paths:
+            result = processor.process(path, options)
+            processor.register(result)
+            yield 'process', result
+            if result.ok:
+                cnv_paths[result.path] = result.cnv_path
+                cast = prepare_cast_for_manual_qc(result.path, **kwargs)
+                add_to_manifest(cast)
+                yield 'cast', cast
+        if processor.manifest:
+            processor.manifest.save()
+        return
+    nr_workers = min(processor.nr_workers, len(paths))
+    logger.info(f'Streaming {len(paths)} files using {nr_workers} processes per stage')
+    process_pool = batch.get_process_pool(nr_workers, record_file_access=True)
+    cast_pool = batch.get_process_pool(nr_workers)
+    try:
+        pending = {processor.submit(process_pool, path, options): 'process' for path in paths}
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                stage = pending.pop(future)
+                result = future.result()
+                if stage == 'process':
+                    processor.register(result)
+                else:
+                    add_to_manifest(result)
+                yield stage, result
+                if stage == 'process' and result.ok:
+                    cnv_paths[result.path] = result.cnv_path
+                    pending[cast_pool.submit(prepare_cast_for_manual_qc, result.path, **kwargs)] = 'cast'
+    finally:
+        process_pool.shutdown(wait=True, cancel_futures=True)
+        cast_pool.shutdown(wait=True, cancel_futures=True)
+        if processor.manifest:
+            processor.manifest.save()
+
+
+def create_plots_for_file(path, plots_directory=None, **kwargs):
+    """Creates plots for the package of the given file. Returns a list of the created image paths"""
+    pack = file_explorer.get_package_for_file(path)
+    return create_seabird_like_plots_for_package(pack, plots_directory, **kwargs)
+
+
+def create_plots(file_paths, plots_directory, nr_workers=1, timer=None, manifest=None, **kwargs):
+    """Creates plots for the packages of the given files. Returns a list of the created image paths.
+    If a manifest is given, files that are unchanged since the plots were made are skipped."""
+    image_paths = []
+    file_paths = list(file_paths)
+    inputs = {}
+    if manifest:
+        inputs = {get_id_from_key(Path(path).name): manifest.get_file_inputs(path) for path in file_paths}
+        file_paths = [path for path in file_paths
+                      if not manifest.is_up_to_date(get_id_from_key(Path(path).name), 'plots',
+                                                    inputs[get_id_from_key(Path(path).name)])]
+    jobs.report_progress(0, len(file_paths))
+    results = batch.run_in_processes(create_plots_for_file, file_paths, nr_workers=nr_workers,
+                                     plots_directory=plots_directory, **kwargs)
+    for nr_done, (path, img_paths, exception) in enumerate(results, 1):
+        jobs.report_progress(nr_done, len(file_paths))
+        if exception:
+            if timer is None:
+                raise exception
+            timer.add_failed('plots', path, str(exception))
+            continue
+        image_paths.extend(img_paths or [])
+        if manifest:
+            _id = get_id_from_key(Path(path).name)
+            manifest.set_output(_id, 'plots', inputs[_id], img_paths or [])
+    if manifest:
+        manifest.save()
+    return image_paths
+
+
+def copy_packs_to_server(packs, file_handler, nr_workers=None):
+    """Copies the local files of the packs to the server, see server_copy.py. Returns the number of
+    copied packs."""
+    cast_ids = []
+    for pack in packs:
+        if 'test' in pack.pattern.lower():
+            logger.warning(f'TEST package not copied to server: {pack} ')
+            continue
+        cast_ids.append(get_id_from_key(pack.key))
+    result = server_copy.copy_casts_to_server(file_handler, cast_ids, update=True, nr_workers=nr_workers)
+    if result.failed:
+        raise server_copy.CopyError(f'Could not copy {len(result.failed)} files to server: '
+                                    f'{", ".join([str(path) for path, e in result.failed])}')
+    return len(cast_ids)
+
+
+def run(source_directory, year, platform, surfacesoak, config_root_directory, local_root_directory,
+        server_root_directory=None, hex_paths=None, nr_workers=None, create_plots_option=True, old_key=False,
+        incremental=False, copy_workers=None, mismatch_policy=batch.MISMATCH_SKIP):
+    """Runs the same stages as "Processera" in PageSimple, except for the manual qc. The dependencies of the
+    casts are always recorded in the manifest (see manifest.py). With incremental=True casts that are
+    unchanged since the last run are skipped. copy_workers is the number of
+    threads used when copying to the server. Mismatches are handled according to mismatch_policy.
+    Returns a summary dict with timings for each stage and the processing report."""
+    nr_workers = nr_workers or batch.get_default_nr_workers()
+    root_dirs = dict(source=source_directory,
+                     config=config_root_directory,
+                     local=local_root_directory,
+                     server=server_root_directory)
+    root_dirs = {key: str(value) for key, value in root_dirs.items() if value}
+    timer = StageTimer()
+    processing_manifest = manifest.Manifest(local_root_directory, config_root_directory,
+                                            skip_unchanged=incremental)
+
+    file_handler = batch.create_file_handler(year, root_dirs)
+    if hex_paths is None:
+        hex_paths = get_unprocessed_hex_paths(file_handler, year)
+    hex_paths = [Path(path) for path in hex_paths]
+    active_ids = [get_id_from_key(path.name) for path in hex_paths]
+
+    with timer('process') as stage:
+        processor = batch.BatchProcessor(year=year,
+                                         root_dirs=dict(local=root_dirs.get('local'),
+                                                        config=root_dirs.get('config')),
+                                         nr_workers=nr_workers,
+                                         platform=platform,
+                                         surfacesoak=surfacesoak,
+                                         psa_paths=None,
+                                         old_key=old_key,
+                                         manifest=processing_manifest,
+                                         mismatch_policy=mismatch_policy)
+        for result in processor.run(hex_paths):
+            if result.status == batch.STATUS_SKIPPED:
+                continue
+            stage.nr_items += 1
+            if not result.ok:
+                logger.error(f'{result.path}: {result.message}')
+                timer.add_failed('process', result.path, result.status)
+
+    file_handler.store_files('local')
+
+    with timer('standard_format') as stage:
+        packs = get_packs_for_ids(file_handler.get_dir('local', 'cnv'), active_ids, old_key=old_key,
+                                  local_root_directory=local_root_directory)
+        packs = create_standard_format(packs, file_handler, year=year, root_dirs=root_dirs, nr_workers=nr_workers,
+                                       old_key=old_key, timer=timer, manifest=processing_manifest)
+        stage.nr_items = len(packs)
+        # Only the casts with new standard format files needs automatic qc
+        active_ids = [_get_cnv_id(pack) for pack in packs]
+
+    with timer('automatic_qc') as stage:
+        nsf_packs = get_packs_for_ids(file_handler.get_dir('local', 'data'), active_ids, old_key=old_key,
+                                      local_root_directory=local_root_directory)
+        files = [pack['txt'] for pack in nsf_packs]
+        stage.nr_items = len(files)
+        if files:
+            run_automatic_qc(files, file_handler, manifest=processing_manifest, nr_workers=nr_workers,
+                             local_root_directory=local_root_directory)
+
+    if create_plots_option:
+        with timer('plots') as stage:
+            stage.nr_items = len(files)
+            create_plots(files, file_handler.get_dir('local', 'plots'), nr_workers=nr_workers, timer=timer,
+                         manifest=processing_manifest)
+
+    if server_root_directory:
+        with timer('copy_to_server') as stage:
+            file_handler.store_files('local')
+            nsf_packs = get_packs_for_ids(file_handler.get_dir('local', 'data'), active_ids, old_key=old_key,
+                                          local_root_directory=local_root_directory)
+            stage.nr_items = copy_packs_to_server(nsf_packs, file_handler, nr_workers=copy_workers)
+
+    return timer.get_summary(year=str(year),
+                             platform=platform,
+                             surfacesoak=surfacesoak,
+                             nr_casts=len(hex_paths),
+                             nr_workers=nr_workers,
+                             report=processor.report.as_dict())
+
+
+def _parse_setting(value):
+    """Settings are stored as strings in the manifest"""
+    return {'None': None, 'True': True, 'False': False}.get(value, value)
+
+
+def get_stale_casts(local_root_directory, config_root_directory):
+    """Returns a dict with cast id as key and the changed config files as value for the casts that
+    were processed with config files that have changed since"""
+    return manifest.Manifest(local_root_directory, config_root_directory).get_stale_casts()
+
+
+def rebuild_stale(config_root_directory, local_root_directory, cast_ids=None, nr_workers=None,
+                  create_plots_option=False):
+    """Reprocesses the casts that depend on changed config files (see manifest.py), using the settings
+    that each cast was processed with. Every output the manifest lists for the cast is made again: cnv,
+    asvp (in the same directory as before), standard format with automatic qc and plots. With
+    create_plots_option=True plots are also made for casts without plots in the manifest.
+    If cast_ids is given only these stale casts are rebuilt. Returns a summary dict with timings for each
+    stage."""
+    nr_workers = nr_workers or batch.get_default_nr_workers()
+    root_dirs = dict(config=str(config_root_directory), local=str(local_root_directory))
+    processing_manifest = manifest.Manifest(local_root_directory, config_root_directory)
+    timer = StageTimer()
+
+    stale = processing_manifest.get_stale_casts()
+    if cast_ids is not None:
+        stale = {cast_id: stale[cast_id] for cast_id in cast_ids if cast_id in stale}
+
+    groups = {}
+    for cast_id in stale:
+        hex_path = processing_manifest.get_hex_path(cast_id)
+        if not hex_path:
+            timer.add_failed('process', cast_id, 'Hex file not found')
+            continue
+        settings = dict(processing_manifest.get_settings(cast_id))
+        asvp_paths = processing_manifest.get_output_paths(cast_id, 'asvp')
+        if asvp_paths:
+            settings['create_asvp_file'] = 'True'
+            settings['asvp_output_dir'] = str(asvp_paths[0].parent)
+        settings = tuple(sorted(settings.items()))
+        if not get_year_from_key(hex_path.name):
+            timer.add_failed('process', cast_id, f'No year in file name {hex_path.name}')
+            continue
+        groups.setdefault((get_year_from_key(hex_path.name), settings), []).append(hex_path)
+
+    for (year, settings), hex_paths in groups.items():
+        settings = {key: _parse_setting(value) for key, value in settings if _parse_setting(value) is not None}
+        logger.info(f'Rebuilding {len(hex_paths)} stale casts for {year}: {settings}')
+        file_handler = batch.create_file_handler(year, root_dirs)
+        processed_ids = []
+        with timer('process') as stage:
+            processor = batch.BatchProcessor(year=year,
+                                             root_dirs=root_dirs,
+                                             nr_workers=nr_workers,
+                                             overwrite=True,
+                                             psa_paths=None,
+                                             manifest=processing_manifest,
+                                             **settings)
+            for i, result in enumerate(processor.run(hex_paths), 1):
+                jobs.report_progress(i, len(hex_paths), result.path.name)
+                stage.nr_items += 1
+                if result.ok:
+                    processed_ids.append(get_id_from_key(result.path.name))
+                    continue
+                logger.error(f'{result.path}: {result.message}')
+                timer.add_failed('process', result.path, result.status)
+
+        file_handler.store_files('local')
+        old_key = bool(settings.get('old_key'))
+
+        with timer('standard_format') as stage:
+            packs = get_packs_for_ids(file_handler.get_dir('local', 'cnv'), processed_ids, old_key=old_key,
+                                      local_root_directory=local_root_directory)
+            packs = create_standard_format(packs, file_handler, year=year, root_dirs=root_dirs,
+                                           nr_workers=nr_workers, old_key=old_key, timer=timer, overwrite=True,
+                                           manifest=processing_manifest)
+            stage.nr_items += len(packs)
+
+        with timer('automatic_qc') as stage:
+            nsf_packs = get_packs_for_ids(file_handler.get_dir('local', 'data'),
+                                          [_get_cnv_id(pack) for pack in packs], old_key=old_key,
+                                          local_root_directory=local_root_directory)
+            files = [pack['txt'] for pack in nsf_packs]
+            stage.nr_items += len(files)
+            if files:
+                run_automatic_qc(files, file_handler, manifest=processing_manifest, nr_workers=nr_workers,
+                                 local_root_directory=local_root_directory)
+
+        plot_files = [path for path in files if create_plots_option
+                      or processing_manifest.get_output(get_id_from_key(Path(path).name), 'plots')]
+        if plot_files:
+            with timer('plots') as stage:
+                stage.nr_items += len(plot_files)
+                create_plots(plot_files, file_handler.get_dir('local', 'plots'), nr_workers=nr_workers,
+                             timer=timer, manifest=processing_manifest)
+
+    return timer.get_summary(nr_casts=len(stale),
+                             nr_workers=nr_workers,
+                             stale=stale)
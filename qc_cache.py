@@ -0,0 +1,261 @@
+"""
+Cache (SQLite) of automatic qc results. Running automatic qc again on a dataset with unchanged data and
+unchanged qc configuration takes the flags from the cache instead of running the qc routines.
+
+The key is the hash of the data block without flag columns, combined with the hash of the qc
+configuration (the installed profileqc version, its routines and settings files). A new version of
+profileqc or changed settings therefore never use old results. The flag columns are not part of the key
+since qc rewrites them: the Q0 columns are made by the qc routines and the S and B flags in them are copied
+to the Q columns (SessionQC.synchronize_flag_fields in profileqc).
+
+For each dataset the Q0 flag columns after qc, the comment lines added to the metadata and the log entry
+of the dataset are stored. When a result is used, the Q0 flags are copied to the Q columns by the qc session
+of profileqc, so manual flags in the Q columns are kept.
+The timestamp in the cached qc comment is set to the time the cache is used. The oldest used entries are
+removed when the cache is larger than max_size bytes.
+
+The database is stored in the local root directory (the user cache directory if not given).
+"""
+import datetime
+import hashlib
+import logging
+import pickle
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILE_NAME = 'qc_cache.sqlite'
+MAX_SIZE = 500 * 1024 * 1024
+
+FLAG_COLUMN_PREFIXES = ['Q0_', 'Q_']
+AUTOMATIC_FLAG_COLUMN_PREFIX = 'Q0_'
+CONFIG_FILE_SUFFIXES = ['.py', '.yaml', '.yml', '.json', '.txt']
+TIMESTAMP_PATTERN = re.compile(r'TIMESTAMP \d+')
+TIMESTAMP_FORMAT = '%Y%m%d%H%M'
+
+_caches = {}
+_lock = threading.Lock()
+_config_hash = None
+
+
+def get_cache_file_path(local_root_directory=None):
+    if local_root_directory:
+        return Path(local_root_directory, CACHE_FILE_NAME)
+    return Path(utils.get_cache_directory(), CACHE_FILE_NAME)
+
+
+def get_qc_cache(local_root_directory=None):
+    """Returns a shared QcCache stored in the given local root directory (user cache directory if not
+    given)"""
+    file_path = str(get_cache_file_path(local_root_directory))
+    with _lock:
+        if file_path not in _caches:
+            _caches[file_path] = QcCache(file_path)
+        return _caches[file_path]
+
+
+def get_config_hash():
+    """Returns the hash of the qc configuration: version, code and settings files of profileqc"""
+    global _config_hash
+    if _config_hash:
+        return _config_hash
+    import profileqc
+    sha = hashlib.sha256(str(getattr(profileqc, '__version__', '')).encode())
+    package_directory = Path(profileqc.__file__).parent
+    for path in sorted(package_directory.rglob('*')):
+        if path.suffix not in CONFIG_FILE_SUFFIXES or '__pycache__' in path.parts:
+            continue
+        sha.update(str(path.relative_to(package_directory)).encode())
+        sha.update(path.read_bytes())
+    _config_hash = sha.hexdigest()
+    return _config_hash
+
+
+def is_flag_column(col):
+    return any([str(col).startswith(prefix) for prefix in FLAG_COLUMN_PREFIXES])
+
+
+def get_data_hash(df, name=''):
+    """Returns the hash of the data block of the dataset with the given name (the name is part of the log
+    entry). The flag columns are rewritten by automatic qc and not part of the key."""
+    columns = [col for col in df.columns if not is_flag_column(col)]
+    sha = hashlib.sha256(str(name).encode())
+    sha.update('\t'.join([str(col) for col in columns]).encode())
+    sha.update(str(len(df)).encode())
+    for col in columns:
+        sha.update(b'\x1e')
+        sha.update('\x1f'.join([str(value) for value in df[col].tolist()]).encode())
+    return sha.hexdigest()
+
+
+def get_automatic_flag_columns(df):
+    return [col for col in df.columns if str(col).startswith(AUTOMATIC_FLAG_COLUMN_PREFIX)]
+
+
+def get_metadata_lines(meta):
+    """Returns the lines of the metadata of a dataset item, a pandas Series or a dict (in order)"""
+    if isinstance(meta, dict):
+        return list(meta.values())
+    return list(meta.tolist())
+
+
+class QcResult:
+    """Q0 flags, metadata comments and log entry of automatic qc for one dataset"""
+
+    def __init__(self, flags, comments, log):
+        self.flags = flags
+        self.comments = comments
+        self.log = log
+
+    @classmethod
+    def from_item(cls, item, nr_metadata_before, log):
+        """Creates the result from a dataset item that automatic qc has been run on"""
+        df = item['data']
+        flags = {col: df[col].tolist() for col in get_automatic_flag_columns(df)}
+        comments = [str(value) for value in get_metadata_lines(item['metadata'])[nr_metadata_before:]]
+        return cls(flags, comments, log)
+
+    def apply(self, item, qc_session):
+        """Sets the cached Q0 flags and adds the qc comments (with a new timestamp) to the dataset item.
+        The flags are copied to the Q columns by qc_session, a profileqc SessionQC holding the item."""
+        df = item['data']
+        for col, values in self.flags.items():
+            df[col] = values
+        qc_session.synchronize_flag_fields()
+        meta = item['metadata']
+        timestamp = datetime.datetime.now().strftime(TIMESTAMP_FORMAT)
+        for comment in self.comments:
+            meta[len(meta) + 1] = TIMESTAMP_PATTERN.sub(f'TIMESTAMP {timestamp}', comment)
+
+    def dumps(self):
+        return zlib.compress(pickle.dumps(dict(flags=self.flags, comments=self.comments, log=self.log)))
+
+    @classmethod
+    def loads(cls, data):
+        return cls(**pickle.loads(zlib.decompress(data)))
+
+
+class QcCache:
+
+    def __init__(self, file_path=None, max_size=MAX_SIZE):
+        self.file_path = Path(file_path or get_cache_file_path())
+        self.max_size = max_size
+        self.nr_hits = 0
+        self.nr_misses = 0
+        self._lock = threading.Lock()
+        self._create_tables()
+
+    def _connect(self):
+        return sqlite3.connect(str(self.file_path), timeout=30)
+
+    def _create_tables(self):
+        with self._connect() as con:
+            con.execute('CREATE TABLE IF NOT EXISTS results ('
+                        'data_hash TEXT, config_hash TEXT, data BLOB, size INTEGER, last_used REAL, '
+                        'PRIMARY KEY (data_hash, config_hash))')
+            con.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+        con.close()
+
+    def get(self, data_hash, config_hash=None):
+        """Returns the cached QcResult or None"""
+        config_hash = config_hash or get_config_hash()
+        with self._lock:
+            con = self._connect()
+            try:
+                row = con.execute('SELECT data FROM results WHERE data_hash=? AND config_hash=?',
+                                  (data_hash, config_hash)).fetchone()
+                if row:
+                    with con:
+                        con.execute('UPDATE results SET last_used=? WHERE data_hash=? AND config_hash=?',
+                                    (time.time(), data_hash, config_hash))
+            finally:
+                con.close()
+        if not row:
+            self.nr_misses += 1
+            return None
+        self.nr_hits += 1
+        try:
+            return QcResult.loads(row[0])
+        except Exception as e:
+            logger.warning(f'Invalid qc cache entry {data_hash}: {e}')
+            self.invalidate(data_hash=data_hash)
+            return None
+
+    def put(self, data_hash, result, config_hash=None):
+        config_hash = config_hash or get_config_hash()
+        data = result.dumps()
+        with self._lock:
+            con = self._connect()
+            try:
+                with con:
+                    con.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                                (data_hash, config_hash, data, len(data), time.time()))
+                    self._evict(con)
+            finally:
+                con.close()
+
+    def _evict(self, con):
+        total = con.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        if total <= self.max_size:
+            return
+        rows = con.execute('SELECT data_hash, config_hash, size FROM results ORDER BY last_used').fetchall()
+        removed = []
+        for data_hash, config_hash, size in rows:
+            if total <= self.max_size:
+                break
+            removed.append((data_hash, config_hash))
+            total -= size
+        con.executemany('DELETE FROM results WHERE data_hash=? AND config_hash=?', removed)
+        logger.info(f'Removed {len(removed)} entries from the qc cache')
+
+    def invalidate(self, data_hash=None, config_hash=None):
+        """Removes the entries for the given data hash and/or config hash. Removes all entries if neither
+        is given. Returns the number of removed entries."""
+        sql = 'DELETE FROM results'
+        conditions = []
+        args = []
+        for name, value in [('data_hash', data_hash), ('config_hash', config_hash)]:
+            if value:
+                conditions.append(f'{name}=?')
+                args.append(value)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        with self._lock:
+            con = self._connect()
+            try:
+                with con:
+                    return con.execute(sql, args).rowcount
+            finally:
+                con.close()
+
+    def invalidate_old_configs(self):
+        """Removes the entries made with another qc configuration than the current"""
+        with self._lock:
+            con = self._connect()
+            try:
+                with con:
+                    return con.execute('DELETE FROM results WHERE config_hash!=?', (get_config_hash(),)).rowcount
+            finally:
+                con.close()
+
+    def clear(self):
+        return self.invalidate()
+
+    def get_size(self):
+        with self._lock:
+            con = self._connect()
+            try:
+                return con.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results').fetchone()
+            finally:
+                con.close()
+
+    def get_summary(self):
+        nr_entries, size = self.get_size()
+        return dict(nr_entries=nr_entries, size=size, nr_hits=self.nr_hits, nr_misses=self.nr_misses)
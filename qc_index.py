@@ -0,0 +1,170 @@
+"""
+Persistent index (SQLite) of the qc stamps in the comment header of standard format files. Replaces
+creating a StandardFormatComments object for every file to check has_automatic_qc_today.
+
+Only the header lines (starting with //) are read, the data block is never loaded. For each file the
+timestamps of automatic and manual qc, the qc comment lines and the Q0 flag columns (one per qc
+routine) are stored with the mtime and size of the file. Files that have changed since they were indexed
+(for example by manual qc in VisQC) are read again when asked for. run_automatic_qc updates the index
+for the files it writes.
+
+The index is stored in the local root directory (the user cache directory if not given).
+"""
+import datetime
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+from pathlib import Path
+
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE_NAME = 'qc_stamp_index.sqlite'
+
+HEADER_PREFIX = '//'
+QC_COMMENT_PREFIX = '//COMNT_QC'
+# //COMNT_QC; AUTOMATIC QC PERFORMED BY <user>; TIMESTAMP <%Y%m%d%H%M>; <version>
+QC_STAMP_PATTERN = re.compile(r'(?P<kind>[A-Z]+) QC PERFORMED BY (?P<user>[^;]*); TIMESTAMP (?P<timestamp>\d+)')
+AUTOMATIC_KINDS = ['AUTOMATIC']
+MANUAL_KINDS = ['MANUAL', 'VISUAL']
+FLAG_COLUMN_PREFIX = 'Q0_'
+FILE_ENCODING = 'cp1252'
+# Number of paths in one SELECT
+QUERY_CHUNK_SIZE = 500
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def get_index_file_path(local_root_directory=None):
+    if local_root_directory:
+        return Path(local_root_directory, INDEX_FILE_NAME)
+    return Path(utils.get_cache_directory(), INDEX_FILE_NAME)
+
+
+def get_qc_index(local_root_directory=None):
+    """Returns a shared QcIndex stored in the given local root directory (user cache directory if not
+    given)"""
+    file_path = str(get_index_file_path(local_root_directory))
+    with _lock:
+        if file_path not in _indexes:
+            _indexes[file_path] = QcIndex(file_path)
+        return _indexes[file_path]
+
+
+def read_header_stamps(path):
+    """Reads the header of the standard format file line by line and returns a dict with the qc stamps.
+    Stops at the first line that is not a header line."""
+    stamps = dict(automatic_qc=[], manual_qc=[], qc_comments=[], flag_columns=[])
+    with open(path, encoding=FILE_ENCODING, errors='replace') as fid:
+        for line in fid:
+            line = line.rstrip('\r\n')
+            if not line.startswith(HEADER_PREFIX):
+                stamps['flag_columns'] = [col for col in line.split('\t') if col.startswith(FLAG_COLUMN_PREFIX)]
+                break
+            if not line.startswith(QC_COMMENT_PREFIX):
+                continue
+            stamps['qc_comments'].append(line)
+            match = QC_STAMP_PATTERN.search(line.upper())
+            if not match:
+                continue
+            if match.group('kind') in AUTOMATIC_KINDS:
+                stamps['automatic_qc'].append(match.group('timestamp'))
+            elif match.group('kind') in MANUAL_KINDS:
+                stamps['manual_qc'].append(match.group('timestamp'))
+    return stamps
+
+
+def _get_stat(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class QcIndex:
+
+    def __init__(self, file_path=None):
+        self.file_path = Path(file_path or get_index_file_path())
+        self._lock = threading.Lock()
+        self._create_tables()
+
+    def _connect(self):
+        return sqlite3.connect(str(self.file_path), timeout=30)
+
+    def _create_tables(self):
+        with self._connect() as con:
+            con.execute('CREATE TABLE IF NOT EXISTS stamps ('
+                        'path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, data TEXT)')
+        con.close()
+
+    def get_stamps(self, paths):
+        """Returns a dict with path (str) as key and the qc stamps (see read_header_stamps) as value.
+        Files that are new or changed since they were indexed are read and indexed. Missing files are
+        not included."""
+        paths = [os.path.abspath(path) for path in paths]
+        stats = {path: _get_stat(path) for path in paths}
+        stamps = {}
+        changed = []
+        with self._lock:
+            con = self._connect()
+            try:
+                for i in range(0, len(paths), QUERY_CHUNK_SIZE):
+                    chunk = paths[i:i + QUERY_CHUNK_SIZE]
+                    for path, mtime_ns, size, data in con.execute(
+                            f'SELECT path, mtime_ns, size, data FROM stamps '
+                            f'WHERE path IN ({", ".join("?" * len(chunk))})', chunk):
+                        if stats.get(path) == (mtime_ns, size):
+                            stamps[path] = json.loads(data)
+                for path in paths:
+                    if path in stamps or not stats[path]:
+                        continue
+                    try:
+                        stamps[path] = read_header_stamps(path)
+                    except OSError as e:
+                        logger.warning(f'Could not read header of {path}: {e}')
+                        continue
+                    changed.append((path, *stats[path], json.dumps(stamps[path])))
+                if changed:
+                    with con:
+                        con.executemany('INSERT OR REPLACE INTO stamps VALUES (?, ?, ?, ?)', changed)
+            finally:
+                con.close()
+        return stamps
+
+    def update(self, paths):
+        """Indexes the given files again, for example after they have been written"""
+        self.remove(paths)
+        self.get_stamps(paths)
+
+    def remove(self, paths):
+        with self._lock:
+            con = self._connect()
+            try:
+                with con:
+                    con.executemany('DELETE FROM stamps WHERE path=?', [(os.path.abspath(path),) for path in paths])
+            finally:
+                con.close()
+
+    def get_last_automatic_qc(self, path):
+        """Returns the latest automatic qc timestamp of the file (as a string %Y%m%d%H%M) or None"""
+        stamps = self.get_stamps([path]).get(os.path.abspath(path))
+        if not stamps or not stamps['automatic_qc']:
+            return None
+        return max(stamps['automatic_qc'])
+
+    def get_files_with_automatic_qc_today(self, paths, today=None):
+        """Returns the paths (as given) that have an automatic qc stamp from today"""
+        today = (today or datetime.date.today()).strftime('%Y%m%d')
+        stamps = self.get_stamps(paths)
+        return [path for path in paths
+                if any([stamp.startswith(today) for stamp in
+                        stamps.get(os.path.abspath(path), {}).get('automatic_qc', [])])]
+
+    def has_automatic_qc_today(self, path, today=None):
+        return bool(self.get_files_with_automatic_qc_today([path], today=today))
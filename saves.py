@@ -198,3 +198,12 @@ class SaveComponents:
             except:
                 pass
 
+
+
+def get_saved_value(key, component_id, user='default'):
+    """Returns the value of the component saved with SaveComponents(key). A default value (see Defaults)
+    is returned if there is one, same as in SaveComponents.load"""
+    item = Defaults().get(component_id, None)
+    if item is None:
+        item = (Saves().get(user, key) or {}).get(component_id, None)
+    return item
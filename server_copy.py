@@ -0,0 +1,169 @@
+"""
+Concurrent copy of files to the server. On a network share the latency per file is larger than the time
+to move the bytes, so many files are copied at the same time in a thread pool.
+
+Each file is written to a temporary name in the target directory and renamed when complete, so a file on
+the server is never half written. The size (or checksum) of the copy is verified after the rename.
+
+Source and target directories are resolved by the file handler (file_handler.get_dir), so the server layout
+is the same as for file_handler.copy_files_to_server. COPY_SUBDIRS only names the handler directories that
+are copied.
+"""
+import concurrent.futures
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+
+from . import jobs
+from .manifest import get_cast_id
+from .manifest import get_file_hash
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_NR_WORKERS = 8
+
+# File handler directories (see file_handler.get_dir) copied to the server for each cast
+COPY_SUBDIRS = ['raw', 'cnv', 'data', 'plots']
+
+VERIFY_OPTIONS = [None, 'size', 'checksum']
+
+
+class CopyError(Exception):
+    pass
+
+
+class CopyResult:
+
+    def __init__(self):
+        self.copied = []
+        self.failed = []
+        self.nr_bytes = 0
+        self.seconds = 0
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.get_summary()})'
+
+    @property
+    def nr_files(self):
+        return len(self.copied)
+
+    @property
+    def files_per_second(self):
+        if not self.seconds:
+            return 0
+        return self.nr_files / self.seconds
+
+    @property
+    def mb_per_second(self):
+        if not self.seconds:
+            return 0
+        return self.nr_bytes / 1e6 / self.seconds
+
+    def get_summary(self):
+        text = f'{self.nr_files} files ({self.nr_bytes / 1e6:.1f} MB) in {self.seconds:.1f} s, ' \
+               f'{self.files_per_second:.1f} files/s, {self.mb_per_second:.1f} MB/s'
+        if self.failed:
+            text += f', {len(self.failed)} failed'
+        return text
+
+
+def get_temp_path(target_path):
+    target_path = Path(target_path)
+    return Path(target_path.parent, f'.{target_path.name}.{os.getpid()}.tmp')
+
+
+def copy_file(source_path, target_path, verify='size'):
+    """Copies source_path to a temporary file next to target_path and renames it to target_path.
+    Raises CopyError if the copy can not be verified. Returns the number of bytes copied."""
+    if verify not in VERIFY_OPTIONS:
+        raise ValueError(f'Invalid verify option: {verify}')
+    source_path = Path(source_path)
+    target_path = Path(target_path)
+    target_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = get_temp_path(target_path)
+    try:
+        shutil.copy2(source_path, temp_path)
+        os.replace(temp_path, target_path)
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+    size = source_path.stat().st_size
+    if verify and target_path.stat().st_size != size:
+        raise CopyError(f'Size differs after copy: {target_path}')
+    if verify == 'checksum' and get_file_hash(source_path) != get_file_hash(target_path):
+        raise CopyError(f'Checksum differs after copy: {target_path}')
+    return size
+
+
+def get_directory_pairs(file_handler, subdirs=None):
+    """Returns a list of (local directory, server directory) resolved by the file handler. Directories the
+    handler does not have for both roots are left out."""
+    pairs = []
+    for subdir in subdirs or COPY_SUBDIRS:
+        try:
+            local_directory = file_handler.get_dir('local', subdir)
+            server_directory = file_handler.get_dir('server', subdir)
+        except Exception as e:
+            logger.debug(f'No {subdir} directory in file handler: {e}')
+            continue
+        if not local_directory or not server_directory:
+            continue
+        pairs.append((local_directory, server_directory))
+    return pairs
+
+
+def get_copy_tasks(file_handler, cast_ids, subdirs=None, update=False):
+    """Returns a list of (source_path, target_path) for all local files belonging to the given casts.
+    Each local directory is listed once. Files already on the server are only included if update=True."""
+    cast_ids = {str(cast_id).upper() for cast_id in cast_ids}
+    tasks = []
+    for local_directory, server_directory in get_directory_pairs(file_handler, subdirs=subdirs):
+        try:
+            entries = list(os.scandir(local_directory))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if not entry.is_file() or get_cast_id(entry.name) not in cast_ids:
+                continue
+            target_path = Path(server_directory, entry.name)
+            if not update and target_path.exists():
+                continue
+            tasks.append((Path(entry.path), target_path))
+    return tasks
+
+
+def copy_files(tasks, nr_workers=None, verify='size'):
+    """Copies (source_path, target_path) in a thread pool. Progress is reported to the current job.
+    Returns a CopyResult."""
+    result = CopyResult()
+    if not tasks:
+        return result
+    t0 = time.perf_counter()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=nr_workers or DEFAULT_NR_WORKERS)
+    futures = {executor.submit(copy_file, source, target, verify=verify): (source, target)
+               for source, target in tasks}
+    try:
+        for i, future in enumerate(concurrent.futures.as_completed(futures)):
+            source, target = futures[future]
+            try:
+                result.nr_bytes += future.result()
+                result.copied.append(target)
+            except (OSError, CopyError) as e:
+                logger.error(f'Could not copy {source} to {target}: {e}')
+                result.failed.append((source, str(e)))
+            jobs.report_progress(i + 1, len(tasks), source.name)
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+        result.seconds = time.perf_counter() - t0
+    logger.info(f'Copied to server: {result.get_summary()}')
+    return result
+
+
+def copy_casts_to_server(file_handler, cast_ids, update=False, nr_workers=None, verify='size', subdirs=None):
+    """Copies all local files of the given casts to the server. Returns a CopyResult."""
+    tasks = get_copy_tasks(file_handler, cast_ids, subdirs=subdirs, update=update)
+    return copy_files(tasks, nr_workers=nr_workers, verify=verify)
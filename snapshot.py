@@ -0,0 +1,87 @@
+"""
+One listing of each directory per refresh. All list updaters in a refresh get their file names from the
+same snapshot instead of listing the directories again, which is slow on a network share.
+"""
+import logging
+import os
+import time
+from pathlib import Path
+
+from . import compare
+from . import listing
+
+logger = logging.getLogger(__name__)
+
+
+class FileSnapshot:
+
+    def __init__(self, file_handler):
+        self.file_handler = file_handler
+        self._file_names = {}
+        self._directories = {}
+        self._stats = {}
+        self._comparisons = {}
+        self.listings = {}
+        self._t0 = time.perf_counter()
+
+    @property
+    def nr_listings(self):
+        return sum(self.listings.values())
+
+    def _count(self, name):
+        self.listings.setdefault(name, 0)
+        self.listings[name] += 1
+
+    def get_file_names(self, root, subdir, suffixes=None):
+        """Same as file_handler.get_file_names but each (root, subdir) is only listed once"""
+        key = (root, subdir)
+        if key not in self._file_names:
+            self._count(f'{root}/{subdir}')
+            self._file_names[key] = list(self.file_handler.get_file_names(root, subdir) or [])
+        names = self._file_names[key]
+        if suffixes:
+            names = [name for name in names if Path(name).suffix in suffixes]
+        return names[:]
+
+    def list_directory(self, directory):
+        """Returns the names in the given directory. Each directory is only listed once"""
+        directory = os.path.abspath(directory)
+        for (root, subdir), names in self._file_names.items():
+            # Already listed through the file handler
+            handler_directory = self.file_handler.get_dir(root, subdir)
+            if handler_directory and os.path.abspath(handler_directory) == directory:
+                return names[:]
+        if directory not in self._directories:
+            self._count(directory)
+            self._directories[directory] = listing.list_directory(directory)
+        return self._directories[directory][:]
+
+    def get_file_stats(self, directory):
+        """Returns size and mtime for the files in the given directory, see compare.get_file_stats"""
+        directory = os.path.abspath(directory)
+        if directory not in self._stats:
+            self._count(f'stat {directory}')
+            self._stats[directory] = compare.get_file_stats(directory)
+        return self._stats[directory]
+
+    def get_comparison(self, subdir, checksum=False):
+        """Compares local and server files in the given subdir. Both directories are listed once and the
+        result is reused for the rest of the refresh."""
+        key = (subdir, checksum)
+        if key not in self._comparisons:
+            local_directory = self.file_handler.get_dir('local', subdir)
+            server_directory = self.file_handler.get_dir('server', subdir)
+            if not local_directory or not server_directory:
+                return compare.Comparison()
+            self._comparisons[key] = compare.compare_stats(self.get_file_stats(local_directory),
+                                                           self.get_file_stats(server_directory),
+                                                           names=self.get_file_names('local', subdir),
+                                                           local_directory=local_directory,
+                                                           server_directory=server_directory,
+                                                           checksum=checksum)
+        return self._comparisons[key]
+
+    def get_summary(self):
+        seconds = time.perf_counter() - self._t0
+        return f'{self.nr_listings} directory listings in {seconds:.2f} s: ' + \
+               ', '.join([f'{name} ({nr})' for name, nr in self.listings.items()])
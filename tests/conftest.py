@@ -0,0 +1,25 @@
+import importlib
+import sys
+import types
+from pathlib import Path
+
+ROOT_DIRECTORY = Path(__file__).parents[1]
+DATA_DIRECTORY = Path(__file__).parent / 'data'
+# Name of the package the modules are loaded in
+PACKAGE_NAME = 'ctd_processing_plugin'
+
+
+def _get_package():
+    """Returns an empty package pointing at the plugin directory. Relative imports between the modules
+    work without running the __init__ of the plugin (which imports the gui)."""
+    if PACKAGE_NAME not in sys.modules:
+        package = types.ModuleType(PACKAGE_NAME)
+        package.__path__ = [str(ROOT_DIRECTORY)]
+        sys.modules[PACKAGE_NAME] = package
+    return sys.modules[PACKAGE_NAME]
+
+
+def load_module(name):
+    """Loads a module of the plugin without importing the plugin package (and the gui)"""
+    _get_package()
+    return importlib.import_module(f'{PACKAGE_NAME}.{name}')
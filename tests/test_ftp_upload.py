@@ -0,0 +1,159 @@
+"""
+Tests of ftp_upload against a local pyftpdlib server. STOR is delayed on the server so that the uploads
+actually overlap when sent over several connections.
+"""
+import ftplib
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('pyftpdlib')
+
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import ThreadedFTPServer
+
+from conftest import load_module
+
+ftp_upload = load_module('ftp_upload')
+
+STOR_DELAY = 0.3
+
+
+class DelayedStorHandler(FTPHandler):
+    nr_active = 0
+    max_active = 0
+    lock = threading.Lock()
+
+    def ftp_STOR(self, file, mode='w'):
+        cls = DelayedStorHandler
+        with cls.lock:
+            cls.nr_active += 1
+            cls.max_active = max(cls.max_active, cls.nr_active)
+        time.sleep(STOR_DELAY)
+        with cls.lock:
+            cls.nr_active -= 1
+        return super().ftp_STOR(file, mode=mode)
+
+
+class FailOnceFTP(ftplib.FTP):
+    """Sends half of the file the first time fail_name is stored and then drops the connection"""
+    failed = set()
+    fail_name = ''
+    raise_error = True
+
+    def storbinary(self, cmd, fp, blocksize=8192, callback=None, rest=None):
+        name = cmd.split(' ', 1)[1]
+        if name != self.fail_name or name in self.failed:
+            return super().storbinary(cmd, fp, blocksize=blocksize, callback=callback, rest=rest)
+        self.failed.add(name)
+        data = fp.read()
+        with self.transfercmd(cmd, rest) as conn:
+            conn.sendall(data[:len(data) // 2])
+        if self.raise_error:
+            raise ConnectionResetError('Injected failure')
+        return self.voidresp()
+
+
+@pytest.fixture
+def server(tmp_path):
+    root = tmp_path / 'server'
+    (root / 'test').mkdir(parents=True)
+    authorizer = DummyAuthorizer()
+    authorizer.add_user('user', 'password', str(root), perm='elradfmwMT')
+    handler = type('Handler', (DelayedStorHandler,), dict(authorizer=authorizer))
+    DelayedStorHandler.nr_active = 0
+    DelayedStorHandler.max_active = 0
+    srv = ThreadedFTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=srv.serve_forever, kwargs=dict(timeout=0.1), daemon=True)
+    thread.start()
+    credentials = dict(host='127.0.0.1', port=srv.address[1], user='user', password='password', test=True)
+    yield credentials, root / 'test'
+    srv.close_all()
+    thread.join(5)
+
+
+def _create_files(directory, nr_files, size=200_000):
+    directory.mkdir(exist_ok=True)
+    paths = []
+    for i in range(nr_files):
+        path = directory / f'file_{i}.txt'
+        path.write_bytes(bytes([i % 256]) * (size + i))
+        paths.append(path)
+    return paths
+
+
+def _connect_func(ftp_class, **attributes):
+    def connect(credentials, timeout=ftp_upload.TIMEOUT):
+        con = ftp_class(timeout=timeout)
+        for key, value in attributes.items():
+            setattr(con, key, value)
+        con.connect(credentials['host'], int(credentials['port']))
+        con.login(credentials['user'], credentials['password'])
+        con.cwd('test')
+        return con
+    return connect
+
+
+def test_parallel_upload(server, tmp_path):
+    credentials, remote_dir = server
+    paths = _create_files(tmp_path / 'local', 6)
+    status = []
+    result = ftp_upload.ParallelUploader(credentials, nr_connections=3).upload(paths, status_callback=status.append)
+    assert sorted(result.sent) == sorted(paths)
+    assert not result.failed
+    assert not result.resumed
+    assert result.nr_bytes == sum(path.stat().st_size for path in paths)
+    for path in paths:
+        assert (remote_dir / path.name).read_bytes() == path.read_bytes()
+    assert DelayedStorHandler.max_active > 1
+
+
+def test_status_callback(server, tmp_path):
+    credentials, _ = server
+    paths = _create_files(tmp_path / 'local', 4)
+    status = []
+    ftp_upload.ParallelUploader(credentials, nr_connections=2).upload(paths, status_callback=status.append)
+    assert [item[:2] for item in status] == [(1, 4), (2, 4), (3, 4), (4, 4)]
+    assert sorted(item[2] for item in status) == sorted(path.name for path in paths)
+
+
+def test_resume_after_failure(server, tmp_path):
+    credentials, remote_dir = server
+    paths = _create_files(tmp_path / 'local', 3)
+    FailOnceFTP.failed = set()
+    connect = _connect_func(FailOnceFTP, fail_name=paths[1].name)
+    result = ftp_upload.ParallelUploader(credentials, nr_connections=2, connect_func=connect).upload(paths)
+    assert not result.failed
+    assert result.resumed == [paths[1]]
+    assert result.nr_bytes < sum(path.stat().st_size for path in paths)
+    for path in paths:
+        assert (remote_dir / path.name).read_bytes() == path.read_bytes()
+
+
+def test_remote_size_check(server, tmp_path):
+    credentials, remote_dir = server
+    path = _create_files(tmp_path / 'local', 1)[0]
+    FailOnceFTP.failed = set()
+    con = _connect_func(FailOnceFTP, fail_name=path.name, raise_error=False)(credentials)
+    try:
+        with pytest.raises(ftp_upload.UploadError):
+            ftp_upload.upload_file(con, path)
+        assert ftp_upload.get_remote_size(con, path.name) == path.stat().st_size // 2
+        ftp_upload.upload_file(con, path, resume=True)
+        assert ftp_upload.get_remote_size(con, path.name) == path.stat().st_size
+        assert ftp_upload.get_remote_size(con, 'missing.txt') is None
+    finally:
+        con.quit()
+    assert (remote_dir / path.name).read_bytes() == path.read_bytes()
+
+
+def test_failed_after_retries(server, tmp_path):
+    credentials, _ = server
+    paths = _create_files(tmp_path / 'local', 2)
+    FailOnceFTP.failed = set()
+    connect = _connect_func(FailOnceFTP, fail_name=paths[0].name)
+    result = ftp_upload.ParallelUploader(credentials, nr_connections=1, retries=0, connect_func=connect).upload(paths)
+    assert result.sent == [paths[1]]
+    assert [path for path, _ in result.failed] == [paths[0]]
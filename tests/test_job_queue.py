@@ -0,0 +1,56 @@
+"""
+Tests of the retries of a stage recorded in the job queue
+"""
+import pytest
+
+from conftest import load_module
+
+job_queue = load_module('job_queue')
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(job_queue, 'BACKOFF_SECONDS', 0)
+    return job_queue.JobQueue(tmp_path)
+
+
+def test_failed_stage_is_retried(queue):
+    batch_id = queue.create_batch('test')
+    calls = []
+
+    def func():
+        calls.append(1)
+        if len(calls) < job_queue.MAX_ATTEMPTS:
+            raise OSError('Network drive not available')
+        return 'done'
+
+    assert job_queue.run_stage(queue, batch_id, 'standard_format', ['A', 'B'], func) == 'done'
+    assert len(calls) == job_queue.MAX_ATTEMPTS
+    assert queue.get_summary(batch_id) == {'standard_format': {job_queue.DONE: 2}}
+
+
+def test_stage_fails_after_max_attempts(queue):
+    batch_id = queue.create_batch('test')
+    calls = []
+
+    def func():
+        calls.append(1)
+        raise OSError('Network drive not available')
+
+    with pytest.raises(OSError):
+        job_queue.run_stage(queue, batch_id, 'copy', ['A'], func)
+    assert len(calls) == job_queue.MAX_ATTEMPTS
+    assert queue.get_summary(batch_id) == {'copy': {job_queue.FAILED: 1}}
+
+
+def test_file_exists_is_not_retried(queue):
+    batch_id = queue.create_batch('test')
+    calls = []
+
+    def func():
+        calls.append(1)
+        raise FileExistsError('exists')
+
+    with pytest.raises(FileExistsError):
+        job_queue.run_stage(queue, batch_id, 'plots', ['A'], func)
+    assert len(calls) == 1
@@ -0,0 +1,54 @@
+"""
+Tests of the stale casts found from the config files in the manifest
+"""
+import os
+import time
+
+import pytest
+
+from conftest import load_module
+
+manifest = load_module('manifest')
+
+PLATFORM = 'sbe09'
+CAST_ID = '0123'
+
+
+@pytest.fixture
+def setup(tmp_path):
+    config_directory = tmp_path / 'config' / PLATFORM
+    config_directory.mkdir(parents=True)
+    psa_path = config_directory / 'DatCnv.psa'
+    psa_path.write_text('<psa/>')
+    local_directory = tmp_path / 'local'
+    local_directory.mkdir()
+    cnv_path = local_directory / f'SBE09_1387_20240315_0830_77SE_01_{CAST_ID}.cnv'
+    cnv_path.write_text('cnv')
+    processing_manifest = manifest.Manifest(local_directory, tmp_path / 'config')
+    inputs = dict(files={}, config=processing_manifest.get_config_file_hashes([psa_path]),
+                  settings=dict(platform=PLATFORM))
+    processing_manifest.set_output(CAST_ID, 'cnv', inputs, [cnv_path])
+    processing_manifest.save()
+    # Processed a while ago
+    processing_manifest.data[CAST_ID]['cnv']['time'] = '2024-03-15 09:00:00'
+    old = time.mktime((2024, 3, 15, 8, 0, 0, 0, 0, -1))
+    os.utime(psa_path, (old, old))
+    return processing_manifest, config_directory
+
+
+def test_not_stale(setup):
+    processing_manifest, config_directory = setup
+    assert processing_manifest.get_stale_casts() == {}
+
+
+def test_changed_config_file(setup):
+    processing_manifest, config_directory = setup
+    (config_directory / 'DatCnv.psa').write_text('<psa changed="true"/>')
+    processing_manifest._file_hashes.clear()
+    assert processing_manifest.get_stale_casts() == {CAST_ID: [os.path.join(PLATFORM, 'DatCnv.psa')]}
+
+
+def test_added_config_file(setup):
+    processing_manifest, config_directory = setup
+    (config_directory / 'Filter.psa').write_text('<psa/>')
+    assert processing_manifest.get_stale_casts() == {CAST_ID: [os.path.join(PLATFORM, 'Filter.psa')]}
@@ -0,0 +1,52 @@
+"""
+Tests of the directory scan of the package index
+"""
+import os
+import time
+
+import pytest
+
+pytest.importorskip('file_explorer')
+
+from conftest import load_module
+
+package_index = load_module('package_index')
+
+FILE_NAME = 'SBE09_1387_20240315_0830_77SE_01_0123.txt'
+
+
+OLD_MTIME_NS = time.time_ns() - 10 * package_index.MTIME_MARGIN_SECONDS * 10 ** 9
+
+
+def set_old_mtime(path):
+    """Sets the mtime before MTIME_MARGIN_SECONDS so that the scan trusts it"""
+    os.utime(path, ns=(OLD_MTIME_NS, OLD_MTIME_NS))
+
+
+def test_file_rewritten_in_place_is_noticed(tmp_path):
+    path = tmp_path / 'data' / FILE_NAME
+    path.parent.mkdir()
+    path.write_text('first')
+    set_old_mtime(path)
+    set_old_mtime(path.parent)
+    set_old_mtime(tmp_path)
+    files, dirs = package_index.scan_directory(tmp_path)
+    assert files[str(path)][1] == len('first')
+
+    path.write_text('second version')
+    set_old_mtime(path.parent)
+    rescanned, rescanned_dirs = package_index.scan_directory(tmp_path, known_dirs=dirs, known_files=files)
+    assert rescanned_dirs == dirs
+    assert rescanned[str(path)] != files[str(path)]
+    assert rescanned[str(path)][1] == len('second version')
+
+
+def test_removed_file_is_noticed(tmp_path):
+    path = tmp_path / FILE_NAME
+    path.write_text('data')
+    set_old_mtime(tmp_path)
+    files, dirs = package_index.scan_directory(tmp_path)
+    path.unlink()
+    set_old_mtime(tmp_path)
+    rescanned, _ = package_index.scan_directory(tmp_path, known_dirs=dirs, known_files=files)
+    assert str(path) not in rescanned
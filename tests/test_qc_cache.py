@@ -0,0 +1,103 @@
+"""
+Tests of the qc cache: the key, hits and misses, eviction and that a cached result applied to a dataset
+gives the same flags and comments as the qc run it was made from.
+"""
+import time
+
+import pytest
+
+pd = pytest.importorskip('pandas')
+
+from conftest import load_module
+
+qc_cache = load_module('qc_cache')
+
+CONFIG_HASH = 'config'
+QC_COMMENT = '//COMNT_QC; AUTOMATIC QC PERFORMED BY mw; TIMESTAMP 202403150915; 0.2.0'
+
+
+def get_data(q0_flags=('', '', ''), q_flags=('', 'M', '')):
+    return pd.DataFrame({'PRES_CTD': ['1.0', '2.0', '3.0'],
+                         'TEMP_CTD': ['10.1', '10.0', '9.8'],
+                         'Q0_TEMP_CTD': list(q0_flags),
+                         'Q_TEMP_CTD': list(q_flags)})
+
+
+def get_metadata(lines, as_dict):
+    if as_dict:
+        return {nr: line for nr, line in enumerate(lines, 1)}
+    return pd.Series(lines, index=range(1, len(lines) + 1))
+
+
+def get_qc_session(item):
+    qc = pytest.importorskip('profileqc.qc')
+    if not hasattr(qc.SessionQC, 'update_data'):
+        # Older versions of profileqc take the item when created
+        return qc.SessionQC(item)
+    session = qc.SessionQC(None)
+    session.update_data(item)
+    return session
+
+
+def test_data_hash_excludes_flag_columns():
+    data_hash = qc_cache.get_data_hash(get_data(), name='a')
+    assert qc_cache.get_data_hash(get_data(q0_flags=('AB', 'AS', 'AA'), q_flags=('B', 'S', '')), name='a') == data_hash
+    assert qc_cache.get_data_hash(get_data(), name='b') != data_hash
+    changed = get_data()
+    changed['TEMP_CTD'] = ['10.1', '10.0', '9.9']
+    assert qc_cache.get_data_hash(changed, name='a') != data_hash
+
+
+def test_hit_and_miss(tmp_path):
+    cache = qc_cache.QcCache(tmp_path / 'cache.sqlite')
+    assert cache.get('data', config_hash=CONFIG_HASH) is None
+    cache.put('data', qc_cache.QcResult({'Q0_TEMP_CTD': ['A']}, [QC_COMMENT], {}), config_hash=CONFIG_HASH)
+    result = cache.get('data', config_hash=CONFIG_HASH)
+    assert result.flags == {'Q0_TEMP_CTD': ['A']}
+    assert result.comments == [QC_COMMENT]
+    assert cache.get('data', config_hash='other config') is None
+    assert cache.get_summary()['nr_hits'] == 1
+    assert cache.get_summary()['nr_misses'] == 2
+
+
+def test_invalidate(tmp_path):
+    cache = qc_cache.QcCache(tmp_path / 'cache.sqlite')
+    for data_hash in ['a', 'b']:
+        cache.put(data_hash, qc_cache.QcResult({}, [], {}), config_hash=CONFIG_HASH)
+    assert cache.invalidate(data_hash='a') == 1
+    assert cache.get('a', config_hash=CONFIG_HASH) is None
+    assert cache.get('b', config_hash=CONFIG_HASH) is not None
+
+
+def test_least_recently_used_is_evicted(tmp_path):
+    result = qc_cache.QcResult({'Q0_TEMP_CTD': ['A'] * 100}, [QC_COMMENT], {})
+    size = len(result.dumps())
+    cache = qc_cache.QcCache(tmp_path / 'cache.sqlite', max_size=2 * size)
+    for data_hash in ['a', 'b']:
+        cache.put(data_hash, result, config_hash=CONFIG_HASH)
+        time.sleep(0.01)
+    cache.get('a', config_hash=CONFIG_HASH)
+    time.sleep(0.01)
+    cache.put('c', result, config_hash=CONFIG_HASH)
+    assert cache.get('b', config_hash=CONFIG_HASH) is None
+    assert cache.get('a', config_hash=CONFIG_HASH) is not None
+    assert cache.get('c', config_hash=CONFIG_HASH) is not None
+
+
+@pytest.mark.parametrize('as_dict', [False, True])
+def test_apply_reproduces_qc_result(as_dict):
+    header = ['//METADATA;A', '//METADATA;B']
+    checked = dict(data=get_data(q0_flags=('AA', 'AB', 'AS')), metadata=get_metadata(header, as_dict))
+    get_qc_session(checked).synchronize_flag_fields()
+    checked['metadata'][len(checked['metadata']) + 1] = QC_COMMENT
+    result = qc_cache.QcResult.from_item(checked, len(header), {})
+    assert result.comments == [QC_COMMENT]
+
+    item = dict(data=get_data(), metadata=get_metadata(header, as_dict))
+    result.apply(item, get_qc_session(item))
+    assert item['data']['Q0_TEMP_CTD'].tolist() == ['AA', 'AB', 'AS']
+    assert item['data']['Q_TEMP_CTD'].tolist() == checked['data']['Q_TEMP_CTD'].tolist() == ['', 'B', 'S']
+    lines = qc_cache.get_metadata_lines(item['metadata'])
+    assert lines[:len(header)] == header
+    assert qc_cache.TIMESTAMP_PATTERN.sub('', lines[-1]) == qc_cache.TIMESTAMP_PATTERN.sub('', QC_COMMENT)
+    assert len(lines) == len(header) + 1
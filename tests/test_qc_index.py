@@ -0,0 +1,64 @@
+"""
+Tests of the header parsing in qc_index with a standard format file. The automatic qc stamp is written by
+profileqc (SessionQC.default_comnt), the file is checked against that format if profileqc is installed.
+"""
+import datetime
+import shutil
+
+import pytest
+
+from conftest import DATA_DIRECTORY
+from conftest import load_module
+
+qc_index = load_module('qc_index')
+
+FILE_NAME = 'SBE09_1387_20240315_0830_77SE_01_0123.txt'
+
+
+@pytest.fixture
+def standard_format_path(tmp_path):
+    path = tmp_path / FILE_NAME
+    shutil.copy(DATA_DIRECTORY / FILE_NAME, path)
+    return path
+
+
+def test_read_header_stamps(standard_format_path):
+    stamps = qc_index.read_header_stamps(standard_format_path)
+    assert stamps['automatic_qc'] == ['202403150915', '202403171005']
+    assert stamps['manual_qc'] == ['202403161130']
+    assert len(stamps['qc_comments']) == 3
+    assert stamps['flag_columns'] == ['Q0_PRES_CTD', 'Q0_TEMP_CTD', 'Q0_SALT_CTD']
+
+
+def test_profileqc_stamp_format():
+    profileqc_qc = pytest.importorskip('profileqc.qc')
+    line = profileqc_qc.SessionQC.default_comnt.format('mw', '202403150915', '0.2.0')
+    match = qc_index.QC_STAMP_PATTERN.search(line.upper())
+    assert match
+    assert match.group('kind') in qc_index.AUTOMATIC_KINDS
+    assert match.group('timestamp') == '202403150915'
+
+
+def test_automatic_qc_today(standard_format_path, tmp_path):
+    index = qc_index.QcIndex(tmp_path / 'index.sqlite')
+    assert index.has_automatic_qc_today(standard_format_path, today=datetime.date(2024, 3, 15))
+    assert not index.has_automatic_qc_today(standard_format_path, today=datetime.date(2024, 3, 16))
+    assert index.get_last_automatic_qc(standard_format_path) == '202403171005'
+
+
+def test_changed_file_is_read_again(standard_format_path, tmp_path):
+    index = qc_index.QcIndex(tmp_path / 'index.sqlite')
+    today = datetime.date(2024, 3, 20)
+    assert not index.has_automatic_qc_today(standard_format_path, today=today)
+    lines = standard_format_path.read_text(encoding=qc_index.FILE_ENCODING).splitlines()
+    nr_header_lines = len([line for line in lines if line.startswith(qc_index.HEADER_PREFIX)])
+    lines.insert(nr_header_lines, '//COMNT_QC; AUTOMATIC QC PERFORMED BY mw; TIMESTAMP 202403200800; 0.2.0')
+    standard_format_path.write_text('\n'.join(lines) + '\n', encoding=qc_index.FILE_ENCODING)
+    assert index.has_automatic_qc_today(standard_format_path, today=today)
+
+
+def test_index_is_stored_in_local_root(tmp_path):
+    index = qc_index.get_qc_index(tmp_path)
+    assert index.file_path == tmp_path / qc_index.INDEX_FILE_NAME
+    assert index.file_path.exists()
+    assert qc_index.get_qc_index(tmp_path) is index
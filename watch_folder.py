@@ -0,0 +1,126 @@
+"""
+Watch mode for the source directory. The deck unit writes a hex, xmlcon and hdr file after each cast.
+A cast is ready when all three files exist and have not changed size for stable_seconds. Ready casts are
+processed, converted to standard format and checked by automatic qc without anyone pressing a button.
+"""
+import logging
+import os
+import time
+from pathlib import Path
+
+from . import batch
+from . import job_queue
+from . import jobs
+from . import pipeline
+
+logger = logging.getLogger(__name__)
+
+REQUIRED_SUFFIXES = ['.hex', '.xmlcon', '.hdr']
+STABLE_SECONDS = 5
+POLL_INTERVAL = 2
+MAX_ATTEMPTS = 3
+
+
+def get_packages(directory):
+    """Returns a dict with stem as key and a dict {suffix: path} as value for the raw files in directory"""
+    packages = {}
+    try:
+        entries = list(os.scandir(directory))
+    except (FileNotFoundError, NotADirectoryError):
+        return packages
+    for entry in entries:
+        if not entry.is_file():
+            continue
+        stem, suffix = os.path.splitext(entry.name)
+        suffix = suffix.lower()
+        if suffix not in REQUIRED_SUFFIXES:
+            continue
+        packages.setdefault(stem, {})[suffix] = Path(entry.path)
+    return packages
+
+
+def is_complete(package):
+    return all([suffix in package for suffix in REQUIRED_SUFFIXES])
+
+
+def get_sizes(package):
+    try:
+        return tuple(package[suffix].stat().st_size for suffix in REQUIRED_SUFFIXES)
+    except FileNotFoundError:
+        return None
+
+
+class SourceWatcher:
+
+    def __init__(self, directory, stable_seconds=STABLE_SECONDS, year=None, ignore_existing=True):
+        self.directory = Path(directory)
+        self.stable_seconds = stable_seconds
+        self.year = str(year) if year else None
+        self._pending = {}
+        self._handled = set()
+        self._attempts = {}
+        if ignore_existing:
+            self._handled = set(get_packages(self.directory))
+
+    def poll(self, now=None):
+        """Returns the hex paths of new casts that are complete and have stopped growing"""
+        now = now or time.time()
+        ready = []
+        for stem, package in get_packages(self.directory).items():
+            if stem in self._handled or not is_complete(package):
+                continue
+            if self.year and pipeline.get_year_from_key(package['.hex'].name) != self.year:
+                continue
+            sizes = get_sizes(package)
+            if sizes is None:
+                continue
+            previous = self._pending.get(stem)
+            if not previous or previous[0] != sizes:
+                self._pending[stem] = (sizes, now)
+                continue
+            if now - previous[1] < self.stable_seconds:
+                continue
+            self._pending.pop(stem)
+            self._handled.add(stem)
+            ready.append(package['.hex'])
+        return sorted(ready)
+
+    def forget(self, hex_path):
+        """The cast will be returned again by poll (for example if the processing failed). A cast is
+        returned at most MAX_ATTEMPTS times. Returns True if the cast will be retried."""
+        stem = Path(hex_path).stem
+        self._attempts[stem] = self._attempts.get(stem, 1) + 1
+        if self._attempts[stem] > MAX_ATTEMPTS:
+            logger.warning(f'Watch mode: giving up on {stem} after {MAX_ATTEMPTS} attempts')
+            return False
+        self._handled.discard(stem)
+        return True
+
+
+def process_casts(processor, hex_paths, file_handler, old_key=False):
+    """Runs process -> standard format -> automatic qc for the given casts. Used in the job executor.
+    The stages are recorded in the job queue batch of the processor (if any).
+    Returns the processing results and the qc-checked files."""
+    results = processor.run_all(hex_paths)
+    ids = [pipeline.get_id_from_key(result.path.name) for result in results if result.ok]
+    qc_files = []
+    if not ids:
+        return results, qc_files
+    jobs.raise_if_cancelled()
+    file_handler.store_files('local')
+    local_root_directory = processor.root_dirs.get('local')
+    cnv_packs = pipeline.get_packs_for_ids(file_handler.get_dir('local', 'cnv'), ids, old_key=old_key,
+                                           local_root_directory=local_root_directory)
+    job_queue.run_stage(processor.job_queue, processor.batch_id, 'standard_format', ids,
+                        pipeline.create_standard_format, cnv_packs, file_handler, year=processor.year,
+                        root_dirs=processor.root_dirs, nr_workers=processor.nr_workers, old_key=old_key)
+    jobs.raise_if_cancelled()
+    nsf_packs = pipeline.get_packs_for_ids(file_handler.get_dir('local', 'data'), ids, old_key=old_key,
+                                           local_root_directory=local_root_directory)
+    qc_files = [pack['txt'] for pack in nsf_packs]
+    if qc_files:
+        job_queue.run_stage(processor.job_queue, processor.batch_id, 'automatic_qc', ids,
+                            pipeline.run_automatic_qc, qc_files, file_handler, nr_workers=processor.nr_workers,
+                            local_root_directory=local_root_directory)
+    logger.info(f'Watch mode: {len(ids)} of {len(hex_paths)} casts processed')
+    return results, qc_files
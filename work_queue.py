@@ -0,0 +1,410 @@
+"""
+Work queue on a shared file system, used to spread a reprocessing campaign over several workstations that
+mount the same data root. There is no central service: the queue is a directory and the workers
+coordinate through atomic file operations only. SQLite is not used here since its locking is not reliable
+on network file systems.
+
+    <local_root>/work_queue/<campaign>/
+        campaign.json           settings for the whole campaign (year, platform, surfacesoak...)
+        todo/<cast_id>.json     one file per cast to process
+        claims/<cast_id>.claim  created with O_CREAT | O_EXCL by the worker that processes the cast
+        results/<cast_id>.json  written (temp file + rename) when the cast is finished
+
+A cast is done when its result file exists. The worker touches its claim file every HEARTBEAT_SECONDS.
+A claim that has not been touched for CLAIM_TIMEOUT seconds (the worker died) is taken over by another
+worker. A worker that finds that its claim has been taken over stops the heartbeat and leaves the cast
+(without result) to the new owner.
+
+The processing writes to a staging directory in the local temp directory. The files are then renamed into
+the local root one by one, so other workers never see partly written outputs. Standard format and automatic
+qc are staged in the same way (see pipeline.prepare_cast_for_manual_qc). Outputs of a cast that was
+interrupted are overwritten when the cast is processed again.
+
+Each worker runs process -> standard format -> automatic qc (-> plots) for one cast at a time. Start
+workers with cli.py (see the worker and enqueue commands there).
+"""
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import threading
+import time
+import traceback
+import uuid
+from pathlib import Path
+
+from . import batch
+from . import manifest
+from . import pipeline
+
+logger = logging.getLogger(__name__)
+
+QUEUE_DIRECTORY_NAME = 'work_queue'
+DEFAULT_CAMPAIGN = 'default'
+CLAIM_TIMEOUT = 600
+HEARTBEAT_SECONDS = 30
+IDLE_SLEEP_SECONDS = 10
+
+RESULT_OK = 'ok'
+RESULT_FAILED = 'failed'
+
+
+class ClaimLostError(Exception):
+    pass
+
+
+def get_queue_directory(local_root_directory, campaign=DEFAULT_CAMPAIGN):
+    return Path(local_root_directory, QUEUE_DIRECTORY_NAME, campaign)
+
+
+def get_worker_id():
+    return f'{socket.gethostname()}_{os.getpid()}_{uuid.uuid4().hex[:6]}'
+
+
+def write_json_atomic(path, data):
+    """Writes data to a temporary file in the same directory and renames it to path. Readers never see a
+    partly written file."""
+    path = Path(path)
+    temp_path = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.tmp')
+    with open(temp_path, 'w') as fid:
+        json.dump(data, fid, indent=4, default=str)
+        fid.flush()
+        os.fsync(fid.fileno())
+    os.replace(temp_path, path)
+
+
+def read_json(path):
+    try:
+        with open(path) as fid:
+            return json.load(fid)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+class WorkQueue:
+
+    def __init__(self, directory, worker_id=None):
+        self.directory = Path(directory)
+        self.worker_id = worker_id or get_worker_id()
+        self.todo_directory = Path(self.directory, 'todo')
+        self.claims_directory = Path(self.directory, 'claims')
+        self.results_directory = Path(self.directory, 'results')
+
+    def create(self, settings):
+        for directory in [self.todo_directory, self.claims_directory, self.results_directory]:
+            directory.mkdir(parents=True, exist_ok=True)
+        write_json_atomic(Path(self.directory, 'campaign.json'), settings)
+
+    @property
+    def settings(self):
+        return read_json(Path(self.directory, 'campaign.json')) or {}
+
+    def add_casts(self, hex_paths):
+        """Adds the casts to the queue. Casts that already are in the queue are not added again.
+        Returns the number of added casts."""
+        nr_added = 0
+        for path in hex_paths:
+            cast_id = pipeline.get_id_from_key(Path(path).name)
+            todo_path = Path(self.todo_directory, f'{cast_id}.json')
+            if todo_path.exists():
+                continue
+            write_json_atomic(todo_path, dict(cast_id=cast_id, path=str(path)))
+            nr_added += 1
+        return nr_added
+
+    def get_cast_ids(self):
+        return sorted([path.stem for path in self.todo_directory.glob('*.json')])
+
+    def get_result(self, cast_id):
+        return read_json(Path(self.results_directory, f'{cast_id}.json'))
+
+    def get_todo(self, cast_id):
+        return read_json(Path(self.todo_directory, f'{cast_id}.json'))
+
+    def get_remaining_cast_ids(self):
+        done = {path.stem for path in self.results_directory.glob('*.json')}
+        return [cast_id for cast_id in self.get_cast_ids() if cast_id not in done]
+
+    def _claim_path(self, cast_id):
+        return Path(self.claims_directory, f'{cast_id}.claim')
+
+    def _create_claim(self, path):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as fid:
+            json.dump(dict(worker=self.worker_id, time=time.time()), fid)
+        return True
+
+    def _get_claim_owner(self, path):
+        data = read_json(path)
+        if not data:
+            return None
+        return data.get('worker')
+
+    def claim(self, cast_id):
+        """Returns True if this worker got the cast. A claim older than CLAIM_TIMEOUT is taken over."""
+        path = self._claim_path(cast_id)
+        if self._create_claim(path):
+            return True
+        try:
+            age = time.time() - path.stat().st_mtime
+        except FileNotFoundError:
+            return self._create_claim(path)
+        if age < CLAIM_TIMEOUT:
+            return False
+        owner = self._get_claim_owner(path)
+        # Only one worker can rename the stale claim
+        stale_path = path.with_name(f'{path.name}.{self.worker_id}.stale')
+        try:
+            os.rename(path, stale_path)
+        except FileNotFoundError:
+            return False
+        if self._get_claim_owner(stale_path) != owner:
+            # Another worker took over between stat and rename, give its claim back
+            try:
+                os.link(stale_path, path)
+            except OSError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        logger.warning(f'Took over stale claim for {cast_id} from {owner}')
+        return self._create_claim(path)
+
+    def owns(self, cast_id):
+        return self._get_claim_owner(self._claim_path(cast_id)) == self.worker_id
+
+    def heartbeat(self, cast_id):
+        try:
+            os.utime(self._claim_path(cast_id))
+        except FileNotFoundError:
+            pass
+
+    def release(self, cast_id):
+        if not self.owns(cast_id):
+            return
+        try:
+            os.remove(self._claim_path(cast_id))
+        except FileNotFoundError:
+            pass
+
+    def set_result(self, cast_id, status, **kwargs):
+        data = dict(cast_id=cast_id, status=status, worker=self.worker_id,
+                    finished=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), **kwargs)
+        write_json_atomic(Path(self.results_directory, f'{cast_id}.json'), data)
+
+    def reset_failed(self):
+        """Removes the results of failed casts so that they are processed again"""
+        nr = 0
+        for path in self.results_directory.glob('*.json'):
+            data = read_json(path)
+            if data and data.get('status') == RESULT_FAILED:
+                os.remove(path)
+                nr += 1
+        return nr
+
+    def get_summary(self):
+        summary = dict(nr_casts=0, nr_done=0, nr_failed=0, nr_claimed=0, nr_remaining=0, failed={})
+        cast_ids = self.get_cast_ids()
+        summary['nr_casts'] = len(cast_ids)
+        for cast_id in cast_ids:
+            result = self.get_result(cast_id)
+            if not result:
+                summary['nr_remaining'] += 1
+                if self._claim_path(cast_id).exists():
+                    summary['nr_claimed'] += 1
+            elif result['status'] == RESULT_OK:
+                summary['nr_done'] += 1
+            else:
+                summary['nr_failed'] += 1
+                summary['failed'][cast_id] = result.get('message', '')
+        return summary
+
+
+class _Heartbeat:
+    """Touches the claim file in a background thread while a cast is processed. The heartbeat stops if the
+    claim has been taken over by another worker, see check_claim."""
+
+    def __init__(self, work_queue, cast_id):
+        self._work_queue = work_queue
+        self._cast_id = cast_id
+        self._stop_event = threading.Event()
+        self._lost_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='work_queue_heartbeat')
+
+    @property
+    def lost(self):
+        return self._lost_event.is_set()
+
+    def _run(self):
+        while not self._stop_event.wait(HEARTBEAT_SECONDS):
+            if not self._work_queue.owns(self._cast_id):
+                logger.warning(f'Claim for {self._cast_id} has been taken over by another worker')
+                self._lost_event.set()
+                return
+            self._work_queue.heartbeat(self._cast_id)
+
+    def check_claim(self):
+        """Raises ClaimLostError if the claim has been taken over by another worker"""
+        if self.lost or not self._work_queue.owns(self._cast_id):
+            self._lost_event.set()
+            raise ClaimLostError(self._cast_id)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop_event.set()
+        self._thread.join()
+
+
+def move_staged_files(staging_directory, target_directory):
+    """Moves all files below staging_directory to the same relative path below target_directory. Each file
+    is renamed in one operation."""
+    staging_directory = Path(staging_directory)
+    for root, dirs, files in os.walk(staging_directory):
+        for name in files:
+            source = Path(root, name)
+            target = Path(target_directory, source.relative_to(staging_directory))
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(source, target)
+
+
+def _get_target_path(path, staging_directory, target_directory):
+    try:
+        return Path(target_directory, Path(path).relative_to(staging_directory))
+    except ValueError:
+        return path
+
+
+def _process_in_staging_directory(hex_path, year, root_dirs, settings):
+    """Processes the cast with a staging directory as local root and moves the outputs to the local root.
+    Returns the ProcessingResult with the paths in the local root."""
+    handler = batch.get_file_handler(year, root_dirs)
+    staging_directory = Path(handler.get_dir('local', 'temp'), QUEUE_DIRECTORY_NAME, uuid.uuid4().hex)
+    staging_directory.mkdir(parents=True)
+    try:
+        result = batch.process_hex_file(hex_path, year=year, root_dirs={**root_dirs, 'local': str(staging_directory)},
+                                        mismatch_policy=settings.get('mismatch_policy', batch.MISMATCH_SKIP),
+                                        **settings['processing_kwargs'])
+        if result.ok:
+            move_staged_files(staging_directory, root_dirs['local'])
+            result.processed_path = _get_target_path(result.processed_path, staging_directory, root_dirs['local'])
+            result.cnv_path = _get_target_path(result.cnv_path, staging_directory, root_dirs['local'])
+    finally:
+        shutil.rmtree(staging_directory, ignore_errors=True)
+        # The handlers of the staging directory are not needed any more and the local root has new files
+        batch.clear_file_handlers()
+    return result
+
+
+def process_cast(hex_path, settings, check_claim=None):
+    """Runs process -> standard format -> automatic qc (-> plots) for one cast. The config files used are
+    recorded in the manifest in the local root. check_claim is called between the stages and should raise
+    if the worker no longer owns the cast. Returns a dict with the result."""
+    check_claim = check_claim or (lambda: None)
+    year = settings['year']
+    root_dirs = settings['root_dirs']
+    old_key = bool(settings.get('old_key'))
+    stages = {}
+    t0 = time.perf_counter()
+    result = _process_in_staging_directory(hex_path, year, root_dirs, settings)
+    stages['process'] = round(time.perf_counter() - t0, 3)
+    if not result.ok:
+        return dict(status=RESULT_FAILED, stage='process', message=f'{result.status}: {result.message}',
+                    stages=stages)
+    processing_manifest = manifest.Manifest(root_dirs['local'], root_dirs.get('config'), skip_unchanged=False)
+    batch.add_to_manifest(processing_manifest, result, **settings['processing_kwargs'])
+    processing_manifest.save()
+    check_claim()
+    t0 = time.perf_counter()
+    cast = pipeline.prepare_cast_for_manual_qc(hex_path, year=year, root_dirs=root_dirs, old_key=old_key)
+    stages['standard_format_and_automatic_qc'] = round(time.perf_counter() - t0, 3)
+    if not cast.ok:
+        return dict(status=RESULT_FAILED, stage='automatic_qc', message=cast.message, stages=stages)
+    pipeline.add_cast_to_manifest(processing_manifest, cast, result.cnv_path, old_key=old_key)
+    processing_manifest.save()
+    if settings.get('create_plots') and cast.qc_path:
+        check_claim()
+        t0 = time.perf_counter()
+        handler = batch.get_file_handler(year, root_dirs)
+        pipeline.create_plots_for_file(cast.qc_path, plots_directory=handler.get_dir('local', 'plots'))
+        stages['plots'] = round(time.perf_counter() - t0, 3)
+    return dict(status=RESULT_OK, stages=stages, qc_path=str(cast.qc_path or ''))
+
+
+def create_campaign(local_root_directory, hex_paths, year, config_root_directory, campaign=DEFAULT_CAMPAIGN,
+                    create_plots=False, mismatch_policy=batch.MISMATCH_SKIP, **processing_kwargs):
+    """Creates (or adds casts to) a campaign in the shared local root. processing_kwargs are passed on
+    to process_sbe_file (platform, surfacesoak...). Returns the WorkQueue."""
+    work_queue = WorkQueue(get_queue_directory(local_root_directory, campaign))
+    if not Path(work_queue.directory, 'campaign.json').exists():
+        processing_kwargs.setdefault('overwrite', True)
+        processing_kwargs.setdefault('psa_paths', None)
+        work_queue.create(dict(year=str(year),
+                               root_dirs=dict(local=str(local_root_directory), config=str(config_root_directory)),
+                               old_key=bool(processing_kwargs.get('old_key')),
+                               create_plots=create_plots,
+                               mismatch_policy=mismatch_policy,
+                               processing_kwargs=processing_kwargs))
+    nr_added = work_queue.add_casts(hex_paths)
+    logger.info(f'{nr_added} casts added to campaign {campaign}')
+    return work_queue
+
+
+def run_worker(queue_directory, max_casts=None, wait=False):
+    """Claims and processes casts until the queue is empty (or max_casts are processed). With wait=True
+    the worker keeps looking for new casts. Returns the number of processed casts."""
+    work_queue = WorkQueue(queue_directory)
+    settings = work_queue.settings
+    if not settings:
+        raise FileNotFoundError(f'No campaign found in {queue_directory}')
+    nr_processed = 0
+    logger.info(f'Worker {work_queue.worker_id} started on {queue_directory}')
+    while max_casts is None or nr_processed < max_casts:
+        remaining = work_queue.get_remaining_cast_ids()
+        cast_id = next((cast_id for cast_id in remaining if work_queue.claim(cast_id)), None)
+        if cast_id is None:
+            if remaining or wait:
+                # Casts are claimed by other workers. A stale claim can be taken over later
+                time.sleep(IDLE_SLEEP_SECONDS)
+                continue
+            break
+        if work_queue.get_result(cast_id):
+            # Finished by another worker between listing and claim
+            work_queue.release(cast_id)
+            continue
+        todo = work_queue.get_todo(cast_id)
+        t0 = time.perf_counter()
+        try:
+            with _Heartbeat(work_queue, cast_id) as heartbeat:
+                result = process_cast(todo['path'], settings, check_claim=heartbeat.check_claim)
+        except ClaimLostError:
+            result = None
+        except Exception:
+            result = dict(status=RESULT_FAILED, message=traceback.format_exc())
+        if result is None or not work_queue.owns(cast_id):
+            logger.warning(f'{cast_id}: claim taken over by another worker, no result written')
+            continue
+        result['seconds'] = round(time.perf_counter() - t0, 3)
+        work_queue.set_result(cast_id, **result)
+        work_queue.release(cast_id)
+        nr_processed += 1
+        logger.info(f'{cast_id}: {result["status"]} in {result["seconds"]} s')
+    logger.info(f'Worker {work_queue.worker_id} finished after {nr_processed} casts')
+    return nr_processed
+
+
+def run_workers(queue_directory, nr_workers=1, wait=False):
+    """Runs nr_workers worker processes on this machine. Returns the total number of processed casts."""
+    if nr_workers <= 1:
+        return run_worker(queue_directory, wait=wait)
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(nr_workers) as pool:
+        return sum(pool.starmap(run_worker, [(str(queue_directory), None, wait)] * nr_workers))